@@ -0,0 +1,106 @@
+import threading
+import collections
+
+ADAPTIVE_INITIAL_LIMIT = 4
+ADAPTIVE_MAX_LIMIT = 64
+# recent requests the error rate is computed over
+ADAPTIVE_SAMPLE_SIZE = 200
+# a round, after which the limit is reconsidered, is at least this many requests, so its p95 latency can be trusted
+ADAPTIVE_MIN_SAMPLES = 20
+ADAPTIVE_ERROR_RATE_THRESHOLD = 0.05
+# p95 latency past this many times the best p95 seen means requests are queueing at the target
+ADAPTIVE_LATENCY_TOLERANCE = 1.3
+ADAPTIVE_ERROR_BACKOFF = 0.5
+ADAPTIVE_LATENCY_BACKOFF = 0.9
+
+def is_overloaded_status(status_code):
+    # throttled, or the target (or the API Gateway in front of it) failing under load
+    return status_code == 429 or status_code >= 500
+
+def _p95(values):
+    ordered = sorted(values)
+    return ordered[int(0.95 * (len(ordered) - 1))]
+
+class AdaptiveLimiter:
+    '''
+        AIMD limit on requests in flight: after each round of completed requests, grows the limit by one
+        while p95 latency and error rate stay healthy; halves it on throttling (429), 5xx or timeouts,
+        and shrinks it slightly when p95 latency rises well above the best seen, before errors start.
+        A round is `limit` requests but at least `ADAPTIVE_MIN_SAMPLES`, and its p95 latency only counts requests
+        sent at the current limit, so latencies from before a change never trigger another one.
+        Pass the same limiter to several calls to keep what it learned about the target; `record()` is thread safe.
+    '''
+    def __init__(self, initial=ADAPTIVE_INITIAL_LIMIT, min_limit=1, max_limit=ADAPTIVE_MAX_LIMIT):
+        self.limit = initial
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        # seconds, of successful requests of the current round
+        self.latencies = []
+        # True for requests failed by overload
+        self.failures = collections.deque(maxlen=ADAPTIVE_SAMPLE_SIZE)
+        self.best_p95 = None
+        # p95 latency of the last full round, for `report()`
+        self.last_p95 = None
+        self.completed_since_change = 0
+        # requests still in flight when the limit changed were sent at the old limit, their latency is not counted
+        self.ignore_count = 0
+        self.lock = threading.Lock()
+        self.max_limit_reached = initial
+        self.backoff_count = 0
+        # whether the last change of limit was a back-off on errors
+        self.backed_off = False
+
+    def get_limit(self):
+        return self.limit
+
+    def record(self, latency=None, status_code=None, timed_out=False):
+        '''
+            Records a completed request attempt: its latency in seconds, and its status code unless it timed out
+        '''
+        with self.lock:
+            self._record(latency, status_code, timed_out)
+
+    def _record(self, latency, status_code, timed_out):
+        overloaded = timed_out or is_overloaded_status(status_code)
+        self.failures.append(overloaded)
+        if self.ignore_count:
+            self.ignore_count -= 1
+        elif latency is not None and not overloaded:
+            self.latencies.append(latency)
+        self.completed_since_change += 1
+
+        if overloaded:
+            # requests sent before a back-off fail the same way, so only back off again after a round at the new limit
+            if not self.backed_off or self.completed_since_change >= self.limit:
+                self._change(int(self.limit * ADAPTIVE_ERROR_BACKOFF))
+                self.backed_off = True
+                self.backoff_count += 1
+            return
+
+        if self.completed_since_change < self.limit or len(self.latencies) < ADAPTIVE_MIN_SAMPLES:
+            return
+        p95 = self.last_p95 = _p95(self.latencies)
+        self.best_p95 = p95 if self.best_p95 is None else min(self.best_p95, p95)
+        if p95 > self.best_p95 * ADAPTIVE_LATENCY_TOLERANCE:
+            self._change(int(self.limit * ADAPTIVE_LATENCY_BACKOFF))
+        elif self.error_rate() <= ADAPTIVE_ERROR_RATE_THRESHOLD:
+            self._change(self.limit + 1)
+        else:
+            self._change(self.limit)
+
+    def _change(self, limit):
+        self.backed_off = False
+        # as many requests as were in flight at the old limit complete before those sent at the new one
+        self.ignore_count = self.limit
+        self.limit = max(self.min_limit, min(self.max_limit, limit))
+        self.max_limit_reached = max(self.max_limit_reached, self.limit)
+        self.completed_since_change = 0
+        self.latencies = []
+
+    def error_rate(self):
+        return sum(self.failures) / len(self.failures) if self.failures else 0
+
+    def report(self):
+        p95_message = f'{self.last_p95:.3f}s' if self.last_p95 is not None else 'n/a'
+        return f'adaptive concurrency settled at {self.limit} in flight (max reached {self.max_limit_reached}, backed off {self.backoff_count} times), ' \
+            f'p95 latency {p95_message}, error rate {self.error_rate():.1%} over the last {len(self.failures)} requests'
@@ -0,0 +1,188 @@
+import os
+import json
+import time
+import atexit
+import asyncio
+import datetime
+import threading
+
+import requests
+
+# optional, only needed by the `asyncio` transport of `Serverless`
+try:
+    import aiohttp
+    import yarl
+except ImportError:
+    aiohttp = None
+
+# process wide cap on open connections, each call bounds its own in-flight requests below this
+ASYNC_MAX_CONNECTIONS = 100
+ASYNC_KEEPALIVE_TIMEOUT = 30
+ASYNC_REQUEST_TIMEOUT = 300
+ASYNC_MAX_ATTEMPTS = 5
+ASYNC_BACKOFF_FACTOR = 0.17
+# a request of another method may have reached the target before the error, only retry it if it was never sent
+IDEMPOTENT_METHODS = ('GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE')
+# signing hashes the body, bodies from this size on are signed in a worker thread so the event loop is not held up;
+# smaller ones are signed on the loop, which takes less than handing them to a thread
+SIGN_OFF_LOOP_MIN_BYTES = 256 * 1024
+
+class AsyncResponse:
+    '''
+        The parts of `requests.Response` that `Serverless` reads, for a response read by aiohttp,
+        so the same response handling works for both transports
+    '''
+    def __init__(self, url, status_code, reason, headers, text, elapsed):
+        self.url = url
+        self.status_code = status_code
+        self.reason = reason
+        self.headers = headers
+        self.text = text
+        self.elapsed = elapsed
+
+    @property
+    def ok(self):
+        return self.status_code < 400
+
+    def json(self):
+        return json.loads(self.text)
+
+    def raise_for_status(self):
+        if not self.ok:
+            raise requests.HTTPError(f'{self.status_code} {self.reason} for url: {self.url}', response=self)
+
+class AsyncTransport:
+    '''
+        Sends requests by aiohttp, with one pooled keep-alive client per process and event loop.
+        Requests are signed by the same `AWS4Auth` as the threaded transport, as returned by `get_auth()` for each request.
+
+        Sync callers go through `run()`, which runs coroutines on a background event loop owned by this transport,
+        so the client and its connections are kept across calls instead of closed with each `asyncio.run()`.
+        Async callers on their own event loop get a client for that loop, which they close by `aclose()` before the loop ends.
+    '''
+    def __init__(self, get_auth, max_connections=ASYNC_MAX_CONNECTIONS):
+        if not aiohttp:
+            raise Exception('TransportError: the `asyncio` transport needs aiohttp, run `pip install aiohttp`')
+        self.get_auth = get_auth
+        self.max_connections = max_connections
+        self.pid = os.getpid()
+        # event loop -> its aiohttp client; a client only works on the loop it was created on
+        self.clients = {}
+        self.loop = None
+        self.lock = threading.Lock()
+        # connection reuse counters, see `stats()`
+        self.requests_count = 0
+        self.connections_count = 0
+        atexit.register(self.close)
+
+    def _check_fork(self):
+        # the background loop thread and connections do not survive a fork, start over in the child
+        if os.getpid() != self.pid:
+            self.pid = os.getpid()
+            self.clients = {}
+            self.loop = None
+
+    def _get_client(self):
+        self._check_fork()
+        loop = asyncio.get_running_loop()
+        # forget clients of loops that ended without `aclose()`, they cannot be closed anymore
+        for closed_loop in [client_loop for client_loop in self.clients if client_loop.is_closed()]:
+            del self.clients[closed_loop]
+        client = self.clients.get(loop)
+        if client is None or client.closed:
+            connector = aiohttp.TCPConnector(limit=self.max_connections, keepalive_timeout=ASYNC_KEEPALIVE_TIMEOUT)
+            client = aiohttp.ClientSession(
+                connector=connector, timeout=aiohttp.ClientTimeout(total=ASYNC_REQUEST_TIMEOUT), trace_configs=[self._get_trace_config()]
+            )
+            self.clients[loop] = client
+        return client
+
+    def _get_trace_config(self):
+        trace_config = aiohttp.TraceConfig()
+
+        async def on_request_start(session, context, params):
+            self.requests_count += 1
+
+        async def on_connection_create_end(session, context, params):
+            self.connections_count += 1
+
+        trace_config.on_request_start.append(on_request_start)
+        trace_config.on_connection_create_end.append(on_connection_create_end)
+        return trace_config
+
+    def stats(self) -> dict:
+        '''
+            Same as `HttpTransport.stats`: `reused` close to `requests` means connections are kept alive
+        '''
+        return {'requests': self.requests_count, 'connections': self.connections_count, 'reused': self.requests_count - self.connections_count}
+
+    def _sign(self, method, url, data=None, params=None):
+        # sign a `requests` prepared request, so signing matches the threaded transport exactly
+        prepared = requests.Request(method, url, data=data, params=params).prepare()
+        auth = self.get_auth()
+        prepared = auth(prepared) if auth else prepared
+        headers = {key: value for key, value in prepared.headers.items() if key.lower() != 'content-length'}
+        body = prepared.body.encode('utf-8') if isinstance(prepared.body, str) else prepared.body
+        return prepared.url, headers, body
+
+    async def _sign_async(self, method, url, data=None, params=None):
+        if data is not None and len(data) >= SIGN_OFF_LOOP_MIN_BYTES:
+            return await asyncio.get_running_loop().run_in_executor(None, self._sign, method, url, data, params)
+        return self._sign(method, url, data=data, params=params)
+
+    async def request(self, method, url, data=None, params=None) -> AsyncResponse:
+        '''
+            Sends a signed request, retrying connection errors with backoff like `Serverless.RETRIES_CONFIG`:
+            for methods not in `IDEMPOTENT_METHODS` (e.g. POST) only errors connecting, before anything was sent
+        '''
+        client = self._get_client()
+        retry_errors = (aiohttp.ClientConnectionError, asyncio.TimeoutError) if method in IDEMPOTENT_METHODS else (aiohttp.ClientConnectorError,)
+        start = time.perf_counter()
+        for attempt in range(ASYNC_MAX_ATTEMPTS):
+            # re-sign each attempt, the signature is only valid for a few minutes
+            signed_url, headers, body = await self._sign_async(method, url, data=data, params=params)
+            try:
+                # the url is already encoded and signed as-is, do not let aiohttp re-encode it
+                async with client.request(method, yarl.URL(signed_url, encoded=True), headers=headers, data=body) as res:
+                    text = await res.text()
+                    # including retries, like `requests.Response.elapsed` with `Serverless.RETRIES_CONFIG`
+                    return AsyncResponse(signed_url, res.status, res.reason, res.headers, text, datetime.timedelta(seconds=time.perf_counter() - start))
+            except retry_errors:
+                if attempt == ASYNC_MAX_ATTEMPTS - 1:
+                    raise
+                await asyncio.sleep(ASYNC_BACKOFF_FACTOR * 2 ** attempt)
+
+    def _get_loop(self):
+        self._check_fork()
+        with self.lock:
+            if self.loop is None:
+                self.loop = asyncio.new_event_loop()
+                threading.Thread(target=self.loop.run_forever, name='async-transport', daemon=True).start()
+        return self.loop
+
+    def submit(self, coroutine):
+        '''
+            Schedules `coroutine` on the background event loop, returns a `concurrent.futures.Future` of its result
+        '''
+        return asyncio.run_coroutine_threadsafe(coroutine, self._get_loop())
+
+    def run(self, coroutine):
+        '''
+            Runs `coroutine` on the background event loop and waits for its result
+        '''
+        return self.submit(coroutine).result()
+
+    def close(self):
+        if os.getpid() != self.pid or self.loop is None:
+            return
+        client = self.clients.pop(self.loop, None)
+        if client is not None and not client.closed:
+            asyncio.run_coroutine_threadsafe(client.close(), self.loop).result()
+
+    async def aclose(self):
+        '''
+            Closes the client of the running event loop, for async callers on their own loop
+        '''
+        client = self.clients.pop(asyncio.get_running_loop(), None)
+        if client is not None and not client.closed:
+            await client.close()
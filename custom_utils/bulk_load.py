@@ -0,0 +1,160 @@
+import re
+import datetime
+from decimal import Decimal
+from boto3.dynamodb.types import TypeSerializer
+
+from custom_utils.logger import Logger
+from custom_utils.relation_linkage import get_pk_or_rid, set_path
+from custom_utils.sls import SLS, BATCH_WRITE_DEFAULT_THREADS
+from custom_utils.traversal_plan import get_traversal_plan, get_path
+
+type_serializer = TypeSerializer()
+
+# item types `serialize_item` is checked to match the serverless controller for; others are POSTed through serverless
+BULK_LOAD_ITEM_TYPES = ('variant',)
+# objects POSTed through serverless to learn the fields the controller adds, two so per-item fields can be told from constant ones
+REFERENCE_COUNT = 2
+ISO_TIMESTAMP_REGEX = re.compile(r'^\d{4}-\d{2}-\d{2}T\d{2}:\d{2}:\d{2}(\.\d+)?(Z|[+-]\d{2}:\d{2})?$')
+
+def _to_dynamodb_value(value):
+    # boto3 only takes Decimal for numbers
+    if isinstance(value, float):
+        return Decimal(str(value))
+    if isinstance(value, dict):
+        return {key: _to_dynamodb_value(field_value) for key, field_value in value.items()}
+    if isinstance(value, list):
+        return [_to_dynamodb_value(item) for item in value]
+    return value
+
+def _to_reference(value):
+    # the controller stores related objects by their PK, not embedded
+    return get_pk_or_rid(value) if isinstance(value, dict) else value
+
+def _is_timestamp(value):
+    return isinstance(value, str) and bool(ISO_TIMESTAMP_REGEX.match(value))
+
+def _timestamp_like(sample, now):
+    '''
+        `now` formatted like the controller's `sample` timestamp: same fraction digits, and same `Z` or offset suffix
+    '''
+    fraction = re.search(r'\.(\d+)', sample)
+    formatted = now.strftime('%Y-%m-%dT%H:%M:%S')
+    if fraction:
+        formatted += '.' + f'{now.microsecond:06d}'[:len(fraction.group(1))].ljust(len(fraction.group(1)), '0')
+    if sample.endswith('Z'):
+        return formatted + 'Z'
+    offset = re.search(r'[+-]\d{2}:\d{2}$', sample)
+    return formatted + '+00:00' if offset else formatted
+
+class ControllerFields:
+    '''
+        The fields a serverless controller adds on create, learned from reference items by `check_against_reference()`:
+        `constant` fields have the same value on every item, `timestamp_samples` fields get the time each item is built,
+        formatted like the controller's sample value
+    '''
+    def __init__(self, constant, timestamp_samples):
+        self.constant = constant
+        self.timestamp_samples = timestamp_samples
+
+    def for_item(self):
+        now = datetime.datetime.now(datetime.timezone.utc)
+        return {**self.constant, **{field_name: _timestamp_like(sample, now) for field_name, sample in self.timestamp_samples.items()}}
+
+def build_item(parent, controller_fields=None):
+    '''
+        The item a serverless controller would put for `parent` on create, as boto3 resource values (numbers as Decimal):
+        empty fields removed the same way as `Serverless.post`, PK assigned the same way the existence check looks it up,
+        and relational fields (per the serverless `ModelSerializer` schema) holding embedded objects replaced by their PK.
+        :param ControllerFields controller_fields: fields the controller adds on create, see `check_against_reference()`
+    '''
+    item_type = parent['item_type']
+    if item_type not in BULK_LOAD_ITEM_TYPES:
+        raise Exception(f'BulkLoadError: {item_type} cannot be bulk loaded, only {BULK_LOAD_ITEM_TYPES} are checked to match the serverless controller')
+
+    # `remove_empty_fields` may return `parent` itself
+    item = {**(controller_fields.for_item() if controller_fields else {}), **SLS.remove_empty_fields(parent)}
+    item['PK'] = get_pk_or_rid(item)
+
+    for relation in get_traversal_plan(item_type, with_extra_relations=False):
+        value = get_path(item, relation.path)
+        if value is None:
+            continue
+        if relation.is_plural and isinstance(value, list):
+            value = [_to_reference(related) for related in value]
+        else:
+            value = _to_reference(value)
+        # nested dicts are shallow copied along the path, they may be shared with `parent`
+        set_path(item, relation.path, value)
+
+    return _to_dynamodb_value(item)
+
+def serialize_item(parent, controller_fields=None):
+    '''
+        `build_item()` in DynamoDB attribute value format, as `BatchWriteItem` takes it
+    '''
+    return {key: type_serializer.serialize(value) for key, value in build_item(parent, controller_fields).items()}
+
+def check_against_reference(reference_parents, dynamodb) -> ControllerFields:
+    '''
+        POSTs `reference_parents` (`REFERENCE_COUNT` objects) through serverless, reads the items the controller stored back
+        from the table of `dynamodb` and compares each with `build_item()` of the same object, so bulk loaded items are checked
+        against real ones. Raises if a field is stored differently or not at all.
+
+        Of the fields only the controller adds, those with the same value on every reference are constant, and ISO timestamps
+        are made afresh for each item; raises on any other field, which would need a per-item value only the controller knows.
+    '''
+    stored_items = []
+    for reference_parent in reference_parents:
+        SLS.post(reference_parent)
+        stored_item = dynamodb.get(reference_parent)
+        if stored_item is None:
+            raise Exception(f'BulkLoadError: reference {reference_parent["item_type"]} {get_pk_or_rid(reference_parent)} is not found in table {dynamodb.table_name} after POST')
+
+        expected_item = build_item(reference_parent)
+        mismatched_fields = [field_name for field_name, value in expected_item.items() if stored_item.get(field_name) != value]
+        if mismatched_fields:
+            raise Exception(f'BulkLoadError: fields {mismatched_fields} of reference {reference_parent["item_type"]} {expected_item["PK"]} are not stored as serialized, POST through serverless instead')
+        stored_items.append({field_name: value for field_name, value in stored_item.items() if field_name not in expected_item})
+
+    constant, timestamp_samples, per_item_fields = {}, {}, []
+    for field_name in set().union(*stored_items):
+        values = [added_fields.get(field_name) for added_fields in stored_items]
+        if all(_is_timestamp(value) for value in values):
+            timestamp_samples[field_name] = values[0]
+        elif all(field_name in added_fields and value == values[0] for added_fields, value in zip(stored_items, values)):
+            constant[field_name] = values[0]
+        else:
+            per_item_fields.append(field_name)
+    if per_item_fields:
+        raise Exception(f'BulkLoadError: the controller adds fields {sorted(per_item_fields)} that differ per item and cannot be made here, POST through serverless instead')
+
+    Logger.info(f'{len(reference_parents)} reference items match, adding constant fields {sorted(constant)} and fresh timestamps {sorted(timestamp_samples)} the controller adds')
+    return ControllerFields(constant, timestamp_samples)
+
+def bulk_load(parents, controller_fields, dynamodb, threads=BATCH_WRITE_DEFAULT_THREADS, verify=True) -> int:
+    '''
+        Writes `parents` straight into the DynamoDB table by `BatchWriteItem`, bypassing serverless, for bulk item types like variant.
+        Objects with the same PK are written once (the last one wins), as a batch may not have the same key twice.
+        If `verify`, checks every object is in the table afterwards, and raises if some are not.
+        :param ControllerFields controller_fields: as returned by `check_against_reference()`
+        :param DynamoDB dynamodb: the table written and verified, e.g. `custom_utils.sls.DYNAMODB`
+        Returns the number of objects written.
+    '''
+    dynamodb_items_by_pk = {}
+    for parent in parents:
+        dynamodb_item = serialize_item(parent, controller_fields)
+        dynamodb_items_by_pk[dynamodb_item['PK']['S']] = (parent, dynamodb_item)
+    if not dynamodb_items_by_pk:
+        return 0
+
+    written_count = dynamodb.batch_put((dynamodb_item for _, dynamodb_item in dynamodb_items_by_pk.values()), threads=threads)
+    Logger.info(f'BatchWriteItem wrote {written_count} items')
+
+    if verify:
+        loaded_parents = [parent for parent, _ in dynamodb_items_by_pk.values()]
+        missing_count = dynamodb.batch_exists(loaded_parents).count(False)
+        if missing_count:
+            raise Exception(f'BulkLoadError: {missing_count} of {len(loaded_parents)} written items are not found in table {dynamodb.table_name}')
+        Logger.info(f'verified all {len(loaded_parents)} written items are in table {dynamodb.table_name}')
+
+    return written_count
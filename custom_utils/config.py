@@ -2,6 +2,11 @@ import yaml
 import os
 
 THIS_FILE_DIR = os.path.dirname(os.path.realpath(__file__))
+CONFIG_FILENAME = f'{THIS_FILE_DIR}/../config_recent.yaml'
 
-with open(f'{THIS_FILE_DIR}/../config_recent.yaml', 'r') as stream:
-    config_data = yaml.load(stream, Loader=yaml.FullLoader)
\ No newline at end of file
+# scripts like `migrate_all_gcivci.py` take their own config file,
+# so do not fail on import when the default one is absent
+config_data = {}
+if os.path.exists(CONFIG_FILENAME):
+    with open(CONFIG_FILENAME, 'r') as stream:
+        config_data = yaml.load(stream, Loader=yaml.FullLoader)
@@ -0,0 +1,116 @@
+import json
+import hashlib
+
+# objects of these item types embed copies of other objects, e.g. snapshot.resourceParent.gdm and its annotations
+INTERNED_ITEM_TYPES = ('snapshot',)
+
+def is_embedded_object(value):
+    # `generic_transformation` stamps `item_type` onto every object embedded in a snapshot
+    return isinstance(value, dict) and 'item_type' in value and '$ref' not in value
+
+def is_ref(value):
+    return isinstance(value, dict) and len(value) == 1 and '$ref' in value
+
+class SubtreeInterner:
+    '''
+        Deduplicates embedded objects by content hash, so identical copies embedded in many objects
+        (e.g. the same annotation in every snapshot of a gdm) are held once, as the same dict instance.
+
+        Hashes are computed bottom-up over the "stored form" of an object, where each embedded object
+        is replaced by `{"$ref": hash}`, so each subtree is hashed once no matter how deep it is nested.
+        The stored form is also what the object store writes to disk.
+
+        Interned objects are shared: copy the path to a field before changing it, never change them in place.
+    '''
+    def __init__(self):
+        # hash -> the shared object
+        self.objects = {}
+        # hash -> stored form
+        self.stored = {}
+        # hash -> hashes of the embedded objects it refers to directly
+        self.refs = {}
+        # id(shared object) -> hash, so interning an already interned object is a lookup; shared objects are kept alive by `objects`
+        self.hash_by_id = {}
+
+    def intern(self, obj):
+        '''
+            Returns `(interned, stored_form, refs)`: a copy of `obj` sharing embedded objects with those interned before,
+            its stored form, and the hashes of embedded objects the stored form refers to directly.
+            `obj` itself is left as-is.
+        '''
+        return self._intern(obj, root=True)
+
+    def _intern(self, value, root=False):
+        if id(value) in self.hash_by_id:
+            content_hash = self.hash_by_id[id(value)]
+            return value, {'$ref': content_hash}, {content_hash}
+
+        if isinstance(value, dict):
+            interned, stored, refs = {}, {}, set()
+            for key, field_value in value.items():
+                interned[key], stored[key], field_refs = self._intern(field_value)
+                refs.update(field_refs)
+            if root or not is_embedded_object(value):
+                return interned, stored, refs
+
+            content_hash = hashlib.sha1(json.dumps(stored, sort_keys=True, separators=(',', ':')).encode('utf-8')).hexdigest()
+            if content_hash not in self.objects:
+                self._register(content_hash, interned, stored, refs)
+            return self.objects[content_hash], {'$ref': content_hash}, {content_hash}
+
+        if isinstance(value, list):
+            interned, stored, refs = [], [], set()
+            for item in value:
+                interned_item, stored_item, item_refs = self._intern(item)
+                interned.append(interned_item)
+                stored.append(stored_item)
+                refs.update(item_refs)
+            return interned, stored, refs
+
+        return value, value, set()
+
+    def _register(self, content_hash, interned, stored, refs):
+        self.objects[content_hash] = interned
+        self.stored[content_hash] = stored
+        self.refs[content_hash] = refs
+        self.hash_by_id[id(interned)] = content_hash
+
+    def closure(self, refs, known):
+        '''
+            Returns hashes in `refs` and whatever they refer to, stopping at hashes in `known` (e.g. already on disk)
+        '''
+        found = set()
+        stack = [content_hash for content_hash in refs if content_hash not in known]
+        while stack:
+            content_hash = stack.pop()
+            if content_hash in found:
+                continue
+            found.add(content_hash)
+            stack.extend(ref for ref in self.refs.get(content_hash, ()) if ref not in known)
+        return found
+
+    def expand(self, stored, load_stored):
+        '''
+            Returns the object of a stored form, sharing embedded objects with those interned before.
+            `load_stored(hash)` returns the stored form of an embedded object not interned yet.
+        '''
+        if is_ref(stored):
+            content_hash = stored['$ref']
+            if content_hash not in self.objects:
+                subtree_stored = load_stored(content_hash)
+                self._register(content_hash, self.expand(subtree_stored, load_stored), subtree_stored, self.direct_refs(subtree_stored))
+            return self.objects[content_hash]
+        if isinstance(stored, dict):
+            return {key: self.expand(value, load_stored) for key, value in stored.items()}
+        if isinstance(stored, list):
+            return [self.expand(value, load_stored) for value in stored]
+        return stored
+
+    def direct_refs(self, stored):
+        if is_ref(stored):
+            return {stored['$ref']}
+        values = stored.values() if isinstance(stored, dict) else stored if isinstance(stored, list) else ()
+        refs = set()
+        for value in values:
+            refs.update(self.direct_refs(value))
+        return refs
@@ -0,0 +1,158 @@
+import os
+import json
+import pathlib
+import sqlite3
+import threading
+from time import perf_counter
+from custom_utils.config import config_data
+from custom_utils.logger import Logger
+from custom_utils.sql import stream_fetch, paginate_keyset, number_keyset_rows, DEFAULT_PAGE_SIZE, SOURCE_RELATION
+
+THIS_FILE_DIR = os.path.dirname(os.path.realpath(__file__))
+DEFAULT_LOCAL_SNAPSHOT_FILENAME = f'{THIS_FILE_DIR}/../.data/migrate_recent_items.sqlite3'
+
+EXPORT_BATCH_SIZE = 2000
+
+class LocalSnapshot:
+    '''
+        A local copy of `migrate_recent_items` in a sqlite file, indexed by (item_type, rid),
+        so fetching does not need postgres to rebuild the view for every query.
+
+        Items are kept as the same `{"body": ...}` json as the view's `item` column.
+    '''
+    def __init__(self, path=DEFAULT_LOCAL_SNAPSHOT_FILENAME):
+        self.filepath = pathlib.Path(path)
+        # sqlite connections cannot be shared across threads nor forked processes,
+        # so each thread opens its own, keyed by pid like `custom_utils.sql.get_pool`
+        self.local = threading.local()
+
+    def _connection(self):
+        if not hasattr(self.local, 'connections'):
+            self.local.connections = {}
+        connection = self.local.connections.get(os.getpid())
+        if connection is None:
+            if not self.filepath.exists():
+                raise Exception(f'LocalSnapshotError: {self.filepath.absolute()} does not exist, run `python export_local_snapshot.py` first')
+            # read-only, so any number of migration processes can read the same file
+            connection = sqlite3.connect(f'file:{self.filepath.absolute()}?mode=ro', uri=True)
+            self.local.connections[os.getpid()] = connection
+        return connection
+
+    def export(self, pg_connection, batch_size=EXPORT_BATCH_SIZE):
+        '''
+            Dumps the whole `migrate_recent_items` view from postgres into the sqlite file.
+            Writes to a temporary file first, so readers never see a partial snapshot.
+        '''
+        start_time = perf_counter()
+        temp_filepath = self.filepath.with_suffix('.exporting')
+        if temp_filepath.exists():
+            os.remove(temp_filepath.absolute())
+        self.filepath.parent.mkdir(parents=True, exist_ok=True)
+
+        connection = sqlite3.connect(temp_filepath.absolute())
+        connection.execute('''
+            CREATE TABLE items (
+                item_type TEXT NOT NULL,
+                rid TEXT NOT NULL,
+                sid INTEGER NOT NULL,
+                item TEXT NOT NULL,
+                PRIMARY KEY (item_type, rid)
+            ) WITHOUT ROWID
+        ''')
+
+        # `item::text` so the json is stored as-is, without decoding and encoding it again on our side
+        sql_query = f'''
+            SELECT item_type, rid::text, sid, item::text
+            FROM {SOURCE_RELATION}
+            ORDER BY item_type, rid
+        '''
+        exported_count = 0
+        batch = []
+        for row in stream_fetch(pg_connection, sql_query, (), itersize=batch_size):
+            batch.append(row)
+            if len(batch) >= batch_size:
+                connection.executemany('INSERT INTO items VALUES (?, ?, ?, ?)', batch)
+                exported_count += len(batch)
+                batch = []
+                Logger.info(f'exported {exported_count} items...')
+        if batch:
+            connection.executemany('INSERT INTO items VALUES (?, ?, ?, ?)', batch)
+            exported_count += len(batch)
+
+        # for keyset pagination on (rid, sid) within an item_type
+        connection.execute('CREATE INDEX items_item_type_rid_sid ON items (item_type, rid, sid)')
+        connection.commit()
+        connection.close()
+
+        os.replace(temp_filepath.absolute(), self.filepath.absolute())
+        Logger.info(f'exported {exported_count} items to {self.filepath.absolute()} in {round(perf_counter() - start_time, 1)}s')
+        return exported_count
+
+    def fetch_by_rids(self, item_type, rids):
+        '''
+            Same as `sql_fetchall_by_rids`, returns a dict of rid -> (object, sid)
+        '''
+        rids = list(rids)
+        objects_by_rid = {}
+        # stay under sqlite's limit of host parameters per statement
+        for index in range(0, len(rids), 500):
+            rids_chunk = rids[index:index + 500]
+            rows = self._connection().execute(
+                f'SELECT rid, sid, item FROM items WHERE item_type=? AND rid IN ({",".join("?" * len(rids_chunk))})',
+                (item_type, *rids_chunk)
+            ).fetchall()
+            for rid, sid, item in rows:
+                objects_by_rid[rid] = (json.loads(item)['body'], sid)
+        return objects_by_rid
+
+    def fetch_sids(self, item_type, rids):
+        '''
+            Returns a dict of rid -> current sid, for the rids of `item_type` that still exist
+        '''
+        rids = list(rids)
+        sids = {}
+        for index in range(0, len(rids), 500):
+            rids_chunk = rids[index:index + 500]
+            rows = self._connection().execute(
+                f'SELECT rid, sid FROM items WHERE item_type=? AND rid IN ({",".join("?" * len(rids_chunk))})',
+                (item_type, *rids_chunk)
+            ).fetchall()
+            sids.update(rows)
+        return sids
+
+    def count(self, item_type):
+        return self._connection().execute('SELECT COUNT(*) FROM items WHERE item_type=?', (item_type,)).fetchone()[0]
+
+    def iter_keyset_pages(self, item_type, start=1, end=None, after=None, page_size=DEFAULT_PAGE_SIZE):
+        '''
+            Same as `custom_utils.sql.iter_keyset_pages` over `KEYSET_ITEMS_QUERY`,
+            yields `(rows, after)` pages of `(item_type, item, rid, sid)` rows
+        '''
+        def fetch_page(after, offset, limit):
+            rows = self._connection().execute('''
+                SELECT item_type, item, rid, sid FROM items
+                WHERE item_type=? AND (rid, sid) > (?, ?)
+                ORDER BY rid, sid
+                LIMIT ? OFFSET ?
+            ''', (item_type, *after, limit, offset)).fetchall()
+            return [(row_item_type, json.loads(item), rid, sid) for row_item_type, item, rid, sid in rows]
+
+        return paginate_keyset(fetch_page, start=start, end=end, after=after, page_size=page_size)
+
+    def iter_keyset_rows(self, item_type, start=1, end=None, after=None, page_size=DEFAULT_PAGE_SIZE):
+        '''
+            Same as `custom_utils.sql.iter_keyset_rows`, yields `(item_type, rownum, item)` rows
+        '''
+        return number_keyset_rows(self.iter_keyset_pages(item_type, start=start, end=end, after=after, page_size=page_size), start=start)
+
+def get_local_snapshot(config=None):
+    '''
+        The local snapshot configured by `local_snapshot.path`, or None if fetching should go to postgres
+    '''
+    config = config or config_data
+    local_snapshot_config = config.get('local_snapshot')
+    if not local_snapshot_config:
+        return None
+    return LocalSnapshot(local_snapshot_config.get('path', DEFAULT_LOCAL_SNAPSHOT_FILENAME))
+
+LOCAL_SNAPSHOT = get_local_snapshot()
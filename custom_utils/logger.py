@@ -12,6 +12,12 @@ class _Logger:
     LOG_LEVEL = LOG_VALUES['DEBUG']
 
     DEFAULT_MSG_TRUNCATE = 1000
+
+    def is_enabled(self, level):
+        '''
+            Lets callers skip building costly messages, e.g. `if Logger.is_enabled('DEBUG'): Logger.debug(f'...')`
+        '''
+        return self.LOG_LEVEL >= self.LOG_VALUES[level]
     
     def debug(self, msg):
         print(f'🐛 DEBUG: {msg[:self.DEFAULT_MSG_TRUNCATE]}...') if self.LOG_LEVEL >= self.LOG_VALUES['DEBUG'] else None
@@ -43,4 +49,18 @@ class Estimate:
         eta_remaining_seconds = eta_total_seconds - elapsed_seconds
         eta_time_delta = timedelta(seconds=eta_remaining_seconds)
         
-        return progress_percent, eta_time_delta
\ No newline at end of file
+        return progress_percent, eta_time_delta
+class Progress:
+    '''
+        Formats `done/total(percent%) ETA ...` for progress logs, or just `done` when the total is not known,
+        e.g. when the items come from a generator
+    '''
+    def __init__(self, items):
+        self.total = len(items) if hasattr(items, '__len__') else None
+        self.estimate = Estimate()
+
+    def format(self, done: int) -> str:
+        if not self.total:
+            return f'{done}'
+        progress, eta = self.estimate.get(done, self.total)
+        return f'{done}/{self.total}({progress}%) ETA {eta}'
@@ -0,0 +1,176 @@
+import os
+import json
+import pathlib
+import sqlite3
+import hashlib
+import threading
+import time
+from custom_utils.config import config_data
+from custom_utils.logger import Logger
+
+THIS_FILE_DIR = os.path.dirname(os.path.realpath(__file__))
+DEFAULT_OBJECT_CACHE_FILENAME = f'{THIS_FILE_DIR}/../.data/shared_object_cache.sqlite3'
+DEFAULT_OBJECT_CACHE_MAX_BYTES = 2 * 1024 ** 3
+
+# seconds a process waits on another process holding the write lock
+SQLITE_BUSY_TIMEOUT_SECONDS = 60
+SQLITE_MAX_PARAMS = 500
+# `last_access` is only written again once older than this, so most reads need no write transaction;
+# eviction order is accurate to this many seconds
+LAST_ACCESS_RESOLUTION_SECONDS = 3600
+# least recently used objects read per eviction query
+EVICT_BATCH_SIZE = 200
+
+class SharedObjectCache:
+    '''
+        Objects fetched from postgres, shared by every gdm migration and safe to use from concurrent processes.
+
+        Objects are stored once by content hash, and looked up by (item_type, rid) along with the `sid` they were fetched at,
+        so shared entities like users, genes or articles are fetched once no matter how many gdms refer to them.
+        Least recently used objects are evicted once the cache grows over `max_bytes`.
+    '''
+    def __init__(self, path=DEFAULT_OBJECT_CACHE_FILENAME, max_bytes=DEFAULT_OBJECT_CACHE_MAX_BYTES):
+        self.filepath = pathlib.Path(path)
+        self.max_bytes = max_bytes
+        # sqlite connections cannot be shared across threads nor forked processes
+        self.local = threading.local()
+
+    def _connection(self):
+        if getattr(self.local, 'pid', None) != os.getpid():
+            self.filepath.parent.mkdir(parents=True, exist_ok=True)
+            connection = sqlite3.connect(self.filepath.absolute(), timeout=SQLITE_BUSY_TIMEOUT_SECONDS)
+            # WAL lets readers proceed while another process writes
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.executescript('''
+                BEGIN IMMEDIATE;
+                CREATE TABLE IF NOT EXISTS objects (
+                    content_hash TEXT PRIMARY KEY,
+                    body TEXT NOT NULL,
+                    size INTEGER NOT NULL,
+                    last_access REAL NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS objects_last_access ON objects (last_access);
+                CREATE TABLE IF NOT EXISTS object_keys (
+                    item_type TEXT NOT NULL,
+                    rid TEXT NOT NULL,
+                    content_hash TEXT NOT NULL,
+                    sid INTEGER,
+                    PRIMARY KEY (item_type, rid)
+                ) WITHOUT ROWID;
+                CREATE INDEX IF NOT EXISTS object_keys_content_hash ON object_keys (content_hash);
+                -- running total of objects.size, kept by triggers so it is right for every process writing the cache
+                CREATE TABLE IF NOT EXISTS stats (
+                    name TEXT PRIMARY KEY,
+                    value INTEGER NOT NULL
+                ) WITHOUT ROWID;
+                CREATE TRIGGER IF NOT EXISTS objects_insert_size AFTER INSERT ON objects BEGIN
+                    UPDATE stats SET value = value + NEW.size WHERE name = 'total_bytes';
+                END;
+                CREATE TRIGGER IF NOT EXISTS objects_delete_size AFTER DELETE ON objects BEGIN
+                    UPDATE stats SET value = value - OLD.size WHERE name = 'total_bytes';
+                END;
+                -- after the triggers, so objects inserted meanwhile are counted by one or the other
+                INSERT OR IGNORE INTO stats SELECT 'total_bytes', COALESCE(SUM(size), 0) FROM objects;
+                COMMIT;
+            ''')
+            # cache files created before sids were recorded
+            if 'sid' not in [column[1] for column in connection.execute('PRAGMA table_info(object_keys)')]:
+                connection.execute('ALTER TABLE object_keys ADD COLUMN sid INTEGER')
+            self.local.connection = connection
+            self.local.pid = os.getpid()
+        return self.local.connection
+
+    def get_many(self, item_type, rids):
+        '''
+            Returns a dict of rid -> (object, sid) for the rids in cache
+        '''
+        connection = self._connection()
+        rids = list(rids)
+        objects_by_rid = {}
+        # content hashes last accessed too long ago
+        stale_content_hashes = set()
+        now = time.time()
+        for index in range(0, len(rids), SQLITE_MAX_PARAMS):
+            rids_chunk = rids[index:index + SQLITE_MAX_PARAMS]
+            rows = connection.execute(f'''
+                SELECT k.rid, k.sid, o.content_hash, o.body, o.last_access FROM object_keys k
+                JOIN objects o ON o.content_hash = k.content_hash
+                WHERE k.item_type=? AND k.rid IN ({",".join("?" * len(rids_chunk))})
+            ''', (item_type, *rids_chunk)).fetchall()
+            for rid, sid, content_hash, body, last_access in rows:
+                objects_by_rid[rid] = (json.loads(body), sid)
+                if now - last_access > LAST_ACCESS_RESOLUTION_SECONDS:
+                    stale_content_hashes.add(content_hash)
+
+        if stale_content_hashes:
+            with connection:
+                connection.executemany('UPDATE objects SET last_access=? WHERE content_hash=?',
+                    [(now, content_hash) for content_hash in stale_content_hashes])
+        return objects_by_rid
+
+    def put_many(self, item_type, objects_by_rid):
+        '''
+        :param dict objects_by_rid: rid -> (object, sid)
+        '''
+        connection = self._connection()
+        now = time.time()
+        object_rows = {}
+        key_rows = []
+        for rid, (parent, sid) in objects_by_rid.items():
+            body = json.dumps(parent, sort_keys=True, separators=(',', ':'))
+            content_hash = hashlib.sha1(body.encode('utf-8')).hexdigest()
+            object_rows[content_hash] = (content_hash, body, len(body), now)
+            key_rows.append((item_type, rid, content_hash, sid))
+
+        with connection:
+            connection.executemany('INSERT OR IGNORE INTO objects VALUES (?, ?, ?, ?)', object_rows.values())
+            connection.executemany('INSERT OR REPLACE INTO object_keys (item_type, rid, content_hash, sid) VALUES (?, ?, ?, ?)', key_rows)
+        self._evict()
+
+    def invalidate(self, item_type, rids):
+        '''
+            Forgets the cached objects of `rids`, e.g. because they changed at source.
+            Their bodies stay until evicted, other keys may share them.
+        '''
+        connection = self._connection()
+        with connection:
+            connection.executemany('DELETE FROM object_keys WHERE item_type=? AND rid=?', [(item_type, rid) for rid in rids])
+
+    def _evict(self):
+        connection = self._connection()
+        total_bytes = connection.execute("SELECT value FROM stats WHERE name='total_bytes'").fetchone()[0]
+        if total_bytes <= self.max_bytes:
+            return
+
+        evicted_count = 0
+        with connection:
+            while total_bytes > self.max_bytes:
+                rows = connection.execute('SELECT content_hash, size FROM objects ORDER BY last_access LIMIT ?', (EVICT_BATCH_SIZE,)).fetchall()
+                if not rows:
+                    break
+                evicted_hashes = []
+                for content_hash, size in rows:
+                    if total_bytes <= self.max_bytes:
+                        break
+                    evicted_hashes.append((content_hash,))
+                    total_bytes -= size
+                connection.executemany('DELETE FROM object_keys WHERE content_hash=?', evicted_hashes)
+                connection.executemany('DELETE FROM objects WHERE content_hash=?', evicted_hashes)
+                evicted_count += len(evicted_hashes)
+        Logger.info(f'evicted {evicted_count} least recently used objects from shared object cache')
+
+def get_shared_object_cache(config=None):
+    '''
+        The shared object cache configured by `object_cache` in config, on by default.
+        Returns None if disabled by `object_cache: {enabled: false}`
+    '''
+    config = config or config_data
+    object_cache_config = config.get('object_cache') or {}
+    if not object_cache_config.get('enabled', True):
+        return None
+    return SharedObjectCache(
+        path=object_cache_config.get('path', DEFAULT_OBJECT_CACHE_FILENAME),
+        max_bytes=object_cache_config.get('max_bytes', DEFAULT_OBJECT_CACHE_MAX_BYTES)
+    )
+
+SHARED_OBJECT_CACHE = get_shared_object_cache()
@@ -1,79 +1,451 @@
 import os
 import pathlib
 import json
-import traceback
-from custom_utils.relation_linkage import LINKAGE_TRANSFORM
+import hashlib
+import heapq
+import collections
+from custom_utils.relation_linkage import LINKAGE_TRANSFORM, is_snapshot
+from custom_utils.traversal_plan import get_traversal_plan, get_path
 from custom_utils.logger import Logger
+from custom_utils.serialization import RecordFile
+from custom_utils.interning import SubtreeInterner, INTERNED_ITEM_TYPES
 
 THIS_FILE_DIR = os.path.dirname(os.path.realpath(__file__))
 
+# save automatically after this many changed objects, so a crash mid-collection loses at most these
+AUTOSAVE_EVERY = 50
+# compact the log once stale records take more than half of it, and it is worth rewriting
+COMPACT_MIN_BYTES = 1024 ** 2
+
+def get_references(parent):
+    '''
+        Returns the [related_item_type, related rid or PK] `parent` refers to, read by its traversal plan
+        the same way collection visits it, including links already transformed to PKs (e.g. article pmid)
+    '''
+    references = []
+    for relation in get_traversal_plan(parent['item_type']):
+        value = get_path(parent, relation.path)
+        if not relation.is_plural:
+            if value and isinstance(value, str):
+                references.append([relation.related_item_type, value])
+            continue
+        if not value or not isinstance(value, list):
+            continue
+        for related in value:
+            if isinstance(related, str):
+                references.append([relation.related_item_type, related])
+            elif isinstance(related, dict) and is_snapshot(related):
+                references.append([relation.related_item_type, related.get('uuid')])
+    return references
+
 class ObjectStoreManager:
+    '''
+        Objects related to a gdm, persisted as an append-only log `.data/gdm_related_objects_{gdm_rid}.records`,
+        a `RecordFile` encoded by the configured cache serializer.
+
+        Each record's key is a header json with the object's item_type, rid, PK, content hash,
+        the `sid` (propsheet version) it was fetched at and the `links` it refers to (see `get_references`),
+        or `deleted` for an object removed by `remove()`. Posting order is planned from the headers alone.
+        Opening the store only reads the headers to index each object's latest record by offset,
+        objects are decoded lazily on `get()`. `save()` only appends objects whose content or sid changed.
+
+        Objects of `INTERNED_ITEM_TYPES` share identical embedded objects through a `SubtreeInterner`, in memory and on disk:
+        their records refer to embedded objects by `{"$ref": hash}`, and each embedded object is written once
+        as a record keyed by `{"subtree": hash, "refs": [...]}`.
+    '''
     def __init__(self, gdm_rid):
-        self.filename = f'{THIS_FILE_DIR}/../.data/gdm_related_objects_{gdm_rid}.json'
-        self.filepath = pathlib.Path(self.filename)
-        if self.filepath.exists():
-            with self.filepath.open('r') as f:
-                self.store = json.load(f)
-                return
-        
-        self.store = {}
-    
+        self.legacy_filepaths = [
+            pathlib.Path(f'{THIS_FILE_DIR}/../.data/gdm_related_objects_{gdm_rid}.jsonl'),
+            pathlib.Path(f'{THIS_FILE_DIR}/../.data/gdm_related_objects_{gdm_rid}.json')
+        ]
+        self.filepath = pathlib.Path(f'{THIS_FILE_DIR}/../.data/gdm_related_objects_{gdm_rid}.records')
+
+        # item_type -> {'byPK': {pk: rid}, 'byRid': {rid: (offset, length, content_hash, sid, refs, links) or None if never saved}},
+        # `links` is None for records saved before links were
+        self.index = {}
+        # subtree hash -> (offset, length, refs)
+        self.subtree_index = {}
+        self.interner = SubtreeInterner()
+        # (item_type, rid) -> object, for objects decoded or inserted in this session
+        self.loaded = {}
+        # (item_type, rid) inserted since last save
+        self.dirty = {}
+        # (item_type, rid) -> sid given on insert since last save
+        self.sids = {}
+        # (item_type, rid) removed since last save
+        self.removed = set()
+        self.live_bytes = 0
+        self.log_bytes = 0
+
+        self._read_index()
+        if not self.filepath.exists():
+            for legacy_filepath in self.legacy_filepaths:
+                if legacy_filepath.exists():
+                    self._import_legacy_file(legacy_filepath)
+                    break
+
+    def _read_index(self):
+        self.record_file = RecordFile(self.filepath, on_record=lambda key, offset, length: self._index_record(json.loads(key), offset, length))
+        self.log_bytes = self.record_file.size
+
+    def _import_legacy_file(self, legacy_filepath):
+        Logger.info(f'importing legacy object store {legacy_filepath}')
+        with legacy_filepath.open('r') as f:
+            if legacy_filepath.suffix == '.jsonl':
+                # `{header json}\t{object json}` lines, the latest line of an object wins
+                for line in f:
+                    if not line.endswith('\n'):
+                        break
+                    header_json, object_json = line.split('\t', 1)
+                    header = json.loads(header_json)
+                    if header.get('deleted'):
+                        self.remove(header['item_type'], header['rid'])
+                    else:
+                        self.insert(json.loads(object_json), sid=header.get('sid'))
+            else:
+                legacy_store = json.load(f)
+                for item_type in legacy_store:
+                    for parent in legacy_store[item_type]['byRid'].values():
+                        self.insert(parent)
+        self.save()
+
+    def _index_record(self, header, offset, length):
+        if 'subtree' in header:
+            if header['subtree'] not in self.subtree_index:
+                self.subtree_index[header['subtree']] = (offset, length, header['refs'])
+                self.live_bytes += length
+            return
+
+        item_type_index = self.index.setdefault(header['item_type'], {'byPK': {}, 'byRid': {}})
+        previous = item_type_index['byRid'].get(header['rid'])
+        if previous:
+            self.live_bytes -= previous[1]
+        if header.get('deleted'):
+            item_type_index['byRid'].pop(header['rid'], None)
+            self._unindex_pks(item_type_index, header['rid'])
+            return
+        item_type_index['byRid'][header['rid']] = (offset, length, header['hash'], header.get('sid'), header.get('refs', []), header.get('links'))
+        self.live_bytes += length
+        if header.get('PK') is not None:
+            item_type_index['byPK'][header['PK']] = header['rid']
+
+    def _unindex_pks(self, item_type_index, rid):
+        for pk in [pk for pk, pk_rid in item_type_index['byPK'].items() if pk_rid == rid]:
+            del item_type_index['byPK'][pk]
+
+    def _get_rid(self, parent):
+        # snapshot has no `rid`, only uuid or the newly assigned PK
+        if 'rid' in parent:
+            return parent['rid']
+        if parent['item_type'] == 'snapshot':
+            return parent['uuid']
+        Logger.error(f'Error while inserting into object store, parent = {parent}')
+        raise KeyError('rid')
+
+    def _resolve_rid(self, item_type, rid_or_pk):
+        item_type_index = self.index[item_type]
+        if rid_or_pk in item_type_index['byPK']:
+            return item_type_index['byPK'][rid_or_pk]
+        if rid_or_pk in item_type_index['byRid']:
+            return rid_or_pk
+        raise KeyError(rid_or_pk)
+
     def save(self):
-        with self.filepath.open('w') as f:
-            json.dump(self.store, f, indent=2)
+        if not self.dirty and not self.removed:
+            return
+
+        serializer = self.record_file.serializer
+        records = []
+        headers = []
+        for item_type, rid in self.removed:
+            records.append((json.dumps({'item_type': item_type, 'rid': rid, 'deleted': True}), serializer.dumps(None)))
+
+        # subtree hash -> True, for embedded objects appended in this save
+        pending_subtrees = {}
+        for item_type, rid in self.dirty:
+            parent = self.loaded[(item_type, rid)]
+            links = get_references(parent)
+            refs = set()
+            if item_type in INTERNED_ITEM_TYPES:
+                _, parent, refs = self.interner.intern(parent)
+            # hash before compression, which may not be deterministic
+            object_bytes = serializer.codec.dumps(parent)
+            content_hash = hashlib.sha1(object_bytes).hexdigest()
+            saved_record = self.index[item_type]['byRid'].get(rid)
+            sid = self.sids.get((item_type, rid), saved_record[3] if saved_record else None)
+            # unchanged since it was last saved, and saved with its links
+            if saved_record and saved_record[2] == content_hash and saved_record[3] == sid and saved_record[5] is not None:
+                continue
+
+            header = {
+                'item_type': item_type,
+                'rid': rid,
+                'PK': parent.get(LINKAGE_TRANSFORM[item_type]) if item_type in LINKAGE_TRANSFORM else None,
+                'hash': content_hash,
+                'sid': sid,
+                'refs': sorted(refs),
+                'links': links
+            }
+            # embedded objects not on disk yet go before the record referring to them
+            for subtree_hash in self.interner.closure(refs, collections.ChainMap(self.subtree_index, pending_subtrees)):
+                subtree_header = {'subtree': subtree_hash, 'refs': sorted(self.interner.refs[subtree_hash])}
+                headers.append(subtree_header)
+                records.append((json.dumps(subtree_header), serializer.dumps(self.interner.stored[subtree_hash])))
+                pending_subtrees[subtree_hash] = True
+            headers.append(header)
+            records.append((json.dumps(header), serializer.compression.compress(object_bytes)))
+
+        positions = self.record_file.append(records, fsync=True)
+        # tombstones come first, and are already unindexed by `remove()`
+        for header, (offset, length) in zip(headers, positions[len(self.removed):]):
+            self._index_record(header, offset, length)
+        self.log_bytes = self.record_file.size
+        Logger.debug(f'object store appended {len(headers) - len(pending_subtrees)} changed objects, {len(pending_subtrees)} embedded objects and {len(self.removed)} removed objects to {self.filepath}')
+        self.dirty = {}
+        self.sids = {}
+        self.removed = set()
+
+        if self.log_bytes > COMPACT_MIN_BYTES and self.live_bytes * 2 < self.log_bytes:
+            self.compact()
+
+    def compact(self):
+        '''
+            Rewrites the log with only the latest record of each object, and the embedded objects they still refer to
+        '''
+        records = []
+        written_subtrees = set()
+        def append_subtrees(refs):
+            # referred embedded objects first, in the same order `save()` writes them
+            for subtree_hash in refs:
+                if subtree_hash in written_subtrees:
+                    continue
+                written_subtrees.add(subtree_hash)
+                offset, length, subtree_refs = self.subtree_index[subtree_hash]
+                append_subtrees(subtree_refs)
+                records.append((json.dumps({'subtree': subtree_hash, 'refs': subtree_refs}), self.record_file.read_bytes(offset, length)))
+
+        for item_type, item_type_index in self.index.items():
+            pk_by_rid = {rid: pk for pk, rid in item_type_index['byPK'].items()}
+            for rid, record in item_type_index['byRid'].items():
+                if not record:
+                    continue
+                offset, length, content_hash, sid, refs, links = record
+                append_subtrees(refs)
+                header = {'item_type': item_type, 'rid': rid, 'PK': pk_by_rid.get(rid), 'hash': content_hash, 'sid': sid, 'refs': refs}
+                if links is not None:
+                    header['links'] = links
+                # copy encoded bytes as-is, the serializer stays the same
+                records.append((json.dumps(header), self.record_file.read_bytes(offset, length)))
+        self.record_file.write(records)
+        self.record_file.close()
+
+        previous_log_bytes = self.log_bytes
+        self.index = {}
+        self.subtree_index = {}
+        self.live_bytes = 0
+        self._read_index()
+        Logger.info(f'compacted object store {self.filepath} from {previous_log_bytes} to {self.log_bytes} bytes')
 
     def exist(self, item_type, rid_or_pk):
-        if item_type in self.store:
-            return rid_or_pk in self.store[item_type]['byPK'] or rid_or_pk in self.store[item_type]['byRid']
-        
+        if item_type in self.index:
+            return rid_or_pk in self.index[item_type]['byPK'] or rid_or_pk in self.index[item_type]['byRid']
+
         return False
 
-    def insert(self, parent):
-        if not parent['item_type'] in self.store:
-            self.store[parent['item_type']] = {
-                'byPK': {},
-                'byRid': {}
-            }
-        
-        try:
-            self.store[parent['item_type']]['byRid'][parent['rid']] = parent
-        except Exception as e:
-            # snapshot has no `rid`, only uuid or the newly assigned PK
-            if parent['item_type'] == 'snapshot':
-                self.store[parent['item_type']]['byRid'][parent['uuid']] = parent
-            else:
-                Logger.error('Error while inserting into object store, parent =', parent)
-                raise e
+    def insert(self, parent, sid=None):
+        '''
+        :param int sid: the propsheet version `parent` was fetched at, if None keeps the one recorded before
+        '''
+        item_type = parent['item_type']
+        rid = self._get_rid(parent)
+
+        item_type_index = self.index.setdefault(item_type, {'byPK': {}, 'byRid': {}})
+        if rid not in item_type_index['byRid']:
+            item_type_index['byRid'][rid] = None
+        if item_type in LINKAGE_TRANSFORM:
+            item_type_index['byPK'][parent[LINKAGE_TRANSFORM[item_type]]] = rid
 
-        if parent['item_type'] in LINKAGE_TRANSFORM:
-            self.store[parent['item_type']]['byPK'][parent[LINKAGE_TRANSFORM[parent['item_type']]]] = parent
+        if item_type in INTERNED_ITEM_TYPES:
+            parent, _, _ = self.interner.intern(parent)
+        self.loaded[(item_type, rid)] = parent
+        self.dirty[(item_type, rid)] = True
+        self.removed.discard((item_type, rid))
+        if sid is not None:
+            self.sids[(item_type, rid)] = sid
+        if len(self.dirty) >= AUTOSAVE_EVERY:
+            self.save()
 
     def get(self, item_type, rid_or_pk):
-        try:
-            item = self.store[item_type]['byPK'][rid_or_pk]
-        except KeyError as error:
-            item = self.store[item_type]['byRid'][rid_or_pk]
-        
-        return item
-    
-    def getAll(self, prioritized_schema_list):
-        '''
-        :param list prioritized_schema_list: if provided, will use the objects of those schema(s) first in the final `all_objects` list
-        '''
-        if prioritized_schema_list:
-            prioritized_schema_name_set = set(prioritized_schema_list)
-            remain_schema_name_set = set(self.store.keys()) - prioritized_schema_name_set
-            all_objects = []
-
-            # construct the list
-            ordered_schema_name_list = [*prioritized_schema_list, *remain_schema_name_set]
-
-            # filter out schema which doesn't exist in data
-            ordered_schema_name_list = list(filter(lambda schema_name: schema_name in self.store, ordered_schema_name_list))
-
-            for schema_name in ordered_schema_name_list:
-                all_objects = [*all_objects, *[value for value in self.store[schema_name]['byRid'].values()]]
-            
-            return all_objects
-
-        return [ value for schemaName in self.store.keys() for value in self.store[schemaName]['byRid'].values() ]
\ No newline at end of file
+        rid = self._resolve_rid(item_type, rid_or_pk)
+        key = (item_type, rid)
+        if key not in self.loaded:
+            self.loaded[key] = self._decode(item_type, rid)
+
+        return self.loaded[key]
+
+    def _decode(self, item_type, rid):
+        offset, length = self.index[item_type]['byRid'][rid][:2]
+        parent = self.record_file.serializer.loads(self.record_file.read_bytes(offset, length))
+        if item_type in INTERNED_ITEM_TYPES:
+            parent = self.interner.expand(parent, self._load_subtree)
+        return parent
+
+    def _load_subtree(self, subtree_hash):
+        offset, length, _ = self.subtree_index[subtree_hash]
+        return self.record_file.serializer.loads(self.record_file.read_bytes(offset, length))
+
+    def get_pk_by_rid(self, item_type):
+        '''
+            Returns a dict of rid -> PK for objects of a `LINKAGE_TRANSFORM` item_type, from the index, without decoding any object
+        '''
+        if item_type not in self.index:
+            return {}
+        return {rid: pk for pk, rid in self.index[item_type]['byPK'].items()}
+
+    def get_sid(self, item_type, rid):
+        if (item_type, rid) in self.sids:
+            return self.sids[(item_type, rid)]
+        record = self.index[item_type]['byRid'][rid]
+        return record[3] if record else None
+
+    def iter_keys(self):
+        '''
+            Yields (item_type, rid) of every object in store
+        '''
+        for item_type, item_type_index in self.index.items():
+            for rid in item_type_index['byRid']:
+                yield (item_type, rid)
+
+    def remove(self, item_type, rid):
+        '''
+            Drops an object from store, e.g. because it changed at source and needs a refetch
+        '''
+        item_type_index = self.index.get(item_type)
+        if not item_type_index or rid not in item_type_index['byRid']:
+            return
+        record = item_type_index['byRid'].pop(rid)
+        if record:
+            self.live_bytes -= record[1]
+        self._unindex_pks(item_type_index, rid)
+
+        key = (item_type, rid)
+        self.loaded.pop(key, None)
+        self.dirty.pop(key, None)
+        self.sids.pop(key, None)
+        if record:
+            self.removed.add(key)
+
+    def _iter_references(self, node):
+        '''
+            Yields (related_item_type, related rid or PK) the object refers to: from its record header if saved,
+            so objects are not decoded to plan the posting order
+        '''
+        record = self.index[node[0]]['byRid'][node[1]]
+        if node in self.dirty or record is None:
+            links = get_references(self.loaded[node])
+        elif record[5] is not None:
+            links = record[5]
+        else:
+            # saved before links were, decoded once without keeping it in `loaded`
+            links = get_references(self._decode(*node))
+        for related_item_type, related_rid_or_pk in links:
+            yield related_item_type, related_rid_or_pk
+
+    def count(self):
+        return sum(len(item_type_index['byRid']) for item_type_index in self.index.values())
+
+    def _ordered_schema_names(self, prioritized_schema_list):
+        prioritized_schema_list = prioritized_schema_list or []
+        remain_schema_names = [schema_name for schema_name in self.index.keys() if schema_name not in set(prioritized_schema_list)]
+        # filter out schema which doesn't exist in data
+        return [schema_name for schema_name in [*prioritized_schema_list, *remain_schema_names] if schema_name in self.index]
+
+    def _priorities(self, prioritized_schema_list):
+        # priority of each object is (schema rank, insertion order), nodes are (item_type, rid)
+        priority = {}
+        for schema_rank, schema_name in enumerate(self._ordered_schema_names(prioritized_schema_list)):
+            for rid in self.index[schema_name]['byRid']:
+                priority[(schema_name, rid)] = (schema_rank, len(priority))
+        return priority
+
+    def _dependencies(self, priority):
+        '''
+            Returns node -> set of nodes it refers to, by `_iter_references`
+        '''
+        dependencies_by_node = {}
+        for node in priority:
+            dependencies = set()
+            for related_item_type, related_rid_or_pk in self._iter_references(node):
+                if not self.exist(related_item_type, related_rid_or_pk):
+                    continue
+                dependency = (related_item_type, self._resolve_rid(related_item_type, related_rid_or_pk))
+                if dependency != node:
+                    dependencies.add(dependency)
+            dependencies_by_node[node] = dependencies
+        return dependencies_by_node
+
+    def _iter_ordered_nodes(self, priority, dependencies_by_node):
+        dependency_count = {node: len(dependencies_by_node.get(node, ())) for node in priority}
+        dependents = {}
+        for node, dependencies in dependencies_by_node.items():
+            for dependency in dependencies:
+                dependents.setdefault(dependency, []).append(node)
+
+        ready = [(priority[node], node) for node, count in dependency_count.items() if count == 0]
+        heapq.heapify(ready)
+        yielded = set()
+        while len(yielded) < len(priority):
+            if not ready:
+                # references form a cycle, break it by priority
+                node = min((node for node in priority if node not in yielded), key=lambda node: priority[node])
+                Logger.warn(f'reference cycle found, yielding {node} before all its references')
+                ready = [(priority[node], node)]
+
+            _, node = heapq.heappop(ready)
+            if node in yielded:
+                continue
+            yielded.add(node)
+            yield node
+
+            for dependent in dependents.get(node, []):
+                dependency_count[dependent] -= 1
+                if dependency_count[dependent] == 0 and dependent not in yielded:
+                    heapq.heappush(ready, (priority[dependent], dependent))
+
+    def get_waves(self, prioritized_schema_list=None, final_schema_names=()):
+        '''
+            Groups every object, as (item_type, rid), into waves that can each be posted concurrently:
+            an object comes in a later wave than all objects it refers to.
+            Objects of `final_schema_names` come after all other objects, one schema after another in that order,
+            so for them only references within the same schema add waves.
+            `prioritized_schema_list` does not order objects across waves, only references decide the wave:
+            objects of different schemas share a wave unless one refers to the other.
+            Within a wave objects are in priority order, which also decides which reference of a cycle is broken.
+        '''
+        priority = self._priorities(prioritized_schema_list)
+        dependencies_by_node = self._dependencies(priority)
+        final_schema_names = list(final_schema_names)
+        def group_of(node):
+            return final_schema_names.index(node[0]) + 1 if node[0] in final_schema_names else 0
+
+        # (group, wave within group) of each node; `_iter_ordered_nodes` yields dependencies first,
+        # except for broken cycles, whose dependencies not placed yet are ignored
+        wave_of = {}
+        # (item_type, related item_type) -> count, of references to a later final schema, which cannot be kept
+        later_group_references = collections.Counter()
+        for node in self._iter_ordered_nodes(priority, dependencies_by_node):
+            group = group_of(node)
+            wave = 0
+            for dependency in dependencies_by_node.get(node, ()):
+                if group_of(dependency) > group:
+                    later_group_references[(node[0], dependency[0])] += 1
+                elif dependency in wave_of and wave_of[dependency][0] == group:
+                    wave = max(wave, wave_of[dependency][1] + 1)
+            wave_of[node] = (group, wave)
+        for (item_type, related_item_type), count in later_group_references.items():
+            Logger.warn(f'{count} {item_type} refer to {related_item_type}, which goes last by `final_schema_names`, posting them before it')
+
+        waves = {}
+        for node, group_wave in wave_of.items():
+            waves.setdefault(group_wave, []).append(node)
+        return [sorted(waves[group_wave], key=priority.get) for group_wave in sorted(waves)]
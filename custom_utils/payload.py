@@ -0,0 +1,77 @@
+import math
+from custom_utils.serialization import get_codec, JsonCodec
+
+# orjson if installed, it encodes in C without the intermediate str of `json.dumps`
+PAYLOAD_CODEC = get_codec('auto')
+FALLBACK_CODEC = JsonCodec()
+
+def _is_empty_string(value):
+    return isinstance(value, str) and value == ''
+
+def strip_empty_fields(value, memo=None):
+    '''
+        Returns `value` without fields that are empty strings, in dicts and in dicts inside lists, and without empty strings in lists.
+        Copy on write: a dict or list is only copied if something in it is stripped, otherwise it is returned as-is,
+        so objects without empty fields cost one read-only walk; do not change the result in place.
+        An object embedded several times (e.g. interned snapshot subtrees) is only walked once.
+    '''
+    memo = {} if memo is None else memo
+    if isinstance(value, dict):
+        return _strip_dict(value, memo)
+    if isinstance(value, list):
+        return _strip_list(value, memo)
+    return value
+
+def _strip_dict(obj, memo):
+    if id(obj) in memo:
+        return memo[id(obj)]
+    stripped = None
+    for field_name, field_value in obj.items():
+        if _is_empty_string(field_value):
+            stripped = dict(obj) if stripped is None else stripped
+            del stripped[field_name]
+        elif isinstance(field_value, (dict, list)):
+            stripped_value = _strip_dict(field_value, memo) if isinstance(field_value, dict) else _strip_list(field_value, memo)
+            if stripped_value is not field_value:
+                stripped = dict(obj) if stripped is None else stripped
+                stripped[field_name] = stripped_value
+    result = obj if stripped is None else stripped
+    memo[id(obj)] = result
+    return result
+
+def _strip_list(items, memo):
+    # only dicts in lists are stripped in turn, lists in lists are kept as they are
+    stripped = None
+    for index, item in enumerate(items):
+        if _is_empty_string(item):
+            stripped = items[:index] if stripped is None else stripped
+            continue
+        stripped_item = _strip_dict(item, memo) if isinstance(item, dict) else item
+        if stripped is None and stripped_item is not item:
+            stripped = items[:index]
+        if stripped is not None:
+            stripped.append(stripped_item)
+    return items if stripped is None else stripped
+
+def _has_non_finite_float(value):
+    if isinstance(value, float):
+        return not math.isfinite(value)
+    if isinstance(value, dict):
+        return any(_has_non_finite_float(field_value) for field_value in value.values())
+    if isinstance(value, list):
+        return any(_has_non_finite_float(item) for item in value)
+    return False
+
+def encode_json(obj) -> bytes:
+    '''
+        Encodes a request body by `PAYLOAD_CODEC`, or stdlib json for what orjson does not take (e.g. integers past 64 bits)
+        or encodes differently: orjson writes NaN and Infinity as null, stdlib json as `NaN` and `Infinity` like before
+    '''
+    try:
+        body = PAYLOAD_CODEC.dumps(obj)
+    except TypeError:
+        return FALLBACK_CODEC.dumps(obj)
+    # a non-finite float comes out as null, only walk the payload when there is one
+    if PAYLOAD_CODEC.name != FALLBACK_CODEC.name and b'null' in body and _has_non_finite_float(obj):
+        return FALLBACK_CODEC.dumps(obj)
+    return body
@@ -1,4 +1,4 @@
-from src.utils.dict import dictdeepget, dictdeepset
+from custom_utils.traversal_plan import get_path
 
 
 LINKAGE_TRANSFORM = {
@@ -42,6 +42,17 @@ def get_pk_or_rid(item):
     
     return item['uuid']
 
+def set_path(item: dict, path: tuple, value):
+    '''
+        Same as `dictdeepset(item, '.'.join(path), value)`, but shallow copies the dicts along `path` first,
+        so nested objects shared with other objects (see `custom_utils.interning`) are not changed.
+        `item` itself is changed in place.
+    '''
+    for key in path[:-1]:
+        item[key] = {**item.get(key, {})}
+        item = item[key]
+    item[path[-1]] = value
+
 class TransformWork:
     def __init__(self, parent_item_type, parent_rid, parent_field_name, relation_item_type):
         '''
@@ -51,11 +62,14 @@ class TransformWork:
         self.parent_item_type = parent_item_type
         self.parent_rid = parent_rid
         self.parent_field_name = parent_field_name
+        self.parent_field_path = tuple(parent_field_name.split('.'))
         self.relation_item_type = relation_item_type
 
 class RelationLinkageTransformer:
     def __init__(self, logger):
-        self.list_to_transform = []
+        # (parent_item_type, parent_rid) -> {parent_field_name: TransformWork}, so each parent is rewritten once
+        # for all its fields, and each field is transformed once no matter how many times the parent is reached
+        self.works_by_parent = {}
         self.logger = logger
     
     def add(self, parent_item_type, parent_rid, parent_field_name, relation_item_type):
@@ -64,27 +78,54 @@ class RelationLinkageTransformer:
             so we call .add('family', familyRid, 'commonDiagnosis', 'disease')
         '''
         if relation_item_type in LINKAGE_TRANSFORM:
-            self.list_to_transform.append(TransformWork(
-                parent_item_type, parent_rid, parent_field_name, relation_item_type
-            ))
-    
+            parent_works = self.works_by_parent.setdefault((parent_item_type, parent_rid), {})
+            if parent_field_name not in parent_works:
+                parent_works[parent_field_name] = TransformWork(
+                    parent_item_type, parent_rid, parent_field_name, relation_item_type
+                )
+
+    def _transform_ref(self, pk_by_rid, object_store_manager, relation_item_type, related_item_rid):
+        pk = pk_by_rid[relation_item_type].get(related_item_rid)
+        if pk is not None:
+            return pk
+        # already transformed, otherwise not in store at all
+        if not object_store_manager.exist(relation_item_type, related_item_rid):
+            raise KeyError(related_item_rid)
+        return related_item_rid
+
     def processAll(self, object_store_manager):
         self.logger.info('transforming relation linkages...')
-        for transform_work in self.list_to_transform:
-            parent = {**object_store_manager.get(transform_work.parent_item_type, transform_work.parent_rid)}
-            parent_field_value = dictdeepget(parent, transform_work.parent_field_name)
-            
-            if isinstance(parent_field_value, str):
-                related_item_rid = parent_field_value
-                related_item = object_store_manager.get(transform_work.relation_item_type, related_item_rid)
-                dictdeepset(parent, transform_work.parent_field_name, get_pk_or_rid(related_item))
-                self.logger.debug(f'transforming linkage, {transform_work.parent_item_type}({transform_work.parent_rid}).{transform_work.parent_field_name}({related_item_rid}->{get_pk_or_rid(related_item)})')
-            elif isinstance(parent_field_value, list) and len(parent_field_value) > 0:
-                related_item_rids = parent_field_value
-                related_items = [object_store_manager.get(transform_work.relation_item_type, related_item_rid) for related_item_rid in related_item_rids]
-                dictdeepset(parent, transform_work.parent_field_name, [
-                    get_pk_or_rid(related_item) for related_item in related_items
-                ])
-                self.logger.debug(f'transforming linkage, {transform_work.parent_item_type}({transform_work.parent_rid}).{transform_work.parent_field_name}([{related_item_rids[0]}->{get_pk_or_rid(related_items[0])}, ...])')
-            
-            object_store_manager.insert(parent)
+        debug_enabled = self.logger.is_enabled('DEBUG')
+        # linkage only concerns LINKAGE_TRANSFORM item types, whose rid -> PK is in the store index already
+        pk_by_rid = {item_type: object_store_manager.get_pk_by_rid(item_type) for item_type in LINKAGE_TRANSFORM}
+
+        transformed_count = 0
+        for (parent_item_type, parent_rid), parent_works in self.works_by_parent.items():
+            stored_parent = object_store_manager.get(parent_item_type, parent_rid)
+            parent = None
+            for transform_work in parent_works.values():
+                parent_field_value = get_path(stored_parent if parent is None else parent, transform_work.parent_field_path)
+
+                if isinstance(parent_field_value, str):
+                    new_value = self._transform_ref(pk_by_rid, object_store_manager, transform_work.relation_item_type, parent_field_value)
+                elif isinstance(parent_field_value, list) and len(parent_field_value) > 0:
+                    new_value = [
+                        self._transform_ref(pk_by_rid, object_store_manager, transform_work.relation_item_type, related_item_rid)
+                        for related_item_rid in parent_field_value
+                    ]
+                else:
+                    continue
+                if new_value == parent_field_value:
+                    continue
+
+                # copied once per parent, on its first changed field
+                if parent is None:
+                    parent = {**stored_parent}
+                set_path(parent, transform_work.parent_field_path, new_value)
+                if debug_enabled:
+                    self.logger.debug(f'transforming linkage, {parent_item_type}({parent_rid}).{transform_work.parent_field_name}({parent_field_value}->{new_value})')
+
+            if parent is not None:
+                object_store_manager.insert(parent)
+                transformed_count += 1
+        self.logger.info(f'transformed relation linkages of {transformed_count} objects')
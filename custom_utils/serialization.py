@@ -0,0 +1,335 @@
+import os
+import json
+import gzip
+import mmap
+import struct
+import pathlib
+from custom_utils.config import config_data
+from custom_utils.logger import Logger
+
+# optional faster codecs and compression, falling back to stdlib json and gzip when not installed
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# every cache file starts with MAGIC, then a u32 length and a json header telling how its content is encoded,
+# so files stay readable after the configured codec changes
+MAGIC = b'GVCACHE1'
+U32 = struct.Struct('<I')
+# a record is [u32 key length][u32 value length][key][value]
+RECORD_LENGTHS = struct.Struct('<II')
+
+LAYOUT_DOCUMENT = 'document'
+LAYOUT_RECORDS = 'records'
+
+class JsonCodec:
+    name = 'json'
+
+    def dumps(self, obj):
+        return json.dumps(obj, separators=(',', ':')).encode('utf-8')
+
+    def loads(self, data):
+        return json.loads(data)
+
+class OrjsonCodec:
+    name = 'orjson'
+
+    def dumps(self, obj):
+        return orjson.dumps(obj)
+
+    def loads(self, data):
+        return orjson.loads(data)
+
+class MsgpackCodec:
+    name = 'msgpack'
+
+    def dumps(self, obj):
+        return msgpack.packb(obj, use_bin_type=True)
+
+    def loads(self, data):
+        return msgpack.unpackb(data, raw=False)
+
+class NoCompression:
+    name = 'none'
+
+    def compress(self, data):
+        return data
+
+    def decompress(self, data):
+        return data
+
+class GzipCompression:
+    name = 'gzip'
+
+    def compress(self, data):
+        # favour speed, these are local caches
+        return gzip.compress(data, compresslevel=1)
+
+    def decompress(self, data):
+        return gzip.decompress(data)
+
+class ZstdCompression:
+    name = 'zstd'
+
+    def __init__(self):
+        self.compressor = zstandard.ZstdCompressor(level=3)
+        self.decompressor = zstandard.ZstdDecompressor()
+
+    def compress(self, data):
+        return self.compressor.compress(data)
+
+    def decompress(self, data):
+        return self.decompressor.decompress(data)
+
+CODECS = {
+    'json': lambda: JsonCodec(),
+    'orjson': lambda: OrjsonCodec() if orjson else None,
+    'msgpack': lambda: MsgpackCodec() if msgpack else None,
+}
+
+COMPRESSIONS = {
+    'none': lambda: NoCompression(),
+    'gzip': lambda: GzipCompression(),
+    'zstd': lambda: ZstdCompression() if zstandard else None,
+}
+
+def get_codec(name='auto'):
+    '''
+        `auto` picks orjson if installed, otherwise stdlib json.
+        A codec that is not installed falls back to json with a warning.
+    '''
+    if name == 'auto':
+        return OrjsonCodec() if orjson else JsonCodec()
+    if name not in CODECS:
+        raise Exception(f'SerializationError: unknown codec `{name}`, choose from {list(CODECS)}')
+    codec = CODECS[name]()
+    if not codec:
+        Logger.warn(f'cache codec `{name}` is not installed, falling back to json')
+        return JsonCodec()
+    return codec
+
+def get_compression(name='none'):
+    if name not in COMPRESSIONS:
+        raise Exception(f'SerializationError: unknown compression `{name}`, choose from {list(COMPRESSIONS)}')
+    compression = COMPRESSIONS[name]()
+    if not compression:
+        Logger.warn(f'cache compression `{name}` is not installed, falling back to gzip')
+        return GzipCompression()
+    return compression
+
+def _require(name, factories, kind):
+    # reading a file must use whatever it was written with
+    if name not in factories or not factories[name]():
+        raise Exception(f'SerializationError: cache file is encoded by {kind} `{name}`, which is not installed')
+    return factories[name]()
+
+class Serializer:
+    '''
+        A codec plus compression. Configured by `cache` in config, e.g. `cache: {codec: msgpack, compression: zstd}`;
+        by default orjson (if installed) without compression.
+    '''
+    def __init__(self, codec, compression):
+        self.codec = codec
+        self.compression = compression
+
+    @classmethod
+    def from_header(cls, header):
+        return cls(_require(header['codec'], CODECS, 'codec'), _require(header['compression'], COMPRESSIONS, 'compression'))
+
+    def header(self, layout):
+        return {'codec': self.codec.name, 'compression': self.compression.name, 'layout': layout}
+
+    def dumps(self, obj):
+        return self.compression.compress(self.codec.dumps(obj))
+
+    def loads(self, data):
+        return self.codec.loads(self.compression.decompress(data))
+
+def get_serializer(config=None):
+    config = config or config_data
+    cache_config = config.get('cache') or {}
+    return Serializer(get_codec(cache_config.get('codec', 'auto')), get_compression(cache_config.get('compression', 'none')))
+
+CACHE_SERIALIZER = get_serializer()
+
+def write_file_header(f, serializer, layout):
+    header_bytes = json.dumps(serializer.header(layout)).encode('utf-8')
+    f.write(MAGIC + U32.pack(len(header_bytes)) + header_bytes)
+
+def read_file_header(f):
+    '''
+        Returns (header, bytes read), or (None, 0) if the file is not a cache file (e.g. a legacy plain json file)
+    '''
+    f.seek(0)
+    if f.read(len(MAGIC)) != MAGIC:
+        f.seek(0)
+        return None, 0
+    header_length, = U32.unpack(f.read(U32.size))
+    header = json.loads(f.read(header_length))
+    return header, len(MAGIC) + U32.size + header_length
+
+def dump_file(path, obj, serializer=None):
+    '''
+        Writes `obj` as a single document, atomically
+    '''
+    serializer = serializer or CACHE_SERIALIZER
+    path = pathlib.Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    temp_path = path.with_name(path.name + '.writing')
+    with temp_path.open('wb') as f:
+        write_file_header(f, serializer, LAYOUT_DOCUMENT)
+        f.write(serializer.dumps(obj))
+    os.replace(temp_path, path)
+
+def load_file(path):
+    '''
+        Reads a file written by `dump_file`, or a plain json file
+    '''
+    with pathlib.Path(path).open('rb') as f:
+        header, _ = read_file_header(f)
+        if not header:
+            return json.load(f)
+        if header['layout'] != LAYOUT_DOCUMENT:
+            raise Exception(f'SerializationError: {path} is a `{header["layout"]}` file, not a document')
+        return Serializer.from_header(header).loads(f.read())
+
+class RecordFile:
+    '''
+        A file of `(key, object)` records, `[u32 key length][u32 value length][key][value]` each after the file header.
+        Opening it only reads the record lengths and keys to index them by offset, and the file is memory mapped,
+        so a single object is decoded on `get()` without reading the whole file.
+        `append()` adds records in place, `write()` replaces the whole file.
+
+    :param on_record: if given, called with (key, value offset, value length) of each record on open,
+        for callers keeping their own index (e.g. a log with many records per key), instead of indexing by key
+    '''
+    def __init__(self, path, serializer=None, on_record=None):
+        self.filepath = pathlib.Path(path)
+        self.serializer = serializer or CACHE_SERIALIZER
+        self.on_record = on_record
+        # key -> (value offset, value length) of its latest record
+        self.index = {}
+        self.data_start = 0
+        self.size = 0
+        self.mmap = None
+        if self.filepath.exists():
+            self._read_index()
+
+    def _read_index(self):
+        with self.filepath.open('r+b') as f:
+            header, offset = read_file_header(f)
+            if not header or header['layout'] != LAYOUT_RECORDS:
+                raise Exception(f'SerializationError: {self.filepath} is not a record file')
+            self.serializer = Serializer.from_header(header)
+            self.data_start = offset
+            file_size = os.fstat(f.fileno()).st_size
+            while offset < file_size:
+                lengths = f.read(RECORD_LENGTHS.size)
+                key_length, value_length = RECORD_LENGTHS.unpack(lengths) if len(lengths) == RECORD_LENGTHS.size else (0, file_size)
+                record_end = offset + RECORD_LENGTHS.size + key_length + value_length
+                # a record cut short by a crash, drop it
+                if record_end > file_size:
+                    Logger.warn(f'dropping incomplete last record in {self.filepath}')
+                    f.truncate(offset)
+                    break
+                key = f.read(key_length).decode('utf-8')
+                self._index_record(key, offset + RECORD_LENGTHS.size + key_length, value_length)
+                f.seek(value_length, os.SEEK_CUR)
+                offset = record_end
+            self.size = offset
+
+    def _index_record(self, key, value_offset, value_length):
+        if self.on_record:
+            self.on_record(key, value_offset, value_length)
+        else:
+            self.index[key] = (value_offset, value_length)
+
+    def _map(self):
+        # remap once the file grew past the current mapping
+        if self.mmap is None or len(self.mmap) < self.size:
+            self.close()
+            with self.filepath.open('rb') as f:
+                self.mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return self.mmap
+
+    def close(self):
+        if self.mmap is not None:
+            self.mmap.close()
+            self.mmap = None
+
+    def __len__(self):
+        return len(self.index)
+
+    def __contains__(self, key):
+        return key in self.index
+
+    def keys(self):
+        return self.index.keys()
+
+    def read_bytes(self, offset, length):
+        return self._map()[offset:offset + length]
+
+    def get(self, key):
+        offset, length = self.index[key]
+        return self.serializer.loads(self.read_bytes(offset, length))
+
+    def values(self):
+        '''
+            Yields objects in the order they were first written
+        '''
+        for key in self.index:
+            yield self.get(key)
+
+    def _write_records(self, f, items, offset):
+        positions = []
+        for key, obj in items:
+            key_bytes = key.encode('utf-8')
+            value_bytes = obj if isinstance(obj, (bytes, bytearray)) else self.serializer.dumps(obj)
+            f.write(RECORD_LENGTHS.pack(len(key_bytes), len(value_bytes)) + key_bytes + value_bytes)
+            value_offset = offset + RECORD_LENGTHS.size + len(key_bytes)
+            if not self.on_record:
+                self.index[key] = (value_offset, len(value_bytes))
+            positions.append((value_offset, len(value_bytes)))
+            offset = value_offset + len(value_bytes)
+        self.size = offset
+        return positions
+
+    def append(self, items, fsync=False):
+        '''
+            Appends `(key, object)` items, objects that are bytes are written as already encoded.
+            Returns the list of (value offset, value length) written, in order.
+        '''
+        if not self.filepath.exists():
+            self.write([])
+        with self.filepath.open('ab') as f:
+            positions = self._write_records(f, items, self.size)
+            f.flush()
+            if fsync:
+                os.fsync(f.fileno())
+        return positions
+
+    def write(self, items):
+        '''
+            Replaces the file with `(key, object)` items, atomically
+        '''
+        self.close()
+        self.index = {}
+        self.filepath.parent.mkdir(parents=True, exist_ok=True)
+        temp_path = self.filepath.with_name(self.filepath.name + '.writing')
+        with temp_path.open('wb') as f:
+            write_file_header(f, self.serializer, LAYOUT_RECORDS)
+            self.data_start = f.tell()
+            positions = self._write_records(f, items, self.data_start)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, self.filepath)
+        return positions
@@ -5,19 +5,24 @@ import datetime
 import requests
 from urllib3.util.retry import Retry
 from requests.adapters import HTTPAdapter
-from requests_futures.sessions import FuturesSession
 from concurrent.futures import ThreadPoolExecutor
-from concurrent.futures import as_completed
+from urllib.parse import urlsplit
+import threading
 
-import json
+import time
+import asyncio
 import boto3
 from boto3.dynamodb.conditions import Key, Attr
 import pathlib
 import shutil
 
 from custom_utils.config import config_data
-from custom_utils.logger import Logger, Estimate
+from custom_utils.logger import Logger, Progress
 from custom_utils.relation_linkage import get_pk_or_rid
+from custom_utils.async_transport import AsyncTransport
+from custom_utils.windowed import iter_windowed, aiter_windowed
+from custom_utils.adaptive_limiter import AdaptiveLimiter
+from custom_utils.payload import strip_empty_fields, encode_json
 
 THIS_FILE_DIR = os.path.dirname(os.path.realpath(__file__))
 
@@ -48,24 +53,134 @@ POST_ENDPOINTS = {
 }
 
 CONCURRENT_GET_DEFAULT_THREADS = 10
-CONCURRENT_POST_DEFAULT_THREADS = 1
+# `auto` adapts requests in flight to what the endpoint sustains, see `AdaptiveLimiter`
+CONCURRENT_POST_DEFAULT_THREADS = 'auto'
+# seconds, a GET taking longer is retried by `RETRIES_CONFIG`
+REQUEST_TIMEOUT = 300
+# attempts of a throttled (429) POST when concurrency is adaptive, see `Serverless._send`
+THROTTLED_MAX_ATTEMPTS = 5
+THROTTLED_BACKOFF_FACTOR = 0.5
+# requests submitted but not yet handled per thread, see `Serverless.iter_concurrent_get`
+CONCURRENT_WINDOW_PER_THREAD = 2
+# `threads` sends each request from a thread pool by requests, `asyncio` sends them all from one event loop by aiohttp
+TRANSPORTS = ('threads', 'asyncio')
+
+AWS_REGION = 'us-west-2'
+AWS_SERVICE = 'execute-api'
+
+# GET is retried on throttling, 5xx and read errors. POST is only retried when it could not connect,
+# since the target may have processed it already; throttled POSTs are re-sent by `Serverless._send` instead, where the limiter sees each attempt.
+# The last response is returned rather than raised once retries run out, so it is handled and logged like any failed request
+RETRIES_CONFIG = Retry(total=5,
+    backoff_factor=0.17,
+    status_forcelist=[ 429, 500, 502, 503, 504 ],
+    raise_on_status=False,
+)
+
+def get_throttled_delay(res, attempt):
+    '''
+        Seconds to wait before re-sending a throttled request: its `Retry-After` if given in seconds, otherwise exponential backoff
+    '''
+    retry_after = res.headers.get('Retry-After', '')
+    return float(retry_after) if retry_after.isdigit() else THROTTLED_BACKOFF_FACTOR * 2 ** attempt
+
+# (UTC day, region, service) -> AWS4Auth, see `get_aws4auth`
+_aws4auth_cache = {}
+
+def get_aws4auth(region=AWS_REGION, service=AWS_SERVICE) -> AWS4Auth:
+    '''
+        One `AWS4Auth` per UTC day, region and service, shared by all requests. `AWS4Auth` already derives its signing key
+        once when constructed, so this only saves constructing one per use, and makes a new one for a new day,
+        instead of one auth regenerating its key in place while other threads sign with it.
+    '''
+    day = datetime.datetime.utcnow().strftime('%Y%m%d')
+    key = (day, region, service)
+    auth = _aws4auth_cache.get(key)
+    if auth is None:
+        auth = AWS4Auth(os.getenv('AWS_ACCESS_KEY_ID'), os.getenv('AWS_SECRET_ACCESS_KEY'), region, service, date=day)
+        # keys of past days are never used again
+        for stale_key in [cached_key for cached_key in _aws4auth_cache if cached_key[0] != day]:
+            _aws4auth_cache.pop(stale_key, None)
+        _aws4auth_cache[key] = auth
+    return auth
+
+def _count_pool_usage(adapter):
+    # urllib3 counts requests and new connections on each connection pool
+    requests_count, connections_count = 0, 0
+    for pool_key in list(adapter.poolmanager.pools.keys()):
+        pool = adapter.poolmanager.pools.get(pool_key)
+        if pool is not None:
+            requests_count += pool.num_requests
+            connections_count += pool.num_connections
+    return requests_count, connections_count
+
+class HttpTransport:
+    '''
+        One keep-alive `requests.Session` per host, shared by every request and thread of this process,
+        with a connection pool at least as large as the concurrency asked of it, so connections are reused instead of opened per request.
+    '''
+    def __init__(self, retries=RETRIES_CONFIG):
+        self.retries = retries
+        self.pid = os.getpid()
+        # (scheme, host) -> (session, pool size)
+        self.sessions = {}
+        # (requests, connections) counted by adapters replaced to grow their pool
+        self.replaced_counts = (0, 0)
+        self.lock = threading.Lock()
+
+    def get_session(self, url, pool_size=CONCURRENT_GET_DEFAULT_THREADS) -> requests.Session:
+        '''
+            The session for the host of `url`, its pool grown to `pool_size` connections if smaller
+        '''
+        # pooled connections do not survive a fork, start over in the child
+        if os.getpid() != self.pid:
+            self.pid = os.getpid()
+            self.sessions = {}
+        parts = urlsplit(url)
+        host = (parts.scheme, parts.netloc)
+        with self.lock:
+            session, current_pool_size = self.sessions.get(host, (None, 0))
+            if session is None:
+                session = requests.Session()
+            if pool_size > current_pool_size:
+                # only grows
+                prefix = f'{parts.scheme}://{parts.netloc}'
+                replaced_adapter = session.adapters.get(prefix)
+                session.mount(prefix, HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=self.retries))
+                self.sessions[host] = (session, pool_size)
+                if replaced_adapter is not None:
+                    self.replaced_counts = tuple(map(sum, zip(self.replaced_counts, _count_pool_usage(replaced_adapter))))
+                    # closes its idle connections now; requests still in flight on it finish,
+                    # and urllib3 closes their connections instead of returning them to the closed pool
+                    replaced_adapter.close()
+        return session
+
+    def stats(self) -> dict:
+        '''
+            Connection reuse counters of every pool, to confirm keep-alive works: `reused` close to `requests` means it does
+        '''
+        requests_count, connections_count = self.replaced_counts
+        for session, _ in list(self.sessions.values()):
+            for adapter in set(session.adapters.values()):
+                adapter_requests_count, adapter_connections_count = _count_pool_usage(adapter)
+                requests_count += adapter_requests_count
+                connections_count += adapter_connections_count
+        return {'requests': requests_count, 'connections': connections_count, 'reused': requests_count - connections_count}
+
 class Serverless:
     POST_ERROR_LOG_FILE = pathlib.Path(f'{THIS_FILE_DIR}/../.log/sls_post_error.log')
 
-    RETRIES_CONFIG = Retry(total=5,
-        backoff_factor=0.17,
-        # status_forcelist=[ 500, 502, 503, 504 ]
-    )
-
-    def __init__(self, logger, base_url='http://0.0.0.0:3000'):
-        self.auth=AWS4Auth(os.getenv('AWS_ACCESS_KEY_ID'), \
-            os.getenv('AWS_SECRET_ACCESS_KEY'),'us-west-2', \
-                'execute-api')
+    RETRIES_CONFIG = RETRIES_CONFIG
 
+    def __init__(self, logger, base_url='http://0.0.0.0:3000', transport='threads'):
         self.logger = logger
         self.BASE_URL = base_url
+        if transport not in TRANSPORTS:
+            raise Exception(f'TransportError: unknown transport `{transport}`, choose from {list(TRANSPORTS)}')
+        self.transport = transport
+        self.new_session()
 
-        self.logger.info(f'Will connect to serverless endpoint {base_url}')
+        self.logger.info(f'Will connect to serverless endpoint {base_url} by {transport} transport')
 
         # TODO: when running two scripts both use sls.py, this will accidentally delete a process's log file
         # better delete the log manually if want to reset. May find better ways to reset log file in the future
@@ -73,17 +188,58 @@ class Serverless:
         # if self.POST_ERROR_LOG_FILE.exists():
         #     os.remove(self.POST_ERROR_LOG_FILE.absolute())
     
+    def new_session(self):
+        '''
+            Use fresh keep-alive http sessions, e.g. in a forked worker process,
+            so it does not share pooled connections with its parent process
+        '''
+        self.http_transport = HttpTransport(retries=self.RETRIES_CONFIG)
+        # created on first use, aiohttp is only needed by the `asyncio` transport
+        self._async_transport = None
+
+    @property
+    def auth(self) -> AWS4Auth:
+        return get_aws4auth()
+
+    @property
+    def session(self) -> requests.Session:
+        return self.http_transport.get_session(self.BASE_URL)
+
+    @property
+    def async_transport(self) -> AsyncTransport:
+        if self._async_transport is None:
+            self._async_transport = AsyncTransport(get_aws4auth)
+        return self._async_transport
+
+    async def aclose(self):
+        '''
+            Closes the pooled connections of the running event loop, call it before your own event loop ends
+            if you awaited `async_*` methods on it
+        '''
+        if self._async_transport is not None:
+            await self._async_transport.aclose()
+
+    def connection_stats(self) -> dict:
+        '''
+            Connection reuse counters of the transports used so far, see `HttpTransport.stats`
+        '''
+        stats = {'threads': self.http_transport.stats()}
+        if self._async_transport is not None:
+            stats['asyncio'] = self._async_transport.stats()
+        return stats
+
+    def _get_url(self, parent):
+        return f'{self.BASE_URL}{POST_ENDPOINTS[parent["item_type"]]}/{get_pk_or_rid(parent)}'
+
+    def _post_url(self, item_type):
+        return f'{self.BASE_URL}{POST_ENDPOINTS[item_type]}'
+
     def remove_empty_fields(self, parent):
-        processed_parent = {**parent}
-        for field_name, field_value in parent.items():
-            if isinstance(field_value, str) and field_value == '':
-                del processed_parent[field_name]
-            elif isinstance(field_value, dict):
-                processed_parent[field_name] = self.remove_empty_fields(field_value)
-            elif isinstance(field_value, list):
-                processed_parent[field_name] = [self.remove_empty_fields(list_item) if isinstance(list_item, dict) else list_item for list_item in field_value if field_value != '']
-        
-        return processed_parent
+        '''
+            `parent` without empty string fields, see `strip_empty_fields`; only copied where something is stripped,
+            so the result may be `parent` itself, copy it before changing it
+        '''
+        return strip_empty_fields(parent)
     
     def _handle_get_response(self, res, parent, item_type):
         if res.status_code == 404:
@@ -113,42 +269,125 @@ class Serverless:
         return data
     
     def get(self, parent) -> dict:
+        if self.transport == 'asyncio':
+            return self.async_transport.run(self.async_get(parent))
+
         item_type = parent['item_type']
-        res = requests.get(f'{self.BASE_URL}{POST_ENDPOINTS[item_type]}/{get_pk_or_rid(parent)}', auth=self.auth)
+        res = self.session.get(self._get_url(parent), auth=self.auth)
         
         return self._handle_get_response(res, parent, item_type)
+
+    async def async_get(self, parent) -> dict:
+        res = await self.async_transport.request('GET', self._get_url(parent))
+        return self._handle_get_response(res, parent, parent['item_type'])
     
-    def concurrent_get(self, parents: list, threads=CONCURRENT_GET_DEFAULT_THREADS, include_parent_in_result=False, log=False, reduce_log_mod=1) -> list:
-        request_list = []
-        session = FuturesSession(executor=ThreadPoolExecutor(max_workers=threads))
+    def _send(self, session, request, limiter=None):
+        '''
+            Sends a `(context, method, url, data, params)` request. With a `limiter`, records every attempt with it,
+            and re-sends a throttled (429) request after a delay: the target did not process it, so even a POST is safe to send again
+        '''
+        for attempt in range(THROTTLED_MAX_ATTEMPTS):
+            try:
+                res = session.request(request[1], request[2], data=request[3], params=request[4], auth=get_aws4auth(), timeout=REQUEST_TIMEOUT)
+            except requests.Timeout:
+                if limiter:
+                    limiter.record(timed_out=True)
+                raise
+            if not limiter:
+                return res
+            limiter.record(res.elapsed.total_seconds(), res.status_code)
+            if res.status_code != 429 or attempt == THROTTLED_MAX_ATTEMPTS - 1:
+                return res
+            time.sleep(get_throttled_delay(res, attempt))
 
-        for parent in parents:
-            item_type = parent['item_type']
-            future_request = session.get(f'{self.BASE_URL}{POST_ENDPOINTS[item_type]}/{get_pk_or_rid(parent)}', auth=self.auth)
+    async def _async_send(self, request, limiter=None):
+        '''
+            Same as `_send` by the asyncio transport
+        '''
+        for attempt in range(THROTTLED_MAX_ATTEMPTS):
+            try:
+                res = await self.async_transport.request(*request[1:])
+            except asyncio.TimeoutError:
+                if limiter:
+                    limiter.record(timed_out=True)
+                raise
+            if not limiter:
+                return res
+            limiter.record(res.elapsed.total_seconds(), res.status_code)
+            if res.status_code != 429 or attempt == THROTTLED_MAX_ATTEMPTS - 1:
+                return res
+            await asyncio.sleep(get_throttled_delay(res, attempt))
 
-            future_request.parent = parent
-            future_request.item_type = item_type
+    def _iter_responses(self, requests_to_send, threads, window, ordered, transport, limiter=None):
+        '''
+            Sends `(context, method, url, data, params)` requests read from an iterable, and yields `(context, response)`.
+            At most `window` requests are submitted but not yet yielded, `requests_to_send` is only read as the window frees up.
+        '''
+        if (transport or self.transport) == 'asyncio':
+            # threads are not needed to keep requests in flight here, so `threads` is how many are in flight
+            submit = lambda request: self.async_transport.submit(self._async_send(request, limiter))
+            for request, future in iter_windowed(submit, requests_to_send, window or threads, ordered):
+                yield request[0], future.result()
+            return
+
+        # a connection per thread, kept alive across calls
+        session = self.http_transport.get_session(self.BASE_URL, pool_size=threads)
+        with ThreadPoolExecutor(max_workers=threads) as executor:
+            submit = lambda request: executor.submit(self._send, session, request, limiter)
+            # window past the thread count, so threads do not wait on the caller to handle a response before sending the next
+            for request, future in iter_windowed(submit, requests_to_send, window or threads * CONCURRENT_WINDOW_PER_THREAD, ordered):
+                yield request[0], future.result()
+
+    def _get_result(self, index, parent, res, include_parent_in_result, log, reduce_log_mod, progress):
+        get_result = self._handle_get_response(res, parent, parent['item_type'])
+        if log and index % reduce_log_mod == 0:
+            self.logger.info(f'GET {res.status_code} {parent["item_type"]}({get_pk_or_rid(parent)}) processed {progress.format(index + 1)} requests')
+        return (get_result, parent) if include_parent_in_result else get_result
+
+    def iter_concurrent_get(self, parents, threads=CONCURRENT_GET_DEFAULT_THREADS, include_parent_in_result=False, log=False, reduce_log_mod=1, transport=None, window=None, ordered=False):
+        '''
+            Generator version of `concurrent_get`. `parents` can be any iterable, e.g. a generator, and is read as responses come in,
+            so however many parents there are, only `window` requests and their parents are held at a time.
+            Yields results as requests complete, or in the order of `parents` if `ordered`.
 
-            request_list.append(future_request)
-        
-        get_results = []
-        estamator = Estimate()
-        for index, completed_request in enumerate(as_completed(request_list)):
-            res = completed_request.result()
-
-            get_result = self._handle_get_response(
-                res, completed_request.parent, completed_request.item_type
-            )
-            if include_parent_in_result:
-                get_result = (get_result, completed_request.parent)
-            get_results.append(get_result)
-
-            if log and index % reduce_log_mod == 0:
-                progress, eta = estamator.get(index + 1, len(request_list))
-                log_message = f'GET {res.status_code} variant({completed_request.parent["rid"]}) processed {index+1}/{len(request_list)}({progress}%) requests ETA {eta}'
-                self.logger.info(log_message)
-        
-        return get_results
+        :param threads: with the `asyncio` transport, the number of requests in flight at once instead
+        :param transport: `threads` or `asyncio`, defaults to the one this client was created with
+        :param window: requests submitted but not yet yielded, by default `CONCURRENT_WINDOW_PER_THREAD` per thread
+        '''
+        progress = Progress(parents)
+        requests_to_send = ((parent, 'GET', self._get_url(parent), None, None) for parent in parents)
+        for index, (parent, res) in enumerate(self._iter_responses(requests_to_send, threads, window, ordered, transport)):
+            yield self._get_result(index, parent, res, include_parent_in_result, log, reduce_log_mod, progress)
+
+    def concurrent_get(self, parents: list, threads=CONCURRENT_GET_DEFAULT_THREADS, include_parent_in_result=False, log=False, reduce_log_mod=1, transport=None, window=None, ordered=False) -> list:
+        '''
+            All results of `iter_concurrent_get` as a list
+        '''
+        return list(self.iter_concurrent_get(
+            parents, threads=threads, include_parent_in_result=include_parent_in_result, log=log, reduce_log_mod=reduce_log_mod,
+            transport=transport, window=window, ordered=ordered
+        ))
+
+    async def _aiter_responses(self, requests_to_send, max_in_flight, ordered, limiter=None):
+        submit = lambda request: asyncio.ensure_future(self._async_send(request, limiter))
+        async for request, future in aiter_windowed(submit, requests_to_send, max_in_flight, ordered):
+            yield request[0], future.result()
+
+    async def async_iter_concurrent_get(self, parents, max_in_flight=CONCURRENT_GET_DEFAULT_THREADS, include_parent_in_result=False, log=False, reduce_log_mod=1, ordered=False):
+        '''
+            Same as `iter_concurrent_get` on the current event loop, with at most `max_in_flight` requests in flight at once
+        '''
+        progress = Progress(parents)
+        requests_to_send = ((parent, 'GET', self._get_url(parent), None, None) for parent in parents)
+        index = 0
+        async for parent, res in self._aiter_responses(requests_to_send, max_in_flight, ordered):
+            yield self._get_result(index, parent, res, include_parent_in_result, log, reduce_log_mod, progress)
+            index += 1
+
+    async def async_concurrent_get(self, parents, max_in_flight=CONCURRENT_GET_DEFAULT_THREADS, include_parent_in_result=False, log=False, reduce_log_mod=1, ordered=False) -> list:
+        return [get_result async for get_result in self.async_iter_concurrent_get(
+            parents, max_in_flight=max_in_flight, include_parent_in_result=include_parent_in_result, log=log, reduce_log_mod=reduce_log_mod, ordered=ordered
+        )]
 
     def _prepare_post_kwargs(self, parent):
         item_type = parent['item_type']
@@ -169,7 +408,7 @@ class Serverless:
 
         return {
             'auth': self.auth,
-            'data': json.dumps(data),
+            'data': encode_json(data),
             'params': querysting_params
         }
     
@@ -177,7 +416,7 @@ class Serverless:
         if not res.ok:
             # assume 422 error is duplicate PK object creation in db
             if res.status_code == 422 and 'The conditional request failed' in res.text:
-                self.logger.info(f'skipping 422 for {item_type} {parent["rid"]}, probably object already exist in db')
+                self.logger.info(f'skipping 422 for {item_type} {get_pk_or_rid(parent)}, probably object already exist in db')
                 return
             
             error_message = f'PostError: {res.status_code} {item_type} fail to post, sls response = {res.text}, parent = {parent}'
@@ -196,62 +435,157 @@ class Serverless:
         return res
         
     def post(self, parent, raise_http_error=True):
+        if self.transport == 'asyncio':
+            return self.async_transport.run(self.async_post(parent, raise_http_error=raise_http_error))
+
         processed_parent = self.remove_empty_fields(parent)
         item_type = processed_parent['item_type']
 
-        res = requests.post(
-            f'{self.BASE_URL}{POST_ENDPOINTS[item_type]}',
+        res = self.session.post(
+            self._post_url(item_type),
             **self._prepare_post_kwargs(processed_parent)
         )
         
         return self._handle_post_response(res, processed_parent, item_type, raise_http_error)
-    
-    def concurrent_post(self, parents: list, threads=CONCURRENT_POST_DEFAULT_THREADS, raise_http_error=False, log=False) -> list:
-        request_list = []
-        session = FuturesSession(executor=ThreadPoolExecutor(max_workers=threads))
-        session.mount('http://', HTTPAdapter(max_retries=self.RETRIES_CONFIG))
 
+    async def _async_post_response(self, processed_parent):
+        post_kwargs = self._prepare_post_kwargs(processed_parent)
+        return await self.async_transport.request(
+            'POST', self._post_url(processed_parent['item_type']), data=post_kwargs['data'], params=post_kwargs['params']
+        )
+
+    async def async_post(self, parent, raise_http_error=True):
+        processed_parent = self.remove_empty_fields(parent)
+        res = await self._async_post_response(processed_parent)
+        return self._handle_post_response(res, processed_parent, processed_parent['item_type'], raise_http_error)
+    
+    def _iter_post_requests(self, parents):
+        # empty fields are removed and bodies encoded as the window frees up, not for all parents up front
         for parent in parents:
             processed_parent = self.remove_empty_fields(parent)
-            item_type = processed_parent['item_type']
-
-            future_request = session.post(
-                f'{self.BASE_URL}{POST_ENDPOINTS[item_type]}',
-                **self._prepare_post_kwargs(processed_parent)
-            )
-            future_request.parent = processed_parent
-            request_list.append(future_request)
-        
-        post_results = []
-        estimator = Estimate()
-        for index, completed_request in enumerate(as_completed(request_list)):
-            res = completed_request.result()
-
-            if log:
-                progress, eta = estimator.get(index + 1, len(request_list))
-                log_message = f'POST {res.status_code} variant({completed_request.parent["rid"]}) processed {index+1}/{len(request_list)}({progress}%) requests ETA {eta}'
-                if res.status_code < 400:
-                    self.logger.info(log_message)
-                else:
-                    self.logger.error(log_message)
-        
-            post_results.append(self._handle_post_response(
-                res, completed_request.parent, completed_request.parent['item_type'], raise_http_error
-            ))
-        
-        return post_results
+            post_kwargs = self._prepare_post_kwargs(processed_parent)
+            yield processed_parent, 'POST', self._post_url(processed_parent['item_type']), post_kwargs['data'], post_kwargs['params']
 
-SLS = Serverless(Logger, base_url=config_data['endpoint']['url'])
+    def _post_result(self, index, processed_parent, res, raise_http_error, log, progress):
+        if log:
+            log_message = f'POST {res.status_code} {processed_parent["item_type"]}({get_pk_or_rid(processed_parent)}) processed {progress.format(index + 1)} requests'
+            if res.status_code < 400:
+                self.logger.info(log_message)
+            else:
+                self.logger.error(log_message)
+        return self._handle_post_response(res, processed_parent, processed_parent['item_type'], raise_http_error)
+
+    def _get_limiter(self, threads):
+        '''
+            Returns `(limiter, threads)`: for `auto`, a new `AdaptiveLimiter` and enough threads for its max limit
+        '''
+        if threads == 'auto':
+            threads = AdaptiveLimiter()
+        if isinstance(threads, AdaptiveLimiter):
+            return threads, threads.max_limit
+        return None, threads
+
+    def _report_limiter(self, limiter, owned):
+        # a limiter passed in by the caller is reported by the caller, once it is done with it
+        if owned:
+            self.logger.info(f'POST {limiter.report()}')
+
+    def iter_concurrent_post(self, parents, threads=CONCURRENT_POST_DEFAULT_THREADS, raise_http_error=False, log=False, transport=None, window=None, ordered=False):
+        '''
+            Generator version of `concurrent_post`. `parents` can be any iterable, e.g. a generator, and is read as responses come in,
+            so however many parents there are, only `window` requests and their parents are held at a time.
+            Yields results as requests complete, or in the order of `parents` if `ordered`.
+
+        :param threads: with the `asyncio` transport, the number of requests in flight at once instead.
+            `auto` (the default) adapts the requests in flight to the latency and errors of the endpoint;
+            pass an `AdaptiveLimiter` instead to keep adapting across calls.
+        :param transport: `threads` or `asyncio`, defaults to the one this client was created with
+        :param window: requests submitted but not yet yielded, by default `CONCURRENT_WINDOW_PER_THREAD` per thread
+        '''
+        owned = threads == 'auto'
+        limiter, threads = self._get_limiter(threads)
+        window = window or (limiter.get_limit if limiter else None)
+        progress = Progress(parents)
+        responses = self._iter_responses(self._iter_post_requests(parents), threads, window, ordered, transport, limiter=limiter)
+        try:
+            for index, (processed_parent, res) in enumerate(responses):
+                yield self._post_result(index, processed_parent, res, raise_http_error, log, progress)
+        finally:
+            self._report_limiter(limiter, owned)
+
+    def concurrent_post(self, parents: list, threads=CONCURRENT_POST_DEFAULT_THREADS, raise_http_error=False, log=False, transport=None, window=None, ordered=False) -> list:
+        '''
+            All results of `iter_concurrent_post` as a list
+        '''
+        return list(self.iter_concurrent_post(
+            parents, threads=threads, raise_http_error=raise_http_error, log=log, transport=transport, window=window, ordered=ordered
+        ))
+
+    async def async_iter_concurrent_post(self, parents, max_in_flight=CONCURRENT_POST_DEFAULT_THREADS, raise_http_error=False, log=False, ordered=False):
+        '''
+            Same as `iter_concurrent_post` on the current event loop, with at most `max_in_flight` requests in flight at once
+        '''
+        owned = max_in_flight == 'auto'
+        limiter, max_in_flight = self._get_limiter(max_in_flight)
+        progress = Progress(parents)
+        index = 0
+        try:
+            async for processed_parent, res in self._aiter_responses(self._iter_post_requests(parents), limiter.get_limit if limiter else max_in_flight, ordered, limiter=limiter):
+                yield self._post_result(index, processed_parent, res, raise_http_error, log, progress)
+                index += 1
+        finally:
+            self._report_limiter(limiter, owned)
+
+    async def async_concurrent_post(self, parents, max_in_flight=CONCURRENT_POST_DEFAULT_THREADS, raise_http_error=False, log=False, ordered=False) -> list:
+        return [post_result async for post_result in self.async_iter_concurrent_post(
+            parents, max_in_flight=max_in_flight, raise_http_error=raise_http_error, log=log, ordered=ordered
+        )]
+
+
+SLS = Serverless(Logger, base_url=config_data['endpoint']['url'], transport=config_data['endpoint'].get('transport', 'threads'))
+
+# BatchGetItem takes at most 100 keys per request
+BATCH_GET_MAX_KEYS = 100
+BATCH_GET_DEFAULT_THREADS = 8
+BATCH_GET_MAX_ATTEMPTS = 8
+# BatchWriteItem takes at most 25 items per request
+BATCH_WRITE_MAX_ITEMS = 25
+BATCH_WRITE_DEFAULT_THREADS = 8
+# writes are throttled sooner than reads on a provisioned table, so unprocessed items get more attempts
+BATCH_WRITE_MAX_ATTEMPTS = 10
+
+LOCAL_HOSTNAMES = ('localhost', '127.0.0.1', '0.0.0.0')
+
+def is_local_url(url):
+    return urlsplit(url).hostname in LOCAL_HOSTNAMES
 
 class DynamoDB:
     TABLE_NAME = 'GeneVariantCuration-dev'
-    def __init__(self, logger):
-        self.db = boto3.resource('dynamodb',
-            aws_access_key_id="anything",
-            aws_secret_access_key="anything",
-            region_name="us-west-2",
-            endpoint_url="http://localhost:8000"
-        ).Table(self.TABLE_NAME)
+    ENDPOINT_URL = 'http://localhost:8000'
+    def __init__(self, logger, config=None, serverless_url=None):
+        '''
+        :param dict config: the optional `dynamodb` config, `{table, endpoint_url, region, bulk_existence_check}`
+        :param str serverless_url: the serverless endpoint objects are posted to. Unless it is local,
+            reading the table directly needs `endpoint_url` set explicitly, so it is not DynamoDB Local by mistake
+        '''
+        config = config or {}
+        # opt-in: the table read must be the one behind the serverless endpoint, which only the config can tell
+        self.bulk_existence_check = config.get('bulk_existence_check', False)
+        if self.bulk_existence_check and 'endpoint_url' not in config and serverless_url and not is_local_url(serverless_url):
+            raise Exception(f'DynamoDBConfigError: `dynamodb.bulk_existence_check` needs `dynamodb.endpoint_url` of the table behind {serverless_url}')
+        self.table_name = config.get('table', self.TABLE_NAME)
+        endpoint_url = config.get('endpoint_url', self.ENDPOINT_URL)
+        connection_kwargs = dict(
+            region_name=config.get('region', 'us-west-2'),
+            endpoint_url=endpoint_url
+        )
+        # DynamoDB Local takes any credentials, a table on AWS is read with the usual AWS credentials
+        if is_local_url(endpoint_url):
+            connection_kwargs.update(aws_access_key_id="anything", aws_secret_access_key="anything")
+        self.db = boto3.resource('dynamodb', **connection_kwargs).Table(self.table_name)
+        # the low-level client, thread-safe, for batch operations
+        self.client = boto3.client('dynamodb', **connection_kwargs)
+        self.key_attribute_names = None
 
         self.logger = logger
     
@@ -279,6 +613,88 @@ class DynamoDB:
         else:
             return None
     
+    def _get_key_attribute_names(self):
+        if self.key_attribute_names is None:
+            key_schema = self.client.describe_table(TableName=self.table_name)['Table']['KeySchema']
+            self.key_attribute_names = [key['AttributeName'] for key in key_schema]
+        return self.key_attribute_names
+
+    def _batch_get_page(self, keys):
+        '''
+            Returns the (item_type, PK) of `keys` that exist, retrying unprocessed keys with backoff
+        '''
+        existing = set()
+        request_items = {self.table_name: {
+            'Keys': keys,
+            # keys only, items themselves are not needed
+            'ProjectionExpression': '#pk, item_type',
+            'ExpressionAttributeNames': {'#pk': 'PK'}
+        }}
+        for attempt in range(BATCH_GET_MAX_ATTEMPTS):
+            res = self.client.batch_get_item(RequestItems=request_items)
+            for item in res['Responses'].get(self.table_name, []):
+                existing.add((item.get('item_type', {}).get('S'), item['PK']['S']))
+
+            request_items = res.get('UnprocessedKeys')
+            if not request_items:
+                return existing
+            time.sleep(min(0.05 * 2 ** attempt, 2))
+        raise Exception(f'BatchGetError: {len(request_items[self.table_name]["Keys"])} keys still unprocessed after {BATCH_GET_MAX_ATTEMPTS} attempts')
+
+    def batch_exists(self, items, threads=BATCH_GET_DEFAULT_THREADS) -> list:
+        '''
+            Same as `bool(self.get(item))` for each of `items`, but in 100-key `BatchGetItem` pages run in parallel.
+            Returns a list of bool in the order of `items`.
+        '''
+        items = list(items)
+        key_attribute_names = self._get_key_attribute_names()
+        if key_attribute_names != ['PK']:
+            # keys are not by PK alone, so they cannot be built from items; query one by one instead
+            self.logger.warn(f'table {self.table_name} keys are {key_attribute_names}, checking existence item by item')
+            with ThreadPoolExecutor(max_workers=threads) as executor:
+                return [bool(item) for item in executor.map(self.get, items)]
+
+        # a request may not have the same key twice
+        pks = list(dict.fromkeys(get_pk_or_rid(item) for item in items))
+        pages = [
+            [{'PK': {'S': pk}} for pk in pks[index:index + BATCH_GET_MAX_KEYS]]
+            for index in range(0, len(pks), BATCH_GET_MAX_KEYS)
+        ]
+        existing = set()
+        with ThreadPoolExecutor(max_workers=threads) as executor:
+            for page_existing in executor.map(self._batch_get_page, pages):
+                existing.update(page_existing)
+        self.logger.debug(f'BatchGetItem found {len(existing)} of {len(pks)} PKs in {len(pages)} pages')
+
+        # same as `get()`, the item has to be of the same item_type
+        return [(item['item_type'], get_pk_or_rid(item)) in existing for item in items]
+
+    def _batch_write_page(self, put_requests):
+        '''
+            Writes one BatchWriteItem page, retrying unprocessed items with backoff; returns the number of items written
+        '''
+        request_items = {self.table_name: put_requests}
+        for attempt in range(BATCH_WRITE_MAX_ATTEMPTS):
+            res = self.client.batch_write_item(RequestItems=request_items)
+            request_items = res.get('UnprocessedItems')
+            if not request_items:
+                return len(put_requests)
+            time.sleep(min(0.05 * 2 ** attempt, 2))
+        raise Exception(f'BatchWriteError: {len(request_items[self.table_name])} items still unprocessed after {BATCH_WRITE_MAX_ATTEMPTS} attempts')
+
+    def batch_put(self, dynamodb_items, threads=BATCH_WRITE_DEFAULT_THREADS) -> int:
+        '''
+            Puts items already in DynamoDB attribute value format (e.g. `{'PK': {'S': ...}}`)
+            in 25-item `BatchWriteItem` pages run in parallel. Returns the number of items written.
+        '''
+        dynamodb_items = list(dynamodb_items)
+        pages = [
+            [{'PutRequest': {'Item': dynamodb_item}} for dynamodb_item in dynamodb_items[index:index + BATCH_WRITE_MAX_ITEMS]]
+            for index in range(0, len(dynamodb_items), BATCH_WRITE_MAX_ITEMS)
+        ]
+        with ThreadPoolExecutor(max_workers=threads) as executor:
+            return sum(executor.map(self._batch_write_page, pages))
+
     def reset(self):
         path = pathlib.Path('../gci-vci-aws/gci-vci-serverless/.dynamodb/data/shared-local-instance.db')
         user_migrated_data_path = pathlib.Path(path.parent.parent.joinpath('data_backup/shared-local-instance__user_migrated.db'))
@@ -293,4 +709,35 @@ class DynamoDB:
         else:
             self.logger.error(f'Database reset failed: {path.absolute()} does not exist')
 
-DYNAMODB = DynamoDB(Logger)
\ No newline at end of file
+DYNAMODB = DynamoDB(Logger, config=config_data.get('dynamodb'), serverless_url=config_data['endpoint']['url'])
+
+def filter_not_in_db(parents, threads=CONCURRENT_GET_DEFAULT_THREADS, log=False) -> list:
+    '''
+        Returns `parents` that are not in db yet, i.e. those to POST.
+        Each parent is checked by a GET through serverless, or with `dynamodb: {bulk_existence_check: true}`,
+        by reading the DynamoDB table directly in batches.
+    '''
+    parents = list(parents)
+    if DYNAMODB.bulk_existence_check:
+        exists = DYNAMODB.batch_exists(parents, threads=threads)
+        not_in_db_parents = [parent for parent, parent_exists in zip(parents, exists) if not parent_exists]
+        if log:
+            Logger.info(f'BatchGetItem found {len(parents) - len(not_in_db_parents)} of {len(parents)} items in db')
+        return not_in_db_parents
+
+    get_results = SLS.concurrent_get(parents, threads=threads, include_parent_in_result=True, log=log, reduce_log_mod=100)
+    return [parent for get_result, parent in get_results if not get_result]
+
+def iter_not_in_db(parents, page_size=BATCH_GET_MAX_KEYS * BATCH_GET_DEFAULT_THREADS, log=False):
+    '''
+        Generator version of `filter_not_in_db`: reads `parents` (any iterable) a page at a time,
+        and yields those of each page not in db, e.g. to stream them into `Serverless.iter_concurrent_post`
+    '''
+    page = []
+    for parent in parents:
+        page.append(parent)
+        if len(page) >= page_size:
+            yield from filter_not_in_db(page, log=log)
+            page = []
+    if page:
+        yield from filter_not_in_db(page, log=log)
@@ -1,6 +1,11 @@
 import psycopg2
-import yaml
+import psycopg2.pool
 import os
+import re
+import uuid
+import time
+import threading
+from contextlib import contextmanager
 from custom_utils.logger import Logger
 from custom_utils.config import config_data
 
@@ -8,6 +13,12 @@ THIS_FILE_DIR = os.path.dirname(os.path.realpath(__file__))
 
 logger = Logger
 
+# the relation all fetch queries read from; point `db.relation` in config to the staging table
+# built by `build_staging_table.py` to get index lookups instead of evaluating the view
+SOURCE_RELATION = config_data.get('db', {}).get('relation', 'migrate_recent_items')
+if not re.match(r'^[A-Za-z_][A-Za-z0-9_.]*$', SOURCE_RELATION):
+    raise Exception(f'Bad db.relation `{SOURCE_RELATION}`')
+
 def getConnection(type='ec2'):
     logger.info('Getting connection object')
     if (type == 'local'):
@@ -24,4 +35,214 @@ def getConnection(type='ec2'):
                                 port=config_data['db']['ec2']['port'],
                                 database=config_data['db']['ec2']['database'])
     else:
-        raise Exception("Bad instance type")
\ No newline at end of file
+        raise Exception("Bad instance type")
+
+DEFAULT_POOL_MINCONN = 1
+DEFAULT_POOL_MAXCONN = 10
+# a connection idle longer than this is pinged before handing it out
+POOL_HEALTH_CHECK_INTERVAL_SECONDS = 60
+
+class ConnectionPool:
+    '''
+        Thread-safe pool of postgres connections.
+
+        Use `with pool.connection() as connection:`; a thread checks out one connection at a time,
+        so nested `connection()` in the same thread reuse it. On exit the transaction is rolled back
+        (commit explicitly if you write) and the connection goes back to the pool instead of being closed.
+    '''
+    def __init__(self, db_config, minconn=DEFAULT_POOL_MINCONN, maxconn=DEFAULT_POOL_MAXCONN):
+        self.pool = psycopg2.pool.ThreadedConnectionPool(minconn, maxconn,
+                                user=db_config['user'],
+                                password=db_config.get('password'),
+                                host=db_config['host'],
+                                port=db_config['port'],
+                                database=db_config['database'])
+        # psycopg2 pool raises when exhausted, so make threads wait for a free connection instead
+        self.available = threading.BoundedSemaphore(maxconn)
+        self.last_used_at = {}
+        self.local = threading.local()
+
+    def _is_healthy(self, connection):
+        if connection.closed:
+            return False
+        if time.monotonic() - self.last_used_at.get(id(connection), 0) < POOL_HEALTH_CHECK_INTERVAL_SECONDS:
+            return True
+        try:
+            cursor = connection.cursor()
+            cursor.execute('SELECT 1')
+            cursor.close()
+            connection.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    def _checkout(self):
+        self.available.acquire()
+        try:
+            return self._getconn()
+        except Exception:
+            self.available.release()
+            raise
+
+    def _getconn(self):
+        connection = self.pool.getconn()
+        while not self._is_healthy(connection):
+            logger.warn('discarding broken postgres connection from pool')
+            self.pool.putconn(connection, close=True)
+            connection = self.pool.getconn()
+        return connection
+
+    def _checkin(self, connection):
+        try:
+            self._putconn(connection)
+        finally:
+            self.available.release()
+
+    def _putconn(self, connection):
+        if connection.closed:
+            self.pool.putconn(connection, close=True)
+            return
+        try:
+            connection.rollback()
+        except psycopg2.Error:
+            self.pool.putconn(connection, close=True)
+            return
+        self.last_used_at[id(connection)] = time.monotonic()
+        self.pool.putconn(connection)
+
+    @contextmanager
+    def connection(self):
+        connection = getattr(self.local, 'connection', None)
+        if connection is not None:
+            yield connection
+            return
+
+        connection = self._checkout()
+        self.local.connection = connection
+        try:
+            yield connection
+        finally:
+            self.local.connection = None
+            self._checkin(connection)
+
+    def close(self):
+        self.pool.closeall()
+
+# (pid, type) -> ConnectionPool; keyed by pid since connections must not be shared across forked processes
+_pools = {}
+_pools_lock = threading.Lock()
+
+def get_pool(type='ec2', config=None):
+    '''
+        :param str type: `ec2` or `local`, the db config to connect with
+        :param dict config: config data to use instead of `config_recent.yaml`, e.g. the one passed to `migrate_all_gcivci.py`
+    '''
+    config = config or config_data
+    key = (os.getpid(), type)
+    with _pools_lock:
+        if key not in _pools:
+            if type not in ('local', 'ec2'):
+                raise Exception("Bad instance type")
+            pool_config = config['db'].get('pool', {})
+            logger.info(f'Creating {type} postgres connection pool')
+            _pools[key] = ConnectionPool(config['db'][type],
+                minconn=pool_config.get('minconn', DEFAULT_POOL_MINCONN),
+                maxconn=pool_config.get('maxconn', DEFAULT_POOL_MAXCONN)
+            )
+        return _pools[key]
+
+# rows fetched per network round-trip by a server-side cursor
+DEFAULT_ITERSIZE = 2000
+
+def stream_fetch(connection, sql_query, data, itersize=DEFAULT_ITERSIZE):
+    '''
+        Generator that yields rows one by one from a named (server-side) cursor,
+        so only `itersize` rows are held in client memory at a time.
+    '''
+    # named cursor is what makes psycopg2 use a server-side cursor
+    cursor = connection.cursor(name=f'stream_fetch_{uuid.uuid4().hex}')
+    cursor.itersize = itersize
+    try:
+        cursor.execute(sql_query, data)
+        for row in cursor:
+            yield row
+    finally:
+        cursor.close()
+
+# the lowest possible (rid, sid), i.e. the `after` cursor which starts from the very first row
+KEYSET_START = ('00000000-0000-0000-0000-000000000000', -1)
+DEFAULT_PAGE_SIZE = 1000
+
+# keyset-paginated equivalent of the `row_number() over(order by rid, sid)` queries for a single item_type
+KEYSET_ITEMS_QUERY = f'''
+    SELECT item_type, item, rid, sid
+    FROM {SOURCE_RELATION}
+    WHERE item_type=%s AND (rid, sid) > (%s, %s)
+    ORDER BY rid, sid
+'''
+
+def paginate_keyset(fetch_page, start=1, end=None, after=None, page_size=DEFAULT_PAGE_SIZE):
+    '''
+        The paging of `iter_keyset_pages` for any source of rows: `fetch_page(after, offset, limit)` returns one page
+        of rows after the `(rid, sid)` cursor `after`, ordered by rid, sid and with rid, sid as their last two columns.
+        Yields `(rows, after)` pages.
+    '''
+    start = max(start, 1)
+    remaining = None if end is None else end - start
+    offset = start - 1
+    after = tuple(after) if after else KEYSET_START
+
+    while remaining is None or remaining > 0:
+        limit = page_size if remaining is None else min(page_size, remaining)
+        rows = fetch_page(after, offset, limit)
+        if not rows:
+            return
+        after = tuple(rows[-1][-2:])
+        offset = 0
+        if remaining is not None:
+            remaining -= len(rows)
+
+        yield rows, after
+
+        if len(rows) < limit:
+            return
+
+def number_keyset_rows(pages, start=1):
+    '''
+        Yields the rows of `(rows, after)` pages in the `(item_type, rownum, item, ...)` shape of the
+        row_number() queries, with rid, sid dropped and rownum counted from `start`
+    '''
+    rownum = max(start, 1)
+    for rows, _ in pages:
+        for row in rows:
+            yield (row[0], rownum, *row[1:-2])
+            rownum += 1
+
+def iter_keyset_pages(connection, sql_query, data=(), start=1, end=None, after=None, page_size=DEFAULT_PAGE_SIZE):
+    '''
+        Generator of `(rows, after)` pages, paginated on (rid, sid) instead of row_number(),
+        so each page only costs its own rows rather than numbering the whole table again.
+
+        `sql_query` takes `data` followed by an after cursor `(rid, sid) > (%s, %s)` as its last params,
+        must `ORDER BY rid, sid`, and must select rid, sid as its last two columns. OFFSET / LIMIT are appended here.
+
+        `start` and `end` keep the `rownum >= start AND rownum < end` semantics of the row_number() queries,
+        counted from `after` if given. Rows before `start` are skipped once by the first page only.
+        Pass a yielded `after` back in to resume right after that page.
+    '''
+    def fetch_page(after, offset, limit):
+        cursor = connection.cursor()
+        try:
+            cursor.execute(f'{sql_query} OFFSET %s LIMIT %s', (*data, *after, offset, limit))
+            return cursor.fetchall()
+        finally:
+            cursor.close()
+
+    return paginate_keyset(fetch_page, start=start, end=end, after=after, page_size=page_size)
+
+def iter_keyset_rows(connection, sql_query, data=(), start=1, end=None, after=None, page_size=DEFAULT_PAGE_SIZE):
+    '''
+        Same as `iter_keyset_pages`, but yields rows in the `(item_type, rownum, item, ...)` shape of the
+        row_number() queries, with rid, sid dropped and rownum counted from `start`.
+    '''
+    return number_keyset_rows(iter_keyset_pages(connection, sql_query, data, start=start, end=end, after=after, page_size=page_size), start=start)
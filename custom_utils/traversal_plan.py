@@ -0,0 +1,43 @@
+import functools
+from collections import namedtuple
+
+# needs gci-vci-serverless installed, see `migrate_single_gdm.py`
+from src.models.item_type_serializer import ModelSerializer
+
+# `path` is `dot_representation` split once, for `get_path`
+RelationAccessor = namedtuple('RelationAccessor', ['path', 'dot_representation', 'related_item_type', 'is_plural'])
+
+# relational fields not in the serverless schema but which we traverse anyway.
+# gdm.annotations & gdm.variantPathogenicity are only patched here, not into the sls json schema for gdm,
+# since controller use it to populate field, and we don't want to populate gdm.annotations
+EXTRA_PLURAL_RELATIONS = {
+    'gdm': (('annotations', 'annotation'), ('variantPathogenicity', 'pathogenicity')),
+}
+
+@functools.lru_cache(maxsize=None)
+def get_traversal_plan(item_type, with_extra_relations=True):
+    '''
+        The relational fields of `item_type`, as a tuple of `RelationAccessor`, singular fields first.
+        Built from the serverless schema once per item_type, plus `EXTRA_PLURAL_RELATIONS` if `with_extra_relations`.
+    '''
+    Model = ModelSerializer._get_model(None, item_type)
+    singular_dot_representation_keys, plural_dot_representation_keys = Model.get_dot_representation_keys()
+
+    plan = []
+    for dot_representation in singular_dot_representation_keys:
+        plan.append(RelationAccessor(tuple(dot_representation.split('.')), dot_representation, Model.map_dot_representation_to_item_type[dot_representation], False))
+    for dot_representation in plural_dot_representation_keys:
+        plan.append(RelationAccessor(tuple(dot_representation.split('.')), dot_representation, Model.map_dot_representation_to_item_type[dot_representation], True))
+    for dot_representation, related_item_type in EXTRA_PLURAL_RELATIONS.get(item_type, ()) if with_extra_relations else ():
+        plan.append(RelationAccessor(tuple(dot_representation.split('.')), dot_representation, related_item_type, True))
+    return tuple(plan)
+
+def get_path(item, path, default=None):
+    '''
+        Same as `dictdeepget(item, dot_representation, default)`, with the path split already
+    '''
+    for key in path:
+        if not isinstance(item, dict) or key not in item:
+            return default
+        item = item[key]
+    return item
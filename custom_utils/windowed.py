@@ -0,0 +1,74 @@
+import asyncio
+import collections
+from concurrent.futures import wait, FIRST_COMPLETED
+
+def iter_windowed(submit, items, window, ordered=False):
+    '''
+        Calls `submit(item)`, which returns a `concurrent.futures.Future`, for each of `items`,
+        keeping at most `window` futures not yet yielded; the next item is only read once one is yielded,
+        so `items` can be a generator of any length and memory stays bounded.
+        `window` can also be a function returning the current window, e.g. `AdaptiveLimiter.get_limit`.
+        Yields `(item, done future)` as futures complete, or in the order of `items` if `ordered`.
+        Futures not yielded yet are cancelled if the generator is closed early.
+    '''
+    pending = collections.deque() if ordered else {}
+    try:
+        for item in items:
+            while pending and len(pending) >= _window_size(window):
+                yield from _take_done(pending, ordered)
+            future = submit(item)
+            if ordered:
+                pending.append((item, future))
+            else:
+                pending[future] = item
+        while pending:
+            yield from _take_done(pending, ordered)
+    finally:
+        for future in (future for _, future in pending) if ordered else pending:
+            future.cancel()
+
+def _window_size(window):
+    return window() if callable(window) else window
+
+def _take_done(pending, ordered):
+    if ordered:
+        item, future = pending.popleft()
+        # `result()` blocks until done; the caller reads it
+        wait([future])
+        yield item, future
+        return
+    done, _ = wait(pending, return_when=FIRST_COMPLETED)
+    for future in done:
+        yield pending.pop(future), future
+
+async def aiter_windowed(submit, items, window, ordered=False):
+    '''
+        Same as `iter_windowed` on the current event loop, with `submit(item)` returning an `asyncio.Future`
+    '''
+    pending = collections.deque() if ordered else {}
+    try:
+        for item in items:
+            while pending and len(pending) >= _window_size(window):
+                async for done in _atake_done(pending, ordered):
+                    yield done
+            future = submit(item)
+            if ordered:
+                pending.append((item, future))
+            else:
+                pending[future] = item
+        while pending:
+            async for done in _atake_done(pending, ordered):
+                yield done
+    finally:
+        for future in (future for _, future in pending) if ordered else pending:
+            future.cancel()
+
+async def _atake_done(pending, ordered):
+    if ordered:
+        item, future = pending.popleft()
+        await asyncio.wait([future])
+        yield item, future
+        return
+    done, _ = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+    for future in done:
+        yield pending.pop(future), future
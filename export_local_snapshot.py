@@ -0,0 +1,19 @@
+import sys
+from custom_utils.config import config_data
+from custom_utils.sql import get_pool
+from custom_utils.logger import Logger
+from custom_utils.local_snapshot import LocalSnapshot, DEFAULT_LOCAL_SNAPSHOT_FILENAME
+
+logger = Logger
+
+if __name__ == "__main__":
+    # usage: python export_local_snapshot.py [<sqlite file path>]
+    # defaults to `local_snapshot.path` in config, so the fetch paths pick it up right away
+    if len(sys.argv) > 1:
+        path = sys.argv[1]
+    else:
+        path = config_data.get('local_snapshot', {}).get('path', DEFAULT_LOCAL_SNAPSHOT_FILENAME)
+
+    logger.info(f'Exporting migrate_recent_items into {path}')
+    with get_pool().connection() as connection:
+        LocalSnapshot(path).export(connection)
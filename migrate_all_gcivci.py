@@ -9,16 +9,28 @@ import sys
 from requests_aws4auth import AWS4Auth
 from requests_futures.sessions import FuturesSession
 from concurrent.futures import ThreadPoolExecutor
-from concurrent.futures import as_completed
+from concurrent.futures import as_completed, wait, FIRST_COMPLETED
 import pathlib
 import traceback
 
 from error_tracker import ErrorTracker
+from custom_utils.sql import get_pool, stream_fetch, iter_keyset_rows, DEFAULT_ITERSIZE
+from custom_utils.local_snapshot import get_local_snapshot
+from custom_utils.serialization import dump_file, load_file
+from custom_utils.adaptive_limiter import AdaptiveLimiter
+
+# `transform()` needs extra columns from custom queries for these, so they cannot be read from local snapshot
+LOCAL_SNAPSHOT_UNSUPPORTED_ITEM_TYPES = ('custom', 'gdm', 'annotation', 'interpretation', 'curated-evidence')
+
+# how many POST requests per thread may be queued before we stop reading more rows
+PENDING_REQUESTS_PER_THREAD = 4
 
 error_tracker = ErrorTracker()
 
 class VariantMigrator:
-    RECORD_FILENAME = 'migrated_variant.json'
+    # encoded by the configured cache serializer, see `custom_utils.serialization`
+    RECORD_FILENAME = 'migrated_variant.cache'
+    LEGACY_RECORD_FILENAME = 'migrated_variant.json'
 
     def __init__(self):
         self.records = set()
@@ -27,17 +39,18 @@ class VariantMigrator:
     
     def read_from_json(self):
         p = pathlib.Path(self.RECORD_FILENAME)
+        if not p.is_file():
+            p = pathlib.Path(self.LEGACY_RECORD_FILENAME)
         if not p.is_file():
             return set()
-        with open(self.RECORD_FILENAME, 'r') as f:
-            records = json.load(f)
-            if not isinstance(records, list):
-                raise Exception('ReadJsonError: json content is not a list')
-            self.records = set(records)    
+        # `load_file` reads the legacy plain json file as well
+        records = load_file(p)
+        if not isinstance(records, list):
+            raise Exception('ReadJsonError: json content is not a list')
+        self.records = set(records)    
     
     def write_to_json(self):
-        with open(self.RECORD_FILENAME, 'w') as f:
-            json.dump(list(self.records), f)
+        dump_file(self.RECORD_FILENAME, list(self.records))
     
     def exists(self, variant_pk):
         return variant_pk in self.records
@@ -47,21 +60,6 @@ class VariantMigrator:
 
 variant_migrator = VariantMigrator()
 
-def getConnection(config_data,type):
-    if (type == 'local'):
-        return psycopg2.connect(user=config_data['db']['local']['user'],
-                                host=config_data['db']['local']['host'],
-                                port=config_data['db']['local']['port'],
-                                database=config_data['db']['local']['database'])
-    elif (type == 'ec2'):
-        return psycopg2.connect(user=config_data['db']['ec2']['user'],
-                                password=config_data['db']['ec2']['password'],
-                                host=config_data['db']['ec2']['host'],
-                                port=config_data['db']['ec2']['port'],
-                                database=config_data['db']['ec2']['database'])
-    else:
-        raise Exception("Bad instance type")
-
 def transform_gdm(row):
     post_data=json.dumps(row[2])
     gene_symbol=row[3]
@@ -188,10 +186,36 @@ def transform(row):
     
     return post_data  
 
+def handle_response(request, limiter=None):
+    response = request.result()
+    if limiter:
+        limiter.record(response.elapsed.total_seconds(), response.status_code)
+    status_code=str(response.status_code)
+    if (status_code != '201'):
+        error_message = 'End: ***Error***' + str(request.index) + " Status code " + str(status_code) + f' {response.text}' + '\nObject: ' + str(request.migrated_object_body) + '\n\n'
+        print(error_message)
+        error_tracker.log(error_message)
+        error_tracker.save()
+    else:
+        print('End: ' + str(request.index) + " Status code " + str(status_code))
+        variant_migrator.add(request.migrated_object_pk)
+        variant_migrator.write_to_json()
+
 def execute(items, base_url,threads):
-    print(f'INFO: got sql results {len(items)}, baseUrl={base_url}, threads={threads}, executing...\n')
+    '''
+        `items` can be any iterable of rows, e.g. a generator streaming from a server-side cursor;
+        at most a few requests per thread are in flight, so rows are not all held in memory at once.
+        With `threads` of `auto`, requests in flight adapt to what the endpoint sustains instead, see `AdaptiveLimiter`
+    '''
+    print(f'INFO: got sql results, baseUrl={base_url}, threads={threads}, executing...\n')
+    limiter = AdaptiveLimiter() if threads == 'auto' else None
+    if limiter:
+        threads = limiter.max_limit
+    max_pending_requests = limiter.get_limit if limiter else lambda: threads * PENDING_REQUESTS_PER_THREAD
+    items_count = 0
+    post_data = None
     try:
-        requests = []
+        pending_requests = set()
         print('INFO: dispatching FuturesSession...')
         session = FuturesSession(executor=ThreadPoolExecutor(max_workers=threads))
         print('INFO: authing AWS...')
@@ -199,8 +223,8 @@ def execute(items, base_url,threads):
             os.getenv('AWS_SECRET_ACCESS_KEY'),'us-west-2', \
                 'execute-api')
         info('execute')
-        print('Number of items = %s ' % len(items))
         for row in items:
+            items_count += 1
             item_type = row[0]
             item_counter=row[1]
             # if already processed, skip it
@@ -231,20 +255,16 @@ def execute(items, base_url,threads):
             request.index = item_counter
             request.migrated_object_body = body
             request.migrated_object_pk = pk
-            requests.append(request)
+            pending_requests.add(request)
+
+            # backpressure - wait for some requests to complete before reading more rows
+            while len(pending_requests) >= max_pending_requests():
+                done_requests, pending_requests = wait(pending_requests, return_when=FIRST_COMPLETED)
+                for request in done_requests:
+                    handle_response(request, limiter)
         
-        for request in as_completed(requests):
-            response = request.result()
-            status_code=str(response.status_code)
-            if (status_code != '201'):
-                error_message = 'End: ***Error***' + str(request.index) + " Status code " + str(status_code) + f' {response.text}' + '\nObject: ' + str(request.migrated_object_body) + '\n\n'
-                print(error_message)
-                error_tracker.log(error_message)
-                error_tracker.save()
-            else:
-                print('End: ' + str(request.index) + " Status code " + str(status_code))
-                variant_migrator.add(request.migrated_object_pk)
-                variant_migrator.write_to_json()
+        for request in as_completed(pending_requests):
+            handle_response(request, limiter)
 
         
     except psycopg2.Error as error:
@@ -257,7 +277,10 @@ def execute(items, base_url,threads):
         error_tracker.save()
         raise error
     
-    if len(items) != len(variant_migrator.records):
+    print('Number of items = %s ' % items_count)
+    if limiter:
+        print(f'INFO: {limiter.report()}')
+    if items_count != len(variant_migrator.records):
         print('WARNING: some records are not yet processed')
     else:
         print('INFO: all records in specified range are processed successfully!')
@@ -271,32 +294,49 @@ def info(title):
         print('parent process:', os.getppid())
     print('process id:', os.getpid())
 
-def chunk(sql, config_data, base_url,threads,data, inst_type):
+def chunk(sql, config_data, base_url,threads,data, inst_type, itersize=DEFAULT_ITERSIZE):
     print(f'INFO: getting postgres connection...\nconfig={config_data}\n\n')
-    connection = getConnection(config_data,inst_type)
-    print(f'INFO: connected to postgres...')
-    try:
-        cursor = connection.cursor()
-        print ("Query = %s data = %s" %(sql, data))
-        cursor.execute(sql,data)
-        items=cursor.fetchall()
-        execute(items,base_url,threads)
-        #print(items)
-    except (Exception, psycopg2.Error) as error:
-        print('Error while fetching data from PostgreSQL %s' %error)
-    finally:
-        connection.close()
+    with get_pool(inst_type, config=config_data).connection() as connection:
+        print(f'INFO: connected to postgres...')
+        try:
+            print ("Query = %s data = %s itersize = %s" %(sql, data, itersize))
+            # stream rows through a server-side cursor instead of fetchall()
+            items=stream_fetch(connection, sql, data, itersize=itersize)
+            execute(items,base_url,threads)
+            #print(items)
+        except (Exception, psycopg2.Error) as error:
+            print('Error while fetching data from PostgreSQL %s' %error)
+
+def keyset_chunk(sql, config_data, base_url,threads,data, inst_type, start, end, after=None, page_size=DEFAULT_ITERSIZE):
+    '''
+        Same as `chunk()`, but `sql` is a `keyset_queries` query paginated on (rid, sid), see `iter_keyset_pages`
+    '''
+    print(f'INFO: getting postgres connection...\nconfig={config_data}\n\n')
+    with get_pool(inst_type, config=config_data).connection() as connection:
+        print(f'INFO: connected to postgres...')
+        try:
+            print ("Query = %s data = %s start = %s end = %s after = %s page_size = %s" %(sql, data, start, end, after, page_size))
+            items=iter_keyset_rows(connection, sql, data, start=start, end=end, after=after, page_size=page_size)
+            execute(items,base_url,threads)
+        except (Exception, psycopg2.Error) as error:
+            print('Error while fetching data from PostgreSQL %s' %error)
 
 def main():
     if len(sys.argv) < 7:
-        print('Usage : python migrate.py <config_file> <#threads> <item_type> <start> <end> <inst_type>s')
+        print('Usage : python migrate.py <config_file> <#threads|auto> <item_type> <start> <end> <inst_type>s [<itersize>] [<after_rid>,<after_sid>]')
         sys.exit(1)
     file = sys.argv[1]
-    threads = int(sys.argv[2])
+    threads = sys.argv[2] if sys.argv[2] == 'auto' else int(sys.argv[2])
     item_type = sys.argv[3]
     start = int(sys.argv[4])
     end = int(sys.argv[5])
     inst_type = sys.argv[6]
+    itersize = int(sys.argv[7]) if len(sys.argv) > 7 else DEFAULT_ITERSIZE
+    # resume a keyset query right after this (rid, sid)
+    after = None
+    if len(sys.argv) > 8:
+        after_rid, after_sid = sys.argv[8].split(',')
+        after = (after_rid, int(after_sid))
     if (item_type == 'custom'):
         data=(start,end)
     else:
@@ -304,10 +344,28 @@ def main():
     with open(file, 'r') as stream:
         config_data = yaml.load(stream, Loader=yaml.FullLoader)
     base_url = config_data['endpoint']['url']
+
+    # the local snapshot only has the plain view rows, not the extra columns custom queries join for these item types
+    local_snapshot = get_local_snapshot(config_data)
+    if local_snapshot and item_type not in LOCAL_SNAPSHOT_UNSUPPORTED_ITEM_TYPES:
+        print(f'INFO: reading {item_type} from local snapshot {local_snapshot.filepath}...\n\n')
+        execute(local_snapshot.iter_keyset_rows(item_type, start=start, end=end, after=after, page_size=itersize), base_url, threads)
+        return
+
+    # keyset queries are preferred, since each page only costs its own rows,
+    # instead of row_number() over the whole result for every chunk
+    keyset_queries = config_data.get('keyset_queries')
+    if keyset_queries:
+        keyset_data = () if item_type == 'custom' else (item_type,)
+        for query in keyset_queries:
+            print(f'INFO: running keyset sql query...\n{query}\n\n')
+            keyset_chunk (query,config_data,base_url,threads,keyset_data, inst_type, start, end, after=after, page_size=itersize)
+        return
+
     queries = config_data['queries']
     for query in queries:
         print(f'INFO: running sql query...\n{query}\n\n')
         sql = query + " where rownum >= %s and rownum < %s "
-        chunk (sql,config_data,base_url,threads,data, inst_type)
+        chunk (sql,config_data,base_url,threads,data, inst_type, itersize=itersize)
 if __name__=='__main__':
     main()
\ No newline at end of file
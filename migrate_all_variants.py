@@ -1,97 +1,105 @@
 import pathlib
-import json
 import os
+import sys
 import traceback
 import psycopg2
-from custom_utils.sql import getConnection
+from custom_utils.sql import get_pool, SOURCE_RELATION, iter_keyset_pages, KEYSET_ITEMS_QUERY, DEFAULT_PAGE_SIZE
 from custom_utils.logger import Logger
-from custom_utils.sls import SLS, DYNAMODB
+from custom_utils.local_snapshot import LOCAL_SNAPSHOT
+from custom_utils.serialization import RecordFile, load_file
+from custom_utils.sls import SLS, DYNAMODB, filter_not_in_db, iter_not_in_db
+from custom_utils.bulk_load import bulk_load, check_against_reference, REFERENCE_COUNT
 
 THIS_FILE_DIR = os.path.dirname(os.path.realpath(__file__))
-LOCAL_VARIANT_CACHE_FILENAME = '.data/all_variants.json'
+LOCAL_VARIANT_CACHE_FILENAME = '.data/all_variants.records'
+LEGACY_LOCAL_VARIANT_CACHE_FILENAME = '.data/all_variants.json'
+NOT_IN_DB_VARIANTS_FILENAME = '.data/not_in_db_variants.records'
+LEGACY_NOT_IN_DB_VARIANTS_FILENAME = '.data/not_in_db_variants.json'
 
 logger = Logger
 sls = SLS
 db = DYNAMODB
 
 def get_total_variants_count() -> int:
-    connection = getConnection()
+    if LOCAL_SNAPSHOT:
+        return LOCAL_SNAPSHOT.count('variant')
 
     # check on total counts first, also testing connection
-    sql_query = 'SELECT COUNT(*) FROM migrate_recent_items WHERE item_type=%s'
+    sql_query = f'SELECT COUNT(*) FROM {SOURCE_RELATION} WHERE item_type=%s'
     data = ('variant',)
-    try:
-        logger.debug('Getting cursor...')
-        cursor = connection.cursor()
-        logger.info(f'executing query to count...')
-        cursor.execute(sql_query, data)
-        results = cursor.fetchone()
-    except psycopg2.Error as error:
-        traceback.print_exc()
-        print('Error while counting data from PostgreSQL: %s' % error)
-        # postgres will abort following transaction anyways, so just close it
-        connection.close()
-        raise
+    with get_pool().connection() as connection:
+        try:
+            logger.debug('Getting cursor...')
+            cursor = connection.cursor()
+            logger.info(f'executing query to count...')
+            cursor.execute(sql_query, data)
+            results = cursor.fetchone()
+        except psycopg2.Error as error:
+            traceback.print_exc()
+            print('Error while counting data from PostgreSQL: %s' % error)
+            raise
     logger.info(f'Counted all variants in postgres: {results}')
 
     return results[0]
 
-def sql_fetch_all_variants_from_pg(start=0, end=15) -> list:
-    connection = getConnection()
-
-    # prepare sql 
-    sql_query = '''
-        SELECT item_type, rownum, item FROM (
-            SELECT row_number() over(order by rid, sid) as rownum,
-            item_type, 
-            item
-            FROM migrate_recent_items 
-            WHERE item_type=%s
-        )a
-
-        WHERE rownum >= %s AND rownum < %s
+def iter_variants_from_pg(start=0, end=15, page_size=DEFAULT_PAGE_SIZE, after=None):
+    '''
+        Generator of variant objects in range [start, end), fetched page by page on (rid, sid)
+        so client memory stays flat, and later pages are not slower than earlier ones.
+        Pass `after` (a (rid, sid) cursor logged per page) to resume from where a previous run stopped.
     '''
-    data = ('variant', start, end)
-    
+    if LOCAL_SNAPSHOT:
+        for rows, after in LOCAL_SNAPSHOT.iter_keyset_pages('variant', start=start, end=end, after=after, page_size=page_size):
+            logger.debug(f'fetched page of {len(rows)} variants from local snapshot, resume cursor after={after}')
+            for row in rows:
+                yield row[1]['body']
+        return
+
     # fetch sql, receive variant objects
-    try:
-        logger.debug('Getting cursor')
-        cursor = connection.cursor()
-        logger.info(f'executing query for fetch...')
-        cursor.execute(sql_query, data)
-        items = cursor.fetchall()
-        objects = list(map(lambda item: item[2]['body'], items))
-        return objects
-    except psycopg2.Error as error:
-        traceback.print_exc()
-        print('Error while fetching data from PostgreSQL: %s' % error)
-        # postgres will abort following transaction anyways, so just close it
-        connection.close()
-        raise
-
-    return []
-
-def post_all_variants_to_sls(variants: list) -> None:
+    with get_pool().connection() as connection:
+        try:
+            logger.info(f'executing query for fetch...')
+            for rows, after in iter_keyset_pages(connection, KEYSET_ITEMS_QUERY, ('variant',), start=start, end=end, after=after, page_size=page_size):
+                logger.debug(f'fetched page of {len(rows)} variants, resume cursor after={after}')
+                for row in rows:
+                    yield row[1]['body']
+        except psycopg2.Error as error:
+            traceback.print_exc()
+            print('Error while fetching data from PostgreSQL: %s' % error)
+            raise
+
+def open_variant_record_file(filename, legacy_filename):
+    '''
+        Opens a variant cache `RecordFile` keyed by rid, importing the json list file of earlier versions if there is one
+    '''
+    record_file = RecordFile(filename)
+    legacy_file = pathlib.Path(legacy_filename)
+    if not record_file.filepath.exists() and legacy_file.exists():
+        logger.info(f'importing legacy variant cache {legacy_file}')
+        record_file.write((variant['rid'], variant) for variant in load_file(legacy_file))
+    return record_file
+
+def post_all_variants_to_sls(variants, variants_count: int) -> None:
+    '''
+    :param variants: any iterable, e.g. decoded lazily from the local variant cache, read once a page at a time
+    '''
     # come up with a list of variants that is not in DB, so we know only to POST them (GET is much faster than POST)
-    cached_not_in_db_parents_file = pathlib.Path('.data/not_in_db_variants.json')
-    if cached_not_in_db_parents_file.exists():
-        with cached_not_in_db_parents_file.open('r') as f:
-            not_in_db_parents = json.load(f)
-    else:
+    cached_not_in_db_parents_file = open_variant_record_file(NOT_IN_DB_VARIANTS_FILENAME, LEGACY_NOT_IN_DB_VARIANTS_FILENAME)
+    if not cached_not_in_db_parents_file.filepath.exists():
         # get first to see if not in db first
         logger.info('Getting all variants, so we can come up with a list to POST')
-        get_results = sls.concurrent_get(variants, include_parent_in_result=True, log=True, reduce_log_mod=100)
-
-        not_in_db_parents = [parent for get_result, parent in get_results if not get_result]
-        # not_in_db_parents = variants
-
-        with cached_not_in_db_parents_file.open('w+') as f:
-            json.dump(not_in_db_parents, f, indent=2)
+        # written atomically, so an interrupted check is redone rather than taken for the complete list
+        cached_not_in_db_parents_file.write((parent['rid'], parent) for parent in iter_not_in_db(variants, log=True))
+    not_in_db_count = len(cached_not_in_db_parents_file)
 
     # only POST to those not in db
-    logger.info(f'Planning to POST {len(not_in_db_parents)} out of {len(variants)} records (pre-checked by GET)')
-    logger.info(f'Will batch POST {len(not_in_db_parents)} items to db...')
-    post_results = sls.concurrent_post(not_in_db_parents, raise_http_error=False, log=True)
+    logger.info(f'Planning to POST {not_in_db_count} out of {variants_count} records (pre-checked by GET)')
+    logger.info(f'Will batch POST {not_in_db_count} items to db...')
+    # variants are decoded from the file as the POST window frees up, and responses are handled as they come in
+    # rather than kept, failures are logged to `sls.POST_ERROR_LOG_FILE`
+    failed_count = sum(1 for res in sls.iter_concurrent_post(cached_not_in_db_parents_file.values(), raise_http_error=False, log=True) if res is not None and not res.ok)
+    logger.info(f'POSTed {not_in_db_count} variants, {failed_count} failed')
+    logger.info(f'connection reuse: {sls.connection_stats()}')
 
 def fetch_then_post_all_variants():
     # total_variants_count = get_total_variants_count()
@@ -100,25 +108,81 @@ def fetch_then_post_all_variants():
     fetch_variant_count_goal = total_variants_count if fetch_variant_count_goal > total_variants_count else fetch_variant_count_goal
 
     # remember to cache or get from cache
-    migrate_variants = []
-    local_variant_cache_file = pathlib.Path(f'{THIS_FILE_DIR}/{LOCAL_VARIANT_CACHE_FILENAME}')
-    if local_variant_cache_file.exists():
-        with local_variant_cache_file.open('r') as f:
-            migrate_variants = json.load(f)
+    # counting cached variants only reads the record index, nothing is decoded until posting
+    local_variant_cache_file = open_variant_record_file(f'{THIS_FILE_DIR}/{LOCAL_VARIANT_CACHE_FILENAME}', f'{THIS_FILE_DIR}/{LEGACY_LOCAL_VARIANT_CACHE_FILENAME}')
 
     # if cached variant less than total, then 
-    cached_variants_count = len(migrate_variants)
+    cached_variants_count = len(local_variant_cache_file)
     if cached_variants_count < fetch_variant_count_goal:
         logger.info(f'cached variant [0,{cached_variants_count-1}], sql fetching [{cached_variants_count}, {fetch_variant_count_goal}) total count goal {fetch_variant_count_goal}')
-        migrate_variants = [*migrate_variants, *sql_fetch_all_variants_from_pg(cached_variants_count, fetch_variant_count_goal)]
-        logger.info('Writing variants into cache...')
-        with local_variant_cache_file.open('w+') as f:
-            json.dump(migrate_variants, f)
+        # appended as they stream in, so an interrupted fetch keeps what it got
+        local_variant_cache_file.append((variant['rid'], variant) for variant in iter_variants_from_pg(cached_variants_count, fetch_variant_count_goal))
     else:
         logger.info('All variants cached! Skip sql fetching')
 
-    post_all_variants_to_sls(migrate_variants)
+    post_all_variants_to_sls(local_variant_cache_file.values(), len(local_variant_cache_file))
+
+def stream_then_post_all_variants(start=0, end=17070, page_size=DEFAULT_PAGE_SIZE, after=None):
+    '''
+        Same as `fetch_then_post_all_variants`, but streams end to end without holding all variants in memory:
+        variants streamed from postgres are checked a page at a time, and those not in db are POSTed as the POST window frees up,
+        so at most a page of variants plus the requests in flight are held at once.
+        Does not read or write the local variant cache.
+    '''
+    not_in_db_variants = iter_not_in_db(iter_variants_from_pg(start, end, page_size=page_size, after=after), page_size=page_size)
+    posted_count, failed_count = 0, 0
+    for res in sls.iter_concurrent_post(not_in_db_variants, raise_http_error=False, log=True):
+        posted_count += 1
+        if res is not None and not res.ok:
+            failed_count += 1
+    logger.info(f'POSTed {posted_count} variants, {failed_count} failed')
+    logger.info(f'connection reuse: {sls.connection_stats()}')
+
+def bulk_load_all_variants(start=0, end=17070, page_size=DEFAULT_PAGE_SIZE, after=None):
+    '''
+        Same as `stream_then_post_all_variants`, but writes each batch straight into the DynamoDB table
+        by `BatchWriteItem` instead of POSTing through serverless, then verifies the batch is in the table.
+        The first variants not in db are POSTed through serverless as references, see `check_against_reference`.
+        Only for an empty or trusted table: unlike a POST, nothing is validated by the serverless controller.
+    '''
+    loaded_count = 0
+    # fields the controller adds, known once the reference variants are POSTed
+    controller_fields = None
+    batch = []
+    for variant in iter_variants_from_pg(start, end, page_size=page_size, after=after):
+        batch.append(variant)
+        if len(batch) >= page_size:
+            batch_count, controller_fields = bulk_load_variant_batch(batch, controller_fields)
+            loaded_count += batch_count
+            batch = []
+    if batch:
+        batch_count, controller_fields = bulk_load_variant_batch(batch, controller_fields)
+        loaded_count += batch_count
+    logger.info(f'Bulk loaded {loaded_count} variants')
+
+def bulk_load_variant_batch(variants: list, controller_fields=None):
+    '''
+        Returns the number of variants loaded, and `controller_fields` for the next batch
+    '''
+    not_in_db_parents = filter_not_in_db(variants)
+    logger.info(f'Planning to bulk load {len(not_in_db_parents)} out of {len(variants)} records in batch')
+    if controller_fields is None:
+        if len(not_in_db_parents) < REFERENCE_COUNT:
+            # too few to learn from, POST them through serverless as usual
+            for parent in not_in_db_parents:
+                sls.post(parent)
+            return len(not_in_db_parents), None
+        controller_fields = check_against_reference(not_in_db_parents[:REFERENCE_COUNT], db)
+        return REFERENCE_COUNT + bulk_load(not_in_db_parents[REFERENCE_COUNT:], controller_fields, db), controller_fields
+    return bulk_load(not_in_db_parents, controller_fields, db), controller_fields
 
 if __name__ == "__main__":
     # db.reset()
-    fetch_then_post_all_variants()
\ No newline at end of file
+    # `--bulk-load` writes variants straight into DynamoDB instead of POSTing through serverless,
+    # `--stream` POSTs variants as they stream from postgres, without the local variant cache
+    if '--bulk-load' in sys.argv[1:]:
+        bulk_load_all_variants()
+    elif '--stream' in sys.argv[1:]:
+        stream_then_post_all_variants()
+    else:
+        fetch_then_post_all_variants()
\ No newline at end of file
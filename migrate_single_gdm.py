@@ -3,53 +3,170 @@ import yaml
 import json
 import copy
 import pathlib
+import re
+import os
+import sys
+import contextlib
+import uuid
+import datetime
+import traceback
+from time import perf_counter
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from custom_utils.config import config_data
-from custom_utils.sql import getConnection
+from custom_utils.sql import get_pool, SOURCE_RELATION
+from custom_utils.local_snapshot import LOCAL_SNAPSHOT
+from custom_utils.object_cache import SHARED_OBJECT_CACHE
 from custom_utils.logger import Logger
 from custom_utils.object_store import ObjectStoreManager
-from custom_utils.sls import SLS, DYNAMODB
-from custom_utils.relation_linkage import RelationLinkageTransformer, get_pk_or_rid, is_snapshot, get_item_type
+from custom_utils.sls import SLS, DYNAMODB, filter_not_in_db, CONCURRENT_GET_DEFAULT_THREADS
+from custom_utils.adaptive_limiter import AdaptiveLimiter
+from custom_utils.relation_linkage import RelationLinkageTransformer, LINKAGE_TRANSFORM, get_pk_or_rid, is_snapshot, get_item_type
+from custom_utils.traversal_plan import get_traversal_plan, get_path
 
 # needs to acticate venv, navigate to `gci-vci-serverless/src`, create a setup.py with content below, and run `pip install .`
 # from setuptools import setup, find_packages
 # setup(name='gcivcisls', version='1.0', packages=find_packages())
-from src.models.schema_reader import is_singular_relational_field, is_plural_relational_field, parse_schema_string
-from src.models.item_type_serializer import ModelSerializer
-from src.utils.dict import dictdeepget
+
+THIS_FILE_DIR = os.path.dirname(os.path.realpath(__file__))
 
 logger = Logger
 sls = SLS
 db = DYNAMODB
 
-def sql_fetchall(item_type, rid, connection):
-    if not (isinstance(item_type, str) and isinstance(rid, str)):
-        raise Exception(f'SQLFetchAllError: invalid arg type, item_type={item_type}, rid={rid}')
-
-    data = (item_type, rid)
-    sql_query = '''
-        SELECT item_type, rownum, item FROM (
-            SELECT row_number() over(order by rid, sid) as rownum,
-            item_type, 
-            item
-            FROM migrate_recent_items 
-            WHERE item_type=%s AND rid=%s
-        )a
+def sql_fetchall_by_rids(item_type, rids, connection):
+    '''
+        Fetch all objects of one item_type whose rid is in `rids` in a single round-trip.
+        Returns a dict of rid -> (object, sid).
+    '''
+    if not (isinstance(item_type, str) and all(isinstance(rid, str) for rid in rids)):
+        raise Exception(f'SQLFetchAllError: invalid arg type, item_type={item_type}, rids={rids}')
+
+    data = (item_type, list(rids))
+    sql_query = f'''
+        SELECT item_type, item, sid
+        FROM {SOURCE_RELATION}
+        WHERE item_type=%s AND rid = ANY(%s::uuid[])
     '''
 
     try:
         logger.debug('Getting cursor')
         cursor = connection.cursor()
-        logger.info(f'executing query {item_type}...')
+        logger.info(f'executing query {item_type} for {len(data[1])} rids...')
+        cursor.execute(sql_query, data)
+        objects_by_rid = {}
+        for item in cursor.fetchall():
+            parent = item[1]['body']
+            if parent['rid'] in objects_by_rid:
+                raise Exception(f'{item_type} queried by PK/rid `{parent["rid"]}` but returned more than one')
+            objects_by_rid[parent['rid']] = (parent, item[2])
+        return objects_by_rid
+    except psycopg2.Error as error:
+        print('Error while fetching data from PostgreSQL: %s' % error)
+        # postgres will abort following transaction anyways, so roll it back;
+        # the pool reuses the connection instead of reconnecting
+        connection.rollback()
+        raise
+
+def sql_fetch_sids(keys, connection):
+    '''
+        Fetch the current sid (propsheet version) of every (item_type, rid) in `keys` in a single round-trip.
+        Returns a dict of (item_type, rid) -> sid; keys that no longer exist are left out.
+    '''
+    keys = list(keys)
+    data = ([item_type for item_type, _ in keys], [rid for _, rid in keys])
+    sql_query = f'''
+        SELECT item_type, rid::text, sid
+        FROM {SOURCE_RELATION}
+        WHERE (item_type, rid) IN (SELECT * FROM unnest(%s::text[], %s::uuid[]))
+    '''
+
+    try:
+        cursor = connection.cursor()
+        logger.info(f'executing query sids of {len(keys)} objects...')
         cursor.execute(sql_query, data)
-        items = cursor.fetchall()
-        objects = list(map(lambda item: item[2]['body'], items))
-        return objects
+        return {(item_type, rid): sid for item_type, rid, sid in cursor.fetchall()}
     except psycopg2.Error as error:
         print('Error while fetching data from PostgreSQL: %s' % error)
-        # postgres will abort following transaction anyways, so just close it
-        connection.close()
+        connection.rollback()
         raise
 
+UUID_REGEX = '^[0-9a-fA-F]{8}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{12}$'
+
+def _sql_text_literal(value):
+    # only schema-derived names (item_type, field names) are inlined into sql, so be strict about them
+    if not re.match(r'^[A-Za-z0-9_@-]+$', value):
+        raise Exception(f'SQLQueryBuildError: refuse to inline `{value}` into sql')
+    return f"'{value}'"
+
+def get_relation_edges(root_item_type='gdm'):
+    '''
+        Walk the serverless schema from `root_item_type` and list every relational field reachable from it,
+        as tuples of (parent_item_type, dot_representation, related_item_type, is_plural)
+    '''
+    edges = []
+    item_types_to_visit = [root_item_type]
+    visited_item_types = set()
+    while item_types_to_visit:
+        item_type = item_types_to_visit.pop()
+        if item_type in visited_item_types:
+            continue
+        visited_item_types.add(item_type)
+
+        # same plan as the client-side traverse, including the patch for gdm.annotations & gdm.variantPathogenicity
+        for relation in get_traversal_plan(item_type):
+            edges.append((item_type, relation.dot_representation, relation.related_item_type, relation.is_plural))
+            item_types_to_visit.append(relation.related_item_type)
+
+    return edges
+
+def build_related_objects_query(root_item_type='gdm'):
+    '''
+        Generates a recursive CTE over `migrate_recent_items` (or the configured `SOURCE_RELATION`) which returns every object reachable from
+        a single `root_item_type` rid (the only query parameter), following the same relational fields
+        as `visit_related_object` does.
+    '''
+    edge_queries = []
+    for parent_item_type, dot_representation, related_item_type, is_plural in get_relation_edges(root_item_type):
+        json_path = "'{" + ','.join(['body', *[_sql_text_literal(key)[1:-1] for key in dot_representation.split('.')]]) + "}'"
+        if is_plural:
+            # array items are either rid strings, or embedded snapshots which we refer by uuid
+            edge_queries.append(f'''
+                SELECT {_sql_text_literal(related_item_type)} AS item_type,
+                    CASE jsonb_typeof(e.value) WHEN 'string' THEN e.value #>> '{{}}' WHEN 'object' THEN e.value ->> 'uuid' END AS ref
+                FROM jsonb_array_elements(
+                    CASE WHEN jsonb_typeof(p.item #> {json_path}) = 'array' THEN p.item #> {json_path} ELSE '[]'::jsonb END
+                ) e
+                WHERE p.item_type = {_sql_text_literal(parent_item_type)}''')
+        else:
+            edge_queries.append(f'''
+                SELECT {_sql_text_literal(related_item_type)} AS item_type, p.item #>> {json_path} AS ref
+                WHERE p.item_type = {_sql_text_literal(parent_item_type)}''')
+
+    edges_query = '\n                UNION ALL'.join(edge_queries)
+    return f'''
+        WITH RECURSIVE related(item_type, rid) AS (
+            SELECT {_sql_text_literal(root_item_type)}::varchar, %s::uuid
+          UNION
+            SELECT m.item_type, m.rid
+            FROM related r
+            JOIN {SOURCE_RELATION} p ON p.item_type = r.item_type AND p.rid = r.rid
+            CROSS JOIN LATERAL ({edges_query}
+            ) e
+            JOIN {SOURCE_RELATION} m ON m.item_type = e.item_type
+                AND m.rid = (CASE WHEN e.ref ~ '{UUID_REGEX}' THEN e.ref::uuid END)
+        )
+        SELECT m.item_type, m.item, m.sid
+        FROM related r
+        JOIN {SOURCE_RELATION} m ON m.item_type = r.item_type AND m.rid = r.rid
+    '''
+
+def is_uuid(value):
+    try:
+        uuid.UUID(value)
+        return True
+    except ValueError:
+        return False
+
 def generic_transformation(gdm_rid, parent, item_type=None):
     new_parent = {**parent}
 
@@ -96,30 +213,169 @@ def generic_transformation(gdm_rid, parent, item_type=None):
             local_parent['item_type'] = get_item_type(local_parent)
             local_parent['PK'] = get_pk_or_rid(local_parent)
 
-            Model = ModelSerializer._get_model(None, local_parent['item_type'])
-            singular_dot_representation_keys, plural_dot_representation_keys = Model.get_dot_representation_keys()
-            for dot_representation in singular_dot_representation_keys:
-                stack.append(dictdeepget(local_parent, dot_representation))
-            for dot_representation in plural_dot_representation_keys:
-                stack.extend(dictdeepget(local_parent, dot_representation, []))
+            # annotations of the gdm are added above, only for the top level gdm
+            for relation in get_traversal_plan(local_parent['item_type'], with_extra_relations=False):
+                if relation.is_plural:
+                    stack.extend(get_path(local_parent, relation.path) or [])
+                else:
+                    related_object = get_path(local_parent, relation.path)
+                    if related_object:
+                        stack.append(related_object)
                     
     return new_parent
 
-def collect_gdm_related_objects(gdm_rid, object_store_manager, relation_linkage_transformer):
-    connection = None
+# `dfs` fetches one object per sql round-trip;
+# `batched` walks the relation graph level by level, and fetches each level with one query per item_type;
+# `server` lets postgres walk the whole relation graph in one recursive query
+COLLECT_MODE_DFS = 'dfs'
+COLLECT_MODE_BATCHED = 'batched'
+COLLECT_MODE_SERVER = 'server'
+
+def collect_gdm_related_objects(gdm_rid, object_store_manager, relation_linkage_transformer, mode=COLLECT_MODE_DFS, roots=None):
+    '''
+    :param list roots: object metas `{item_type, rid}` to start traversing from, besides the gdm itself;
+        e.g. objects dropped by `refresh_changed_objects`, which their (already transformed) referrers no longer lead to
+    '''
+    roots = [{'item_type': 'gdm', 'rid': gdm_rid}, *(roots or [])]
+    if mode == COLLECT_MODE_DFS:
+        _collect_depth_first(gdm_rid, object_store_manager, relation_linkage_transformer, roots)
+    elif mode == COLLECT_MODE_BATCHED:
+        _collect_level_by_level(gdm_rid, object_store_manager, relation_linkage_transformer, roots)
+    elif mode == COLLECT_MODE_SERVER:
+        _collect_server_side(gdm_rid, object_store_manager, relation_linkage_transformer, roots)
+    else:
+        raise Exception(f'CollectError: unknown collect mode `{mode}`')
+
+    logger.info('saving all sql process results to file...')
+    object_store_manager.save()
+
+def get_visit_keys(item_type, parent):
+    '''
+        An object can be referred to by its rid, uuid, PK, or (once relation links are transformed) its LINKAGE_TRANSFORM field,
+        so all of them identify the object as visited.
+    '''
+    keys = set((item_type, parent[field_name]) for field_name in ('rid', 'uuid', 'PK') if parent.get(field_name))
+    if item_type in LINKAGE_TRANSFORM and parent.get(LINKAGE_TRANSFORM[item_type]):
+        keys.add((item_type, parent[LINKAGE_TRANSFORM[item_type]]))
+    return keys
+
+# objects fetched are written to the shared object cache this many per item_type at a time, one sqlite transaction each
+SHARED_OBJECT_CACHE_BATCH_SIZE = 500
+
+class RelatedObjectFetcher:
+    '''
+        Fetches objects by rid for a gdm's collection: from the shared object cache first, if their sid is still current at source,
+        then from local snapshot or postgres, checking out a pooled connection only when needed.
+        The sid each object was fetched at is kept in `sids` for the object store.
+        Fetched objects are written to the shared object cache in batches, the rest once `connection_context` exits.
+    '''
+    def __init__(self, gdm_rid, connection_context):
+        self.gdm_rid = gdm_rid
+        self.connection_context = connection_context
+        self.connection = None
+        # (item_type, rid) -> sid
+        self.sids = {}
+        # item_type -> {rid: (object, sid)} not written to the shared object cache yet
+        self.to_share = {}
+        connection_context.callback(self.share_fetched)
+
+    def _get_connection(self):
+        if not self.connection:
+            self.connection = self.connection_context.enter_context(get_pool().connection())
+        return self.connection
+
+    def fetch_by_rids(self, item_type, rids):
+        '''
+            Returns a dict of rid -> object; rids that do not exist are left out
+        '''
+        rids = set(rids)
+        # rid -> (object, sid)
+        fetched_by_rid = self._fetch_current_from_cache(item_type, rids) if SHARED_OBJECT_CACHE else {}
+        missing_rids = rids - fetched_by_rid.keys()
+
+        if missing_rids:
+            if LOCAL_SNAPSHOT:
+                fetched = LOCAL_SNAPSHOT.fetch_by_rids(item_type, missing_rids)
+            else:
+                fetched = sql_fetchall_by_rids(item_type, missing_rids, self._get_connection())
+
+            if SHARED_OBJECT_CACHE and fetched:
+                self._share(item_type, fetched)
+            fetched_by_rid.update(fetched)
+
+        objects_by_rid = {}
+        for rid, (parent, sid) in fetched_by_rid.items():
+            objects_by_rid[rid] = parent
+            self.sids[(item_type, rid)] = sid
+        return objects_by_rid
+
+    def _share(self, item_type, fetched):
+        to_share = self.to_share.setdefault(item_type, {})
+        for rid, (parent, sid) in fetched.items():
+            # copied, objects are transformed in place once visited
+            to_share[rid] = (copy.deepcopy(parent), sid)
+        if len(to_share) >= SHARED_OBJECT_CACHE_BATCH_SIZE:
+            SHARED_OBJECT_CACHE.put_many(item_type, self.to_share.pop(item_type))
+
+    def share_fetched(self):
+        '''
+            Writes the fetched objects not written yet to the shared object cache
+        '''
+        for item_type, to_share in self.to_share.items():
+            SHARED_OBJECT_CACHE.put_many(item_type, to_share)
+        self.to_share = {}
+
+    def _fetch_current_from_cache(self, item_type, rids):
+        '''
+            Returns rid -> (object, sid) of cached objects whose sid is still the current one at source,
+            since the cache may hold objects fetched by an earlier dump; the others are dropped from cache to fetch again
+        '''
+        cached_by_rid = SHARED_OBJECT_CACHE.get_many(item_type, rids)
+        if not cached_by_rid:
+            return {}
+        current_sids = self.fetch_sids([(item_type, rid) for rid in cached_by_rid])
+        stale_rids = [rid for rid, (_, sid) in cached_by_rid.items() if sid is None or current_sids.get((item_type, rid)) != sid]
+        if stale_rids:
+            logger.debug(f'{len(stale_rids)} of {len(cached_by_rid)} cached {item_type} changed at source, fetching them again')
+            SHARED_OBJECT_CACHE.invalidate(item_type, stale_rids)
+            for rid in stale_rids:
+                del cached_by_rid[rid]
+        return cached_by_rid
+
+    def fetch_sids(self, keys):
+        '''
+            Returns a dict of (item_type, rid) -> current sid for `keys` that still exist at source
+        '''
+        if not LOCAL_SNAPSHOT:
+            return sql_fetch_sids(keys, self._get_connection())
+
+        rids_by_item_type = {}
+        for item_type, rid in keys:
+            rids_by_item_type.setdefault(item_type, []).append(rid)
+        sids = {}
+        for item_type, rids in rids_by_item_type.items():
+            sids.update({(item_type, rid): sid for rid, sid in LOCAL_SNAPSHOT.fetch_sids(item_type, rids).items()})
+        return sids
+
+def _collect_depth_first(gdm_rid, object_store_manager, relation_linkage_transformer, roots):
+    with contextlib.ExitStack() as connection_context:
+        _collect_depth_first_with(gdm_rid, object_store_manager, relation_linkage_transformer, roots, connection_context)
+
+def _collect_depth_first_with(gdm_rid, object_store_manager, relation_linkage_transformer, roots, connection_context):
+    fetcher = RelatedObjectFetcher(gdm_rid, connection_context)
+    # (item_type, rid) already expanded, so each object is visited exactly once
+    visited = set()
 
     # a dfs traverse through the relation graph
-    store = {}
-    object_stack = [{
-        'item_type': 'gdm',
-        'rid': gdm_rid
-    }]
+    object_stack = list(reversed(roots))
 
     processed_counter = 0
     while object_stack:
         object_meta = object_stack.pop()
         item_type = object_meta['item_type']
         related_rid = object_meta['rid']
+        if (item_type, related_rid) in visited:
+            continue
         # in case the parent is embedded directly on its ancestor, like snapshot (in legacy db)
         parent = object_meta.get('object')
 
@@ -127,22 +383,15 @@ def collect_gdm_related_objects(gdm_rid, object_store_manager, relation_linkage_
             parent = object_store_manager.get(item_type, related_rid)
             logger.debug(f'Found in store so reuse: {item_type} {related_rid}')
         elif not parent:
-            # fetch object from postgres
-            try:
-                if not connection:
-                    connection = getConnection()
-                items = sql_fetchall(item_type, related_rid, connection)
-            except psycopg2.Error as error:
-                if 'invalid input syntax for type uuid' in str(error):
-                    # means relation links are transformed -
-                    # since we only do transform after collecting all related objects
-                    # this means objects are already cached by object store manager
-                    # hence no need to sql fetch
-                    logger.info(f'sql processed #{processed_counter} (skipped due to relation link already transformed)')
-                    connection = getConnection()
-                    continue
-                raise
+            # a non-uuid reference means relation links are transformed -
+            # since we only do transform after collecting all related objects
+            # this means objects are already cached by object store manager
+            # hence no need to sql fetch
+            if not is_uuid(related_rid):
+                logger.info(f'sql processed #{processed_counter} (skipped due to relation link already transformed)')
+                continue
 
+            items = list(fetcher.fetch_by_rids(item_type, [related_rid]).values())
             if len(items) != 1:
                 raise Exception(f'{item_type} queried by PK/rid `{related_rid}` but returned not one: {items}')
             parent = items[0]
@@ -155,31 +404,148 @@ def collect_gdm_related_objects(gdm_rid, object_store_manager, relation_linkage_
             # so just query by uuid/rid/PK is preferrable, don't directly use the nested object
             pass
 
-        # store it (the normalized form in postgres)
-        parent = generic_transformation(gdm_rid, parent, item_type=item_type)
-        object_store_manager.insert(parent)
+        visited.add((item_type, related_rid))
+        visited.update(get_visit_keys(item_type, parent))
+        object_stack.extend(visit_related_object(gdm_rid, item_type, parent, object_store_manager, relation_linkage_transformer,
+            sid=fetcher.sids.get((item_type, related_rid))))
 
+        processed_counter += 1
+        logger.info(f'sql processed #{processed_counter} (not saved yet)')
 
-        Model = ModelSerializer._get_model(None, item_type)
-        singular_dot_representation_keys, plural_dot_representation_keys = Model.get_dot_representation_keys()
+def _collect_level_by_level(gdm_rid, object_store_manager, relation_linkage_transformer, roots):
+    with contextlib.ExitStack() as connection_context:
+        _collect_level_by_level_with(gdm_rid, object_store_manager, relation_linkage_transformer, roots, connection_context)
 
-        # patch schema of gdm.annotations so that we know how to link gdm to annotation
-        # but don't change sls json schema for gdm, since controller
-        # use it to populate field, and we don't want to populate gdm.annotations
-        if item_type == 'gdm':
-            plural_dot_representation_keys.append('annotations')
-            Model.map_dot_representation_to_item_type['annotations'] = 'annotation'
-            plural_dot_representation_keys.append('variantPathogenicity')
-            Model.map_dot_representation_to_item_type['variantPathogenicity'] = 'pathogenicity'
+def _collect_level_by_level_with(gdm_rid, object_store_manager, relation_linkage_transformer, roots, connection_context):
+    fetcher = RelatedObjectFetcher(gdm_rid, connection_context)
+    # (item_type, rid) already expanded, so each object is visited exactly once
+    visited = set()
 
-        # visit related fields
-        for dot_representation in singular_dot_representation_keys:
-            parent_field_value = dictdeepget(parent, dot_representation)
+    # a bfs traverse through the relation graph, one level (frontier) at a time
+    frontier = list(roots)
+
+    processed_counter = 0
+    while frontier:
+        # drop objects visited in previous levels, and duplicates within this level
+        unique_frontier = {}
+        for object_meta in frontier:
+            key = (object_meta['item_type'], object_meta['rid'])
+            if key not in visited and key not in unique_frontier:
+                unique_frontier[key] = object_meta
+        frontier = list(unique_frontier.values())
+
+        # group everything not in store yet by item_type, so each group costs one round-trip
+        rids_to_fetch = {}
+        for object_meta in frontier:
+            item_type = object_meta['item_type']
+            related_rid = object_meta['rid']
+            if object_store_manager.exist(item_type, related_rid):
+                continue
+            # a non-uuid reference means relation links are transformed already -
+            # since we only do transform after collecting all related objects
+            # this means objects are already cached by object store manager
+            # hence no need to sql fetch
+            if not is_uuid(related_rid):
+                continue
+            rids_to_fetch.setdefault(item_type, set()).add(related_rid)
+
+        fetched = {}
+        for item_type, rids in rids_to_fetch.items():
+            fetched[item_type] = fetcher.fetch_by_rids(item_type, rids)
+
+        next_frontier = []
+        for object_meta in frontier:
+            item_type = object_meta['item_type']
+            related_rid = object_meta['rid']
+
+            if object_store_manager.exist(item_type, related_rid):
+                parent = object_store_manager.get(item_type, related_rid)
+                logger.debug(f'Found in store so reuse: {item_type} {related_rid}')
+            elif not is_uuid(related_rid):
+                logger.info(f'sql processed #{processed_counter} (skipped due to relation link already transformed)')
+                continue
+            else:
+                parent = fetched[item_type].get(related_rid)
+                if not parent:
+                    raise Exception(f'{item_type} queried by PK/rid `{related_rid}` but returned not one')
+                logger.debug(f'fetched items = {parent["item_type"]} {get_pk_or_rid(parent)}')
+
+            # the same object may be referred by a different key (e.g. rid and transformed PK) in this level
+            if (item_type, related_rid) in visited:
+                continue
+            visited.add((item_type, related_rid))
+            visited.update(get_visit_keys(item_type, parent))
+            next_frontier.extend(visit_related_object(gdm_rid, item_type, parent, object_store_manager, relation_linkage_transformer,
+                sid=fetcher.sids.get((item_type, related_rid))))
+
+            processed_counter += 1
+        logger.info(f'sql processed #{processed_counter} (not saved yet), next level has {len(next_frontier)} objects')
+
+        frontier = next_frontier
+
+def _collect_server_side(gdm_rid, object_store_manager, relation_linkage_transformer, roots):
+    if LOCAL_SNAPSHOT:
+        # local fetches have no round-trip latency to save, so the batched walk is as good
+        logger.info('local snapshot is configured, collecting level by level from it instead of recursive query')
+        _collect_level_by_level(gdm_rid, object_store_manager, relation_linkage_transformer, roots)
+        return
+
+    with get_pool().connection() as connection:
+        try:
+            # named cursor is a server-side cursor, so results are streamed instead of loaded all at once
+            cursor = connection.cursor(name=f'gdm_related_objects_{gdm_rid}')
+            logger.info(f'executing recursive query for all objects related to gdm {gdm_rid}...')
+            cursor.execute(build_related_objects_query(), (gdm_rid,))
+
+            fetched_counter = 0
+            # buffered per item_type, to share with other gdms through the shared object cache
+            fetched_by_item_type = {}
+            for item_type, item, sid in cursor:
+                parent = item['body']
+                if SHARED_OBJECT_CACHE:
+                    fetched_by_item_type.setdefault(item_type, {})[parent['rid']] = (copy.deepcopy(parent), sid)
+                    if len(fetched_by_item_type[item_type]) >= SHARED_OBJECT_CACHE_BATCH_SIZE:
+                        SHARED_OBJECT_CACHE.put_many(item_type, fetched_by_item_type.pop(item_type))
+                # keep what's already in store, it may have its relation links transformed already
+                if not object_store_manager.exist(item_type, parent['rid']):
+                    object_store_manager.insert(generic_transformation(gdm_rid, parent, item_type=item_type), sid=sid)
+                fetched_counter += 1
+            for item_type, objects_by_rid in fetched_by_item_type.items():
+                SHARED_OBJECT_CACHE.put_many(item_type, objects_by_rid)
+            logger.info(f'recursive query returned {fetched_counter} objects')
+            cursor.close()
+        except psycopg2.Error as error:
+            print('Error while fetching data from PostgreSQL: %s' % error)
+            raise
+
+    # every related object is in store now, so this walk only registers the relation linkage work
+    # and does not need to hit postgres again
+    _collect_level_by_level(gdm_rid, object_store_manager, relation_linkage_transformer, roots)
+
+def visit_related_object(gdm_rid, item_type, parent, object_store_manager, relation_linkage_transformer, sid=None):
+    '''
+        Transforms and stores `parent`, registers its relation linkage work,
+        and returns the `{item_type, rid}` of objects it relates to, which should be visited next.
+
+    :param int sid: the sid `parent` was fetched at, None if it was reused from store
+    '''
+    related_object_metas = []
+
+    # store it (the normalized form in postgres)
+    parent = generic_transformation(gdm_rid, parent, item_type=item_type)
+    object_store_manager.insert(parent, sid=sid)
+
+    # visit related fields; the plan includes the patch for gdm.annotations so that we know how to link gdm to annotation
+    for relation in get_traversal_plan(item_type):
+        dot_representation = relation.dot_representation
+        related_item_type = relation.related_item_type
+        parent_field_value = get_path(parent, relation.path)
+
+        if not relation.is_plural:
             if not parent_field_value or not isinstance(parent_field_value, str):
                 continue
 
-            related_item_type = Model.map_dot_representation_to_item_type[dot_representation]
-            object_stack.append({
+            related_object_metas.append({
                 'item_type': related_item_type,
                 'rid': parent_field_value
             })
@@ -189,52 +555,43 @@ def collect_gdm_related_objects(gdm_rid, object_store_manager, relation_linkage_
                 parent_field_name=dot_representation,
                 relation_item_type=related_item_type
             )
-            
-        for dot_representation in plural_dot_representation_keys:
-            parent_field_value = dictdeepget(parent, dot_representation)
-            if not parent_field_value or not isinstance(parent_field_value, list):
-                continue
+            continue
+
+        if not parent_field_value or not isinstance(parent_field_value, list):
+            continue
+
+        for related_rid in parent_field_value:
+            if isinstance(related_rid, str):
+                related_object_metas.append({
+                    'item_type': related_item_type,
+                    'rid': related_rid
+                })
+            elif isinstance(related_rid, dict) and (
+                is_snapshot(related_rid)
+            ):
+                # snapshot does not have rid nor item_type in legacy system
+                snapshot = related_rid
+                related_object_metas.append({
+                    'item_type': related_item_type,
+                    
+                    # looks like some snapshot does not have rid
+                    'rid': snapshot['uuid'],
 
-            related_item_type = Model.map_dot_representation_to_item_type[dot_representation]
-            for related_rid in parent_field_value:
-                if isinstance(related_rid, str):
-                    object_stack.append({
-                        'item_type': related_item_type,
-                        'rid': related_rid
-                    })
-                elif isinstance(related_rid, dict) and (
-                    is_snapshot(related_rid)
-                ):
-                    # snapshot does not have rid nor item_type in legacy system
-                    snapshot = related_rid
-                    object_stack.append({
-                        'item_type': related_item_type,
-                        
-                        # looks like some snapshot does not have rid
-                        'rid': snapshot['uuid'],
-
-                        # do not use nested snapshot - it does not have resourceParent - 
-                        # use its uuid/rid to query the actual 'complete' snapshot object in db
-                        # 'object': snapshot
-                    })
-                else:
-                    raise Exception(f'Error: array field item has invalid type (neither PK (str) or object (dict)) in {item_type}.{dot_representation}, related_rid={related_rid}')
+                    # do not use nested snapshot - it does not have resourceParent - 
+                    # use its uuid/rid to query the actual 'complete' snapshot object in db
+                    # 'object': snapshot
+                })
+            else:
+                raise Exception(f'Error: array field item has invalid type (neither PK (str) or object (dict)) in {item_type}.{dot_representation}, related_rid={related_rid}')
 
-            relation_linkage_transformer.add(
-                parent_item_type=item_type,
-                parent_rid=parent['rid'],
-                parent_field_name=dot_representation,
-                relation_item_type=related_item_type
-            )
+        relation_linkage_transformer.add(
+            parent_item_type=item_type,
+            parent_rid=parent['rid'],
+            parent_field_name=dot_representation,
+            relation_item_type=related_item_type
+        )
 
-        processed_counter += 1
-        logger.info(f'sql processed #{processed_counter} (not saved yet)')
-    
-    logger.info('saving all sql process results to file...')
-    object_store_manager.save()
-    
-    if connection:
-        connection.close()
+    return related_object_metas
 
 def transform_relation_links(object_store_manager, relation_linkage_transformer):
     '''
@@ -244,8 +601,21 @@ def transform_relation_links(object_store_manager, relation_linkage_transformer)
     relation_linkage_transformer.processAll(object_store_manager)
     object_store_manager.save()
 
-def post_related_objects(object_store_manager):
-    items = object_store_manager.getAll(prioritized_schema_list=[
+# how many GET or POST requests may be in flight at once while posting a wave, configurable by `endpoint.max_in_flight`;
+# `auto` adapts POSTs in flight to what the endpoint sustains
+DEFAULT_POST_MAX_IN_FLIGHT = 'auto'
+
+def post_related_objects(object_store_manager, max_in_flight=None):
+    '''
+        Posts every object in dependency waves: each wave is checked against db and then POSTed concurrently,
+        and the next wave only starts once every POST of this one succeeded, so objects are created after those they refer to.
+        annotation and gdm still go last, so that related fields can populate properly.
+    '''
+    max_in_flight = max_in_flight or config_data.get('endpoint', {}).get('max_in_flight', DEFAULT_POST_MAX_IN_FLIGHT)
+    # one limiter for all waves, so each wave starts from the concurrency the previous ones settled on
+    post_threads = AdaptiveLimiter() if max_in_flight == 'auto' else max_in_flight
+    get_threads = CONCURRENT_GET_DEFAULT_THREADS if max_in_flight == 'auto' else max_in_flight
+    waves = object_store_manager.get_waves(prioritized_schema_list=[
         # create objects that does not have relationship first
         'user', 'disease', 'article', 'gene', 'evidenceScore', 'snapshot', 'provisionalClassification', 'assessment',
         # VCI objects
@@ -254,29 +624,186 @@ def post_related_objects(object_store_manager):
         'individual', 'family', 'group', 'experimental', 'caseControl', 'pathogenicity',
         # gdm should be the last, so that related fields can populate properly
         'annotation', 'gdm'
-    ])
-    logger.debug(f'n = {len(items)}')
-
-    for index, item in enumerate(items):
-        # use sls to GET
-        db_item_already = sls.get(item)
-        # use dynamodb to GET
-        # db_item_already = db.get(item)
-        if not db_item_already:
-            res = sls.post(item)
-            logger.info(f'POST {res.status_code} {item["item_type"]}({get_pk_or_rid(item)}) processed {index+1}/{len(items)} item')
+    ], final_schema_names=['annotation', 'gdm'])
+    items_count = object_store_manager.count()
+    logger.debug(f'n = {items_count}, in {len(waves)} waves')
+
+    processed_count = 0
+    for wave_index, wave in enumerate(waves):
+        items = [object_store_manager.get(*node) for node in wave]
+        not_in_db_items = filter_not_in_db(items, threads=get_threads)
+
+        post_results = sls.concurrent_post(not_in_db_items, threads=post_threads, raise_http_error=False)
+        failed_results = [res for res in post_results if res is not None and not res.ok]
+        processed_count += len(items)
+        logger.info(f'POST wave {wave_index+1}/{len(waves)}: {len(not_in_db_items)} posted, {len(items) - len(not_in_db_items)} skipping, processed {processed_count}/{items_count} item')
+        if failed_results:
+            # objects in later waves may refer to those not created
+            raise Exception(f'PostError: {len(failed_results)} POST failed in wave {wave_index+1}/{len(waves)}, see {sls.POST_ERROR_LOG_FILE}, first response = {failed_results[0].status_code} {failed_results[0].text}')
+
+    if isinstance(post_threads, AdaptiveLimiter):
+        logger.info(f'POST {post_threads.report()}')
+    logger.debug(f'connection reuse: {sls.connection_stats()}')
+
+def refresh_changed_objects(gdm_rid, object_store_manager):
+    '''
+        Compares the sid of every object in store with its current sid at source, in one query,
+        and drops objects which changed, were deleted, or have no sid recorded (stored before sids were).
+        Returns the `{item_type, rid}` of dropped objects that still exist, to collect again from.
+    '''
+    keys = [key for key in object_store_manager.iter_keys() if is_uuid(key[1])]
+    if not keys:
+        return []
+
+    with contextlib.ExitStack() as connection_context:
+        current_sids = RelatedObjectFetcher(gdm_rid, connection_context).fetch_sids(keys)
+
+    changed_metas = []
+    deleted_count = 0
+    stale_by_item_type = {}
+    for item_type, rid in keys:
+        current_sid = current_sids.get((item_type, rid))
+        if current_sid is not None and current_sid == object_store_manager.get_sid(item_type, rid):
+            continue
+        object_store_manager.remove(item_type, rid)
+        stale_by_item_type.setdefault(item_type, []).append(rid)
+        if current_sid is None:
+            deleted_count += 1
+            logger.warn(f'{item_type} {rid} no longer exists at source, dropped from store')
         else:
-            logger.info(f'POST skipping {item["item_type"]}({get_pk_or_rid(item)}) processed {index+1}/{len(items)} item')
+            changed_metas.append({'item_type': item_type, 'rid': rid})
 
-def single_migrate(gdm_rid):
+    if SHARED_OBJECT_CACHE:
+        for item_type, rids in stale_by_item_type.items():
+            SHARED_OBJECT_CACHE.invalidate(item_type, rids)
+    object_store_manager.save()
+    logger.info(f'refresh: {len(keys) - len(changed_metas) - deleted_count} objects unchanged, {len(changed_metas)} changed, {deleted_count} deleted')
+    return changed_metas
+
+def single_migrate(gdm_rid, collect_mode=COLLECT_MODE_BATCHED, refresh=False):
+    '''
+    :param bool refresh: refetch objects in store which changed at source since they were fetched,
+        instead of reusing the store as-is
+    '''
     object_store_manager = ObjectStoreManager(gdm_rid=gdm_rid)
     relation_linkage_transformer = RelationLinkageTransformer(logger)
 
-    collect_gdm_related_objects(gdm_rid=gdm_rid, object_store_manager=object_store_manager, relation_linkage_transformer=relation_linkage_transformer)
+    roots = refresh_changed_objects(gdm_rid, object_store_manager) if refresh else None
+    collect_gdm_related_objects(gdm_rid=gdm_rid, object_store_manager=object_store_manager, relation_linkage_transformer=relation_linkage_transformer, mode=collect_mode, roots=roots)
     transform_relation_links(object_store_manager=object_store_manager, relation_linkage_transformer=relation_linkage_transformer)
     post_related_objects(object_store_manager)
 
+DEFAULT_BATCH_WORKERS = os.cpu_count()
+BATCH_REPORT_DIRECTORY = pathlib.Path(f'{THIS_FILE_DIR}/.data')
+
+def _init_batch_worker():
+    # postgres pools are per process already (see `get_pool`), but the http session is created on import
+    sls.new_session()
+
+def _timed_single_migrate(gdm_rid, collect_mode, refresh):
+    start_time = perf_counter()
+    try:
+        single_migrate(gdm_rid, collect_mode=collect_mode, refresh=refresh)
+        return {
+            'gdm_rid': gdm_rid,
+            'ok': True,
+            'seconds': round(perf_counter() - start_time, 2)
+        }
+    except Exception as error:
+        return {
+            'gdm_rid': gdm_rid,
+            'ok': False,
+            'seconds': round(perf_counter() - start_time, 2),
+            'error': f'{type(error).__name__}: {error}',
+            'traceback': traceback.format_exc()
+        }
+
+def batch_migrate(gdm_rids, workers=DEFAULT_BATCH_WORKERS, collect_mode=COLLECT_MODE_BATCHED, refresh=False):
+    '''
+        Migrates many gdms at once, one gdm per worker process at a time.
+        Each gdm gets its own object store; a failing gdm does not stop the others.
+        Returns (and saves under `.data/`) a report of per-gdm timings and failures.
+    '''
+    gdm_rids = list(dict.fromkeys(gdm_rids))
+    logger.info(f'Batch migrating {len(gdm_rids)} gdms with {workers} workers')
+
+    start_time = perf_counter()
+    results = []
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_batch_worker) as executor:
+        futures = [executor.submit(_timed_single_migrate, gdm_rid, collect_mode, refresh) for gdm_rid in gdm_rids]
+        for index, future in enumerate(as_completed(futures)):
+            result = future.result()
+            results.append(result)
+            if result['ok']:
+                logger.info(f'gdm {result["gdm_rid"]} migrated in {result["seconds"]}s, {index+1}/{len(gdm_rids)} gdms processed')
+            else:
+                logger.error(f'gdm {result["gdm_rid"]} failed after {result["seconds"]}s: {result["error"]}, {index+1}/{len(gdm_rids)} gdms processed')
+
+    failed = [result for result in results if not result['ok']]
+    report = {
+        'workers': workers,
+        'collect_mode': collect_mode,
+        'refresh': refresh,
+        'total_seconds': round(perf_counter() - start_time, 2),
+        'succeeded_count': len(results) - len(failed),
+        'failed_count': len(failed),
+        'failed_gdm_rids': [result['gdm_rid'] for result in failed],
+        'results': sorted(results, key=lambda result: result['seconds'], reverse=True)
+    }
+
+    BATCH_REPORT_DIRECTORY.mkdir(parents=True, exist_ok=True)
+    report_file = BATCH_REPORT_DIRECTORY.joinpath(f'batch_migrate_report_{datetime.datetime.now().strftime("%Y%m%d-%H%M%S")}.json')
+    with report_file.open('w') as f:
+        json.dump(report, f, indent=2)
+    logger.info(f'Batch migrated {report["succeeded_count"]} gdms, {report["failed_count"]} failed, in {report["total_seconds"]}s. Report saved to {report_file}')
+
+    return report
+
+BATCH_USAGE = 'Usage : python migrate_single_gdm.py [--workers <#workers>] [--refresh] <gdm rid or file of gdm rids> ...'
+
+def read_gdm_rids(args):
+    '''
+        Each arg is either a gdm rid, or a file listing one gdm rid per line (`#` starts a comment)
+    '''
+    gdm_rids = []
+    for arg in args:
+        if is_uuid(arg):
+            gdm_rids.append(arg)
+            continue
+        if not os.path.isfile(arg):
+            print(f'{arg} is neither a gdm rid nor a file of gdm rids')
+            print(BATCH_USAGE)
+            sys.exit(1)
+        with open(arg, 'r') as f:
+            for line in f:
+                line = line.split('#')[0].strip()
+                if line:
+                    gdm_rids.append(line)
+    return gdm_rids
+
 if __name__ == "__main__":
+    # batch mode, e.g. `python migrate_single_gdm.py --workers 4 [--refresh] gdm_rids.txt <gdm rid> ...`
+    args = sys.argv[1:]
+    if args:
+        workers = DEFAULT_BATCH_WORKERS
+        refresh = False
+        while args and args[0] in ('--workers', '--refresh'):
+            if args[0] == '--workers':
+                if len(args) < 2 or not args[1].isdigit() or int(args[1]) < 1:
+                    print(BATCH_USAGE)
+                    sys.exit(1)
+                workers = int(args[1])
+                args = args[2:]
+            else:
+                refresh = True
+                args = args[1:]
+        gdm_rids = read_gdm_rids(args)
+        if not gdm_rids:
+            print(BATCH_USAGE)
+            sys.exit(1)
+        report = batch_migrate(gdm_rids, workers=workers, refresh=refresh)
+        sys.exit(1 if report['failed_count'] else 0)
+
     # note that this will cause local dynamodb data file to change
     # which may require a re-start of the dynamodb server
     # better reset the db by replacing the data file manually
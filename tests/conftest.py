@@ -0,0 +1,5 @@
+import os
+import sys
+
+# the scripts import `custom_utils` from the repo root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
@@ -0,0 +1,67 @@
+from custom_utils.adaptive_limiter import AdaptiveLimiter, ADAPTIVE_MIN_SAMPLES, is_overloaded_status
+
+def record_round(limiter, latency, count=None):
+    # the requests in flight at the last change are ignored, then a full round is judged
+    for _ in range(limiter.ignore_count + (count or max(limiter.limit, ADAPTIVE_MIN_SAMPLES))):
+        limiter.record(latency, 200)
+
+def test_overloaded_statuses():
+    assert is_overloaded_status(429) and is_overloaded_status(503)
+    assert not is_overloaded_status(200) and not is_overloaded_status(404)
+
+def test_grows_by_one_per_healthy_round():
+    limiter = AdaptiveLimiter(initial=4)
+    record_round(limiter, 0.1)
+    assert limiter.limit == 5
+    record_round(limiter, 0.1)
+    assert limiter.limit == 6
+
+def test_no_decision_before_enough_samples():
+    limiter = AdaptiveLimiter(initial=4)
+    for _ in range(ADAPTIVE_MIN_SAMPLES - 1):
+        limiter.record(0.1, 200)
+    assert limiter.limit == 4
+
+def test_halves_on_throttling_once_per_round():
+    limiter = AdaptiveLimiter(initial=16)
+    limiter.record(0.1, 429)
+    assert limiter.limit == 8
+    # requests sent at the old limit fail the same way, they do not back off again
+    for _ in range(7):
+        limiter.record(0.1, 429)
+    assert limiter.limit == 8
+    # a full round at the new limit still failing does
+    limiter.record(0.1, 429)
+    assert limiter.limit == 4
+    assert limiter.backoff_count == 2
+
+def test_timeouts_back_off():
+    limiter = AdaptiveLimiter(initial=10)
+    limiter.record(timed_out=True)
+    assert limiter.limit == 5
+
+def test_shrinks_when_latency_rises_above_best():
+    limiter = AdaptiveLimiter(initial=10)
+    record_round(limiter, 0.1)
+    assert limiter.limit == 11
+    record_round(limiter, 0.2)
+    assert limiter.limit == 9
+    assert limiter.last_p95 == 0.2
+
+def test_latency_of_old_limit_is_ignored():
+    limiter = AdaptiveLimiter(initial=10)
+    record_round(limiter, 0.1)
+    # slow requests sent before the change do not count against the new limit
+    for _ in range(limiter.ignore_count):
+        limiter.record(5.0, 200)
+    record_round(limiter, 0.1, count=ADAPTIVE_MIN_SAMPLES)
+    assert limiter.limit == 12
+
+def test_stays_within_bounds():
+    limiter = AdaptiveLimiter(initial=2, min_limit=2, max_limit=3)
+    for _ in range(3):
+        record_round(limiter, 0.1)
+    assert limiter.limit == 3
+    limiter.record(0.1, 503)
+    assert limiter.limit == 2
+    assert limiter.max_limit_reached == 3
@@ -0,0 +1,64 @@
+import copy
+
+from custom_utils.interning import SubtreeInterner, is_ref
+
+def make_snapshot(uuid, annotation_note='note'):
+    annotation = {'item_type': 'annotation', 'rid': 'annotation-1', 'notes': annotation_note}
+    return {
+        'item_type': 'snapshot',
+        'uuid': uuid,
+        'resourceParent': {'item_type': 'gdm', 'rid': 'gdm-1', 'annotations': [annotation, copy.deepcopy(annotation)]},
+    }
+
+def test_intern_shares_identical_embedded_objects():
+    interner = SubtreeInterner()
+    first, _, _ = interner.intern(make_snapshot('s1'))
+    second, _, _ = interner.intern(make_snapshot('s2'))
+
+    assert first['resourceParent'] is second['resourceParent']
+    annotations = first['resourceParent']['annotations']
+    assert annotations[0] is annotations[1]
+    # roots are never shared
+    assert first is not second and first['uuid'] == 's1'
+
+def test_intern_leaves_input_unchanged():
+    snapshot = make_snapshot('s1')
+    original = copy.deepcopy(snapshot)
+    interned, _, _ = SubtreeInterner().intern(snapshot)
+    assert snapshot == original
+    assert interned == original
+
+def test_different_content_is_not_shared():
+    interner = SubtreeInterner()
+    first, _, _ = interner.intern(make_snapshot('s1'))
+    second, _, _ = interner.intern(make_snapshot('s2', annotation_note='changed'))
+    assert first['resourceParent'] is not second['resourceParent']
+
+def test_stored_form_expands_back_in_a_new_interner():
+    interner = SubtreeInterner()
+    snapshot = make_snapshot('s1')
+    _, stored, refs = interner.intern(snapshot)
+
+    assert is_ref(stored['resourceParent'])
+    assert refs == {stored['resourceParent']['$ref']}
+    # everything the stored form needs, as the object store writes it
+    subtree_hashes = interner.closure(refs, known={})
+    assert len(subtree_hashes) == 2
+
+    loaded = []
+    def load_stored(content_hash):
+        loaded.append(content_hash)
+        return interner.stored[content_hash]
+
+    reader = SubtreeInterner()
+    expanded = reader.expand(stored, load_stored)
+    assert expanded == snapshot
+    # each embedded object is loaded once, and shared once expanded
+    assert sorted(loaded) == sorted(subtree_hashes)
+    assert expanded['resourceParent']['annotations'][0] is expanded['resourceParent']['annotations'][1]
+
+def test_closure_stops_at_known_hashes():
+    interner = SubtreeInterner()
+    _, stored, refs = interner.intern(make_snapshot('s1'))
+    parent_hash = stored['resourceParent']['$ref']
+    assert interner.closure(refs, known={parent_hash: True}) == set()
@@ -0,0 +1,57 @@
+import pytest
+
+# the object store reads relations from the serverless schema, see `custom_utils.traversal_plan`
+pytest.importorskip('src.models.item_type_serializer')
+
+from custom_utils import object_store
+from custom_utils.object_store import ObjectStoreManager
+
+GDM_RID = 'test-gdm'
+
+@pytest.fixture
+def store_dir(tmp_path, monkeypatch):
+    # the store is kept in `{THIS_FILE_DIR}/../.data`
+    monkeypatch.setattr(object_store, 'THIS_FILE_DIR', str(tmp_path / 'custom_utils'))
+    return tmp_path / '.data'
+
+def test_reopen_reads_saved_objects(store_dir):
+    store = ObjectStoreManager(GDM_RID)
+    gene = {'item_type': 'gene', 'rid': 'gene-rid', 'symbol': 'RELN'}
+    store.insert(gene, sid=3)
+    store.save()
+
+    reopened = ObjectStoreManager(GDM_RID)
+    assert reopened.count() == 1
+    assert reopened.exist('gene', 'gene-rid') and reopened.exist('gene', 'RELN')
+    assert reopened.get('gene', 'RELN') == gene
+    assert reopened.get_sid('gene', 'gene-rid') == 3
+
+def test_reopen_after_change_and_remove(store_dir):
+    store = ObjectStoreManager(GDM_RID)
+    store.insert({'item_type': 'gene', 'rid': 'a', 'symbol': 'A'})
+    store.insert({'item_type': 'gene', 'rid': 'b', 'symbol': 'B'})
+    store.save()
+    store.insert({'item_type': 'gene', 'rid': 'a', 'symbol': 'A', 'name': 'changed'})
+    store.remove('gene', 'b')
+    store.save()
+
+    reopened = ObjectStoreManager(GDM_RID)
+    assert sorted(reopened.iter_keys()) == [('gene', 'a')]
+    assert reopened.get('gene', 'a')['name'] == 'changed'
+    assert not reopened.exist('gene', 'B')
+
+def test_reopen_expands_interned_snapshots(store_dir):
+    annotation = {'item_type': 'annotation', 'rid': 'annotation-1', 'notes': 'note'}
+    snapshots = [
+        {'item_type': 'snapshot', 'uuid': uuid, 'resourceParent': {'item_type': 'gdm', 'rid': 'gdm-1', 'annotations': [dict(annotation)]}}
+        for uuid in ('s1', 's2')
+    ]
+    store = ObjectStoreManager(GDM_RID)
+    for snapshot in snapshots:
+        store.insert(snapshot)
+    store.save()
+
+    reopened = ObjectStoreManager(GDM_RID)
+    assert [reopened.get('snapshot', uuid) for uuid in ('s1', 's2')] == snapshots
+    # embedded objects are shared again once loaded
+    assert reopened.get('snapshot', 's1')['resourceParent'] is reopened.get('snapshot', 's2')['resourceParent']
@@ -0,0 +1,42 @@
+import copy
+import json
+
+from custom_utils.payload import strip_empty_fields, encode_json
+
+def stdlib_json(obj):
+    # the encoding of `custom_utils.serialization.JsonCodec`
+    return json.dumps(obj, separators=(',', ':')).encode('utf-8')
+
+def test_strip_removes_empty_strings_and_leaves_input_unchanged():
+    parent = {'a': '', 'b': 'x', 'nested': {'c': '', 'd': 1}, 'list': ['', 'y', {'e': ''}], 'none': None}
+    original = copy.deepcopy(parent)
+
+    stripped = strip_empty_fields(parent)
+    assert stripped == {'b': 'x', 'nested': {'d': 1}, 'list': ['y', {}], 'none': None}
+    assert parent == original
+
+def test_strip_returns_objects_without_empty_fields_as_is():
+    parent = {'a': 'x', 'nested': {'b': 1}, 'list': [{'c': 'y'}], 'changed': {'d': ''}}
+    stripped = strip_empty_fields(parent)
+    assert stripped is not parent
+    # only the path to a stripped field is copied
+    assert stripped['nested'] is parent['nested']
+    assert stripped['list'] is parent['list']
+    assert strip_empty_fields(parent['nested']) is parent['nested']
+
+def test_strip_walks_shared_objects_once():
+    shared = {'a': '', 'b': 1}
+    stripped = strip_empty_fields({'first': shared, 'second': [shared]})
+    assert stripped['first'] == {'b': 1}
+    assert stripped['first'] is stripped['second'][0]
+
+def test_encode_matches_stdlib_json_for_non_finite_floats():
+    for payload in (
+        {'score': float('nan'), 'note': None},
+        {'scores': [1.5, float('inf')], 'nested': {'low': float('-inf')}},
+    ):
+        assert encode_json(payload) == stdlib_json(payload)
+
+def test_encode_round_trips_regular_payloads():
+    payload = {'item_type': 'variant', 'score': 0.25, 'none': None, 'list': [1, 'é', True], 'big': 2 ** 70}
+    assert json.loads(encode_json(payload)) == payload
@@ -0,0 +1,76 @@
+import json
+
+import pytest
+
+from custom_utils.serialization import (
+    CODECS, COMPRESSIONS, RECORD_LENGTHS, RecordFile, Serializer, JsonCodec, NoCompression, GzipCompression,
+    dump_file, load_file,
+)
+
+SAMPLE = {'item_type': 'gene', 'rid': 'a', 'symbol': 'RELN', 'nested': {'list': [1, 2.5, None, True, 'é']}}
+
+def installed(factories):
+    return [name for name, factory in factories.items() if factory()]
+
+@pytest.mark.parametrize('codec_name', installed(CODECS))
+def test_codec_round_trip(codec_name):
+    codec = CODECS[codec_name]()
+    assert codec.loads(codec.dumps(SAMPLE)) == SAMPLE
+
+@pytest.mark.parametrize('compression_name', installed(COMPRESSIONS))
+def test_compression_round_trip(compression_name):
+    compression = COMPRESSIONS[compression_name]()
+    data = json.dumps(SAMPLE).encode('utf-8') * 10
+    assert compression.decompress(compression.compress(data)) == data
+
+def test_dump_file_round_trip_and_plain_json(tmp_path):
+    path = tmp_path / 'document'
+    dump_file(path, SAMPLE, serializer=Serializer(JsonCodec(), GzipCompression()))
+    assert load_file(path) == SAMPLE
+
+    legacy_path = tmp_path / 'legacy.json'
+    legacy_path.write_text(json.dumps(SAMPLE))
+    assert load_file(legacy_path) == SAMPLE
+
+def test_record_file_reopen_round_trip(tmp_path):
+    path = tmp_path / 'objects.records'
+    record_file = RecordFile(path, serializer=Serializer(JsonCodec(), NoCompression()))
+    record_file.write([('a', {'n': 1}), ('b', {'n': 2})])
+    record_file.append([('c', {'n': 3}), ('a', {'n': 4})])
+    record_file.close()
+
+    reopened = RecordFile(path)
+    assert len(reopened) == 3
+    # the latest record of a key wins, keys stay in first written order
+    assert list(reopened.keys()) == ['a', 'b', 'c']
+    assert [reopened.get(key) for key in reopened.keys()] == [{'n': 4}, {'n': 2}, {'n': 3}]
+    assert reopened.serializer.codec.name == 'json'
+
+def test_record_file_drops_torn_tail_on_open(tmp_path):
+    path = tmp_path / 'objects.records'
+    record_file = RecordFile(path, serializer=Serializer(JsonCodec(), NoCompression()))
+    record_file.write([('a', {'n': 1})])
+    complete_size = record_file.size
+    record_file.append([('b', {'n': 2})])
+    record_file.close()
+    # a crash in the middle of the last record
+    with open(path, 'r+b') as f:
+        f.truncate(complete_size + RECORD_LENGTHS.size + 1)
+
+    reopened = RecordFile(path)
+    assert list(reopened.keys()) == ['a']
+    assert path.stat().st_size == complete_size
+
+    # appending after the truncation gives a readable file again
+    reopened.append([('c', {'n': 3})])
+    reopened.close()
+    assert [RecordFile(path).get(key) for key in ('a', 'c')] == [{'n': 1}, {'n': 3}]
+
+def test_record_file_write_replaces_content(tmp_path):
+    path = tmp_path / 'objects.records'
+    record_file = RecordFile(path)
+    record_file.write([('a', 1), ('b', 2)])
+    record_file.write([('c', 3)])
+    record_file.close()
+    assert dict((key, RecordFile(path).get(key)) for key in RecordFile(path).keys()) == {'c': 3}
+    assert not (tmp_path / 'objects.records.writing').exists()